@@ -12,6 +12,11 @@ def getCluster():
     # Cluster defaults
     #
     # The bootImage parameter is relative to some libvirt-managed storage pool.
+    # Hosts run on copy-on-write overlays of the boot image, which is never
+    # written to. With cacheBootImage, the overlays are created when the cluster
+    # starts and removed with it. Otherwise a host keeps its overlay,
+    # <uname>.persistent.qcow2 in the storage pool, across runs; remove it to
+    # start the host from the boot image again.
     #---------------------------------------------------------------------------
     cluster.defaultHost.bootImage = 'slc6_testslave_ref.img'
     cluster.defaultHost.cacheBootImage = True
@@ -53,6 +58,11 @@ def getCluster():
     #
     # Disk sizes should be larger than 10GB for data server nodes, otherwise 
     # the node might not be selected by the cmsd.
+    #
+    # Disks are formatted with ext4 unless fsType (and mkfsOptions) are given,
+    # e.g. Disk('disk1', '20G', fsType='xfs', mkfsOptions='-b size=4096'). Each
+    # combination of size, filesystem and options is formatted only once, into
+    # a template in the storage pool, and disks are copy-on-write overlays of it.
     #---------------------------------------------------------------------------
     metamanager1.disks =  [Disk('disk1', '20G', device='vda', mountPoint='/data')]
     manager1.disks =  [Disk('disk1', '20G', device='vda', mountPoint='/data')]
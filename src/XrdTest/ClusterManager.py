@@ -49,10 +49,12 @@ try:
     import libvirt
     import time
     
-    from ClusterUtils import ClusterManagerException, Cluster
+    from hashlib import md5
+    from ClusterUtils import ClusterManagerException, Cluster, Capacity
     from ClusterUtils import ERR_CONNECTION, ERR_ADD_HOST, ERR_CREATE_NETWORK
     from Utils import Command, State
     from SocketUtils import XrdMessage
+    from StorageCatalog import StorageCatalog
     from copy import deepcopy
     from libvirt import libvirtError
 except ImportError, e:
@@ -76,20 +78,82 @@ class ClusterManager:
         self.hosts = {}
         # dictionary of currently running networks. Key: networkObj.uname
         self.nets = {}
+        # snapshots of running hosts, in order of taking. Key: hostObj.uname
+        # Value: list of (name, memory file, live domain XML, overlays), the
+        # overlays being (target device, backing file, format, overlay file)
+        self.snapshots = {}
         self.storagePool = ''
+        # maximum number of hosts of a cluster provisioned at once
+        self.provisionWorkers = 4
+        # seconds a host is given to shut down before it is destroyed
+        self.shutdownTimeout = 60
+        # guards self.hosts while hosts are defined by several threads
+        self.hostsLock = threading.RLock()
+        # serializes messages sent to the master by several threads
+        self.sendLock = threading.Lock()
+        # libvirt connection shared by all threads, opened on first use
+        self.virtConnection = None
+        self.virtConnectionUrl = None
+        self.virtConnectionLock = threading.Lock()
+        # pre-formatted disk templates being created. Key: template path,
+        # Value: lock held while formatting it
+        self.templateLocks = {}
+        self.templateLocksLock = threading.Lock()
+        # storage pool paths and volumes, looked up once
+        self.storageCatalog = StorageCatalog(self.virtconnect)
 
     def virtconnect(self, url="qemu:///system"):
         '''
-        Creates and returns connection to virtual machines manager
+        Returns connection to virtual machines manager. The connection is
+        opened once and shared, libvirt connections being thread safe. It is
+        reopened if it was closed, e.g. because libvirtd restarted.
         @param url: connection url
         @raise ClusterManagerException: when fails to connect
         @return: None
         '''
+        self.virtConnectionLock.acquire()
         try:
-            virtConnection = libvirt.open(url)
-            return virtConnection
+            if self.virtConnection and (self.virtConnectionUrl != url or \
+                                        not self.isAlive(self.virtConnection)):
+                LOGGER.info("Reconnecting to libvirt (%s)." % url)
+                self.closeConnection()
+            if not self.virtConnection:
+                try:
+                    self.virtConnection = libvirt.open(url)
+                    self.virtConnectionUrl = url
+                except libvirtError, e:
+                    LOGGER.error("Can not connect to libvirt (-c %s): %s" % \
+                                 (url, e))
+            return self.virtConnection
+        finally:
+            self.virtConnectionLock.release()
+
+    def isAlive(self, conn):
+        '''
+        @param conn: libvirt connection
+        @return: True if the connection is still usable
+        '''
+        try:
+            if hasattr(conn, 'isAlive'):
+                return conn.isAlive() == 1
+            # libvirt older than 0.9.8, ask the daemon
+            conn.getLibVersion()
+            return True
+        except libvirtError:
+            return False
+
+    def closeConnection(self):
+        '''
+        Close the shared libvirt connection, if it is open.
+        '''
+        if not self.virtConnection:
+            return
+        try:
+            self.virtConnection.close()
         except libvirtError, e:
-            LOGGER.error("Can not connect to libvirt (-c qemu:///system): %s" % e)
+            LOGGER.warning("Error closing libvirt connection: %s" % e)
+        self.virtConnection = None
+        self.virtConnectionUrl = None
 
     def disconnect(self):
         '''
@@ -107,111 +171,174 @@ class ClusterManager:
         if err:
             LOGGER.error(err)
 
-    def copyImg(self, huName):
+        self.virtConnectionLock.acquire()
+        try:
+            self.closeConnection()
+        finally:
+            self.virtConnectionLock.release()
+
+    def imageFormat(self, path):
         '''
-        Method runnable in separate threads, to separate copying of source
-        operating system image to a temporary image.
-        
-        @param huName: host.uname - host unique name
+        @param path: path of a disk image
+        @return: format of the image, e.g. raw or qcow2, raw if unknown
         '''
-        (host, cacheImg, hostObj) = self.hosts[huName]
-        dip = self.clusters[hostObj.clusterName].defaultHost.bootImage
-        
-        self.updateState(Cluster.S_COPYING_IMAGES, hostObj.clusterName)
-        LOGGER.info(("Start copying %s (for %s) to cache image %s") \
-                    % (dip, hostObj.uname, cacheImg))
+        output, retcode = Command('qemu-img info %s' % path, '.').execute()
+        match = re.search(r'^file format: (\S+)', output or '', re.M)
+        if retcode or not match:
+            return 'raw'
+        return match.group(1)
+
+    def createOverlay(self, hostObj):
+        '''
+        Create the copy-on-write image a host runs on, backed by its boot
+        image in the storage pool. Takes a moment whatever the size of the
+        boot image, which is never written to and is shared by all hosts.
+        An overlay left from an earlier run is replaced.
+
+        @param hostObj: Host object with bootImage set to the full path
+        @raise ClusterManagerException: when fails
+        '''
+        self.removeOverlay(hostObj)
+        LOGGER.info("Creating overlay image %s (for %s) backed by %s" % \
+                    (hostObj.runningDiskImage, hostObj.uname,
+                     hostObj.bootImage))
+        output, retcode = Command(('qemu-img create -f qcow2 -o ' + \
+                                   'backing_fmt=%s -b %s %s') % \
+                                  (self.imageFormat(hostObj.bootImage),
+                                   hostObj.bootImage,
+                                   hostObj.runningDiskImage), '.').execute()
+        if retcode:
+            raise ClusterManagerException(("Could not create overlay " + \
+                                           "image for %s: %s") % \
+                                          (hostObj.uname, output))
+
+    def removeOverlay(self, hostObj):
+        '''
+        Remove the copy-on-write image of a host, unless it is kept across
+        runs. Errors are only logged.
+
+        @param hostObj: Host object
+        '''
+        if not hostObj.cacheBootImage or \
+            not os.path.exists(hostObj.runningDiskImage):
+            return
         try:
-            f = open(dip , "r")
-            cacheImgFile = open(cacheImg, 'w')
-            #buffsize = 52428800 #read 50 MB at a time
-            buffsize = (1024 ** 3) / 2  #read/write 512 MB at a time
-            buff = f.read(buffsize)
-            while buff:
-                cacheImgFile.write(buff)
-                buff = f.read(buffsize)
-            f.close()
-            cacheImgFile.close()
-        except IOError, e:
-            msg = "Can't open %s: %s" % (dip, e)
-            raise ClusterManagerException(msg)
-        else:
-            LOGGER.info(("Disk image %s  (for %s) copied to cache file %s") \
-                        % (dip, hostObj.name, cacheImg))
-                
+            os.remove(hostObj.runningDiskImage)
+        except OSError, e:
+            LOGGER.error("Could not remove overlay image %s: %s" % \
+                         (hostObj.runningDiskImage, e))
+
     def defineHost(self, host):
         '''
         Defines virtual host in a cluster using given host object,
         not starting it. Host with the given name may be defined once
         in the system. Stores hosts objects in class property self.hosts.
+        Safe to call from several threads.
         
         @param host: ClusterManager.Host object
         @raise ClusterManagerException: when fails
         @return: host object from libvirt lib
         '''
-        if self.hosts.has_key(host.uname):
-            return self.hosts[host.uname][0]
+        self.hostsLock.acquire()
+        try:
+            if self.hosts.has_key(host.uname):
+                return self.hosts[host.uname][0]
 
-        for h in self.hosts.itervalues():
-            # get disk image path from cluster definition
-            cip = self.clusters[host.clusterName].defaultHost.bootImage
-            # if machine has any disk image given?
-            if h[2].runningDiskImage == host.bootImage or \
-                (not host.bootImage and h[2].runningDiskImage == cip):
-                return h[0]
+            pool = self.findStoragePool(self.storagePool)
+            if host.cacheBootImage:
+                # machine runs on a copy-on-write overlay of its boot image,
+                # created anew for every run
+                host.runningDiskImage = os.path.join(pool,
+                                                     '%s.qcow2' % host.uname)
+            else:
+                # machine keeps its overlay across runs. The boot image
+                # itself backs the overlays of other machines, so it is
+                # never run on
+                host.runningDiskImage = os.path.join(pool,
+                                            '%s.persistent.qcow2' % host.uname)
+            host.runningDiskFormat = 'qcow2'
 
-        if not host.bootImage:
-            host.runningDiskImage = os.path.join(self.findStoragePool(\
-                                    self.storagePool), '%s.img.cache' % (host.uname))
-        else:
-            # machine uses original source image
-            LOGGER.info(("Defining machine %s using original image %s") \
-                        % (host.uname, host.bootImage))
-            host.runningDiskImage = os.path.join(self.findStoragePool(self.storagePool), host.bootImage)
+            try:
+                conn = self.virtconnect()
+                hostdef = conn.defineXML(host.xmlDesc)
+
+                # add host definition objects to dictionary
+                # key: host.uname - unique name
+                self.hosts[host.uname] = (hostdef, host.runningDiskImage, host)
+                LOGGER.info("Defined machine: %s" % host.uname)
+            except libvirtError, e:
+                try:
+                    # that is possible that machine was already created
+                    # if so, find it and safe the definition
+                    hostdef = conn.lookupByName(host.uname)
+                    self.hosts[host.uname] = (hostdef, None, host)
+                    LOGGER.info("Machine already defined: %s" % host.uname)
+                except libvirtError, e:
+                    msg = ("Can't define machine %s on image %s nor " + \
+                            "obtain machine definition: %s") % \
+                            (host.uname, host.runningDiskImage, e)
+                    raise ClusterManagerException(msg, ERR_ADD_HOST)
+            return self.hosts[host.uname]
+        finally:
+            self.hostsLock.release()
 
-        self.hosts[host.uname] = None
+    #---------------------------------------------------------------------------
+    def shutdownHosts(self, hostUnameList, clusterName=None):
+        '''
+        Shut down hosts, all of them at once. Each one is asked to power off
+        and destroyed if it did not within self.shutdownTimeout seconds.
+        @param hostUnameList: list of unames of defined hosts
+        @param clusterName: name of the cluster progress is reported for
+        @raise ClusterManagerException: when any of the hosts fails
+        '''
+        errors = self.parallel(lambda h: self.shutdownHost(h, clusterName),
+                               hostUnameList)
+        if errors:
+            msg = "Could not shut down virtual machine: %s" % \
+                  ', '.join(map(str, errors))
+            raise ClusterManagerException(msg, ERR_CONNECTION)
+
+    def shutdownHost(self, hostUName, clusterName=None):
+        '''
+        Shut down a host gracefully, polling it at growing intervals, and
+        destroy it when the deadline passes.
+        @param hostUName: host.uname host unique name
+        @param clusterName: name of the cluster progress is reported for
+        @raise ClusterManagerException: when fails
+        '''
+        h = self.hosts[hostUName][0]
+        start = time.time()
+        deadline = start + self.shutdownTimeout
         try:
-            conn = self.virtconnect()
-            hostdef = conn.defineXML(host.xmlDesc)
+            if not h.isActive():
+                return
+            LOGGER.info("Shutting down %s." % hostUName)
+            h.shutdown()
+
+            interval = 0.1
+            while h.isActive() and time.time() < deadline:
+                time.sleep(max(0, min(interval, deadline - time.time())))
+                interval = min(interval * 2, 1)
 
-            # add host definition objects to dictionary
-            # key: host.uname - unique name
-            self.hosts[host.uname] = (hostdef, host.runningDiskImage, host)
-            LOGGER.info("Defined machine: %s" % host.uname)
+            if h.isActive():
+                LOGGER.warning("Machine %s did not shut down in %ds." % \
+                               (hostUName, self.shutdownTimeout))
+                try:
+                    h.destroy()
+                except libvirtError, e:
+                    # it may have powered off just now
+                    if h.isActive():
+                        raise e
+                how = 'destroyed after %ds' % self.shutdownTimeout
+            else:
+                how = 'powered off in %.1fs' % (time.time() - start)
         except libvirtError, e:
-            try:
-                # that is possible that machine was already created
-                # if so, find it and safe the definition
-                hostdef = conn.lookupByName(host.uname)
-                self.hosts[host.uname] = (hostdef, None, host)
-                LOGGER.info("Machine already defined: %s" % host.uname)
-            except libvirtError, e:
-                msg = ("Can't define machine %s on image %s nor " + \
-                        "obtain machine definition: %s") % \
-                        (host.uname, host.runningDiskImage, e)
-                raise ClusterManagerException(msg, ERR_ADD_HOST)
-        return self.hosts[host.uname]
+            raise ClusterManagerException("%s: %s" % (hostUName, e))
 
-    #---------------------------------------------------------------------------
-    def shutdownHosts( self, hostUnameList ):
-      try:
-        for hName in hostUnameList:
-          h = self.hosts[hName][0]
-          LOGGER.info("Shutting down %s." % hName)
-          h.shutdown()
-      except libvirtError, e:
-        msg = "Could not shut down virtual machine: %s" % e
-        raise ClusterManagerException(msg, ERR_CONNECTION)
-
-      # active waiting is crappy, especially blocking the command thread,
-      # but I need to rewrite this class anyways
-      activeHosts = len(hostUnameList)
-      while activeHosts:
-        activeHosts = 0
-        for hName in hostUnameList:
-          if self.hosts[hName][0].isActive():
-            activeHosts += 1
-        LOGGER.info("Waiting for %d hosts to shutdown." % activeHosts)
-        time.sleep(2)
+        LOGGER.info("Machine %s %s." % (hostUName, how))
+        if clusterName:
+            self.updateState(Cluster.S_DESTROYING_CLUSTER, clusterName,
+                             "%s %s" % (hostUName, how))
 
     def removeHost(self, hostUName):
         '''
@@ -219,11 +346,18 @@ class ClusterManager:
         @param hostUName: host.uname host unique name
         '''
         try:
-            h = self.hosts[hostUName][0]
+            (h, runningDiskImage, hostObj) = self.hosts[hostUName]
             LOGGER.info("Destroying and undefining machine %s." % hostUName)
             h.undefine()
 
-            del self.hosts[hostUName]
+            self.hostsLock.acquire()
+            try:
+                del self.hosts[hostUName]
+            finally:
+                self.hostsLock.release()
+            self.removeOverlay(hostObj)
+            for snapshot in self.snapshots.pop(hostUName, []):
+                self.removeSnapshotFiles(snapshot)
         except libvirtError, e:
             msg = "Could not remove virtual machine: %s" % e
             LOGGER.error(msg)
@@ -317,6 +451,42 @@ class ClusterManager:
             LOGGER.error(msg)
             raise ClusterManagerException(msg, ERR_CONNECTION)
 
+    def createTunnel(self, networkObj):
+        '''
+        Bridges the network to the networks of other parts of a split
+        cluster, if it is a part of one.
+        @param networkObj: Network object
+        @raise ClusterManagerException: when fails
+        '''
+        tunnel = getattr(networkObj, 'tunnel', None)
+        if not tunnel:
+            return
+
+        LOGGER.info("Tunnelling network %s to %s over %s." % \
+                    (networkObj.uname, ', '.join(tunnel.peers), tunnel.mode))
+        for cmd in tunnel.upCommands(networkObj.bridgeName, networkObj.ip):
+            output, retcode = Command(cmd, '.').execute()
+            if retcode:
+                self.removeTunnel(networkObj)
+                raise ClusterManagerException(("Could not tunnel network " + \
+                                               "%s: %s failed: %s") % \
+                                              (networkObj.uname, cmd, output),
+                                              ERR_CREATE_NETWORK)
+
+    def removeTunnel(self, networkObj):
+        '''
+        Removes the tunnel of the network, if it has one. Errors are only
+        logged, as parts of the tunnel may not have been created.
+        @param networkObj: Network object
+        '''
+        tunnel = getattr(networkObj, 'tunnel', None)
+        if not tunnel:
+            return
+
+        LOGGER.info("Removing tunnel of network %s." % networkObj.uname)
+        for cmd in tunnel.downCommands(networkObj.ip):
+            Command(cmd + ' 2>/dev/null', '.').execute()
+
     def removeDanglingHost(self, hostObj):
         '''
         Remove already defined host, if it has name the same as hostObj.
@@ -380,6 +550,9 @@ class ClusterManager:
         self.clusters[cluster.name] = cluster
         try:
             net = self.createNetwork(cluster.network, cluster.name)
+            if net:
+                self.removeTunnel(cluster.network)
+                self.createTunnel(cluster.network)
         except ClusterManagerException, e:
             LOGGER.error(e)
             raise e
@@ -390,85 +563,102 @@ class ClusterManager:
                                           (cluster.network.uname, cluster.name))
             return
 
+        if not cluster.hosts:
+            LOGGER.warning("No hosts in cluster defined.")
+            return
+
         self.updateState(Cluster.S_CREATING_SLAVES, cluster.name)
+        # hosts are provisioned independently, each one going through all
+        # the stages as soon as a worker picks it up
+        started = []
+        begin = time.time()
+        errors = self.parallel(lambda h: self.provisionHost(cluster, h, started),
+                               cluster.hosts, self.provisionWorkers, True)
+        if errors:
+            LOGGER.error("Error occured. Removing machines of cluster %s." % \
+                         cluster.name)
+            self.rollbackHosts(cluster)
+            self.removeTunnel(cluster.network)
+            try:
+                self.removeNetwork(cluster.network.uname)
+            except ClusterManagerException, e:
+                LOGGER.error(e)
+            del self.clusters[cluster.name]
+            raise ClusterManagerException("Error during creation of " + \
+                  "cluster %s: %s" % (cluster.name, ', '.join(map(str, errors))))
+
+        LOGGER.info("Provisioned %d machine(s) of cluster %s in %.1fs" % \
+                    (len(cluster.hosts), cluster.name, time.time() - begin))
+
+    def provisionHost(self, cluster, host, started):
+        '''
+        Create the storage disks of a host, define it with the disks, create
+        its overlay image and start it. Run by the provisioning workers, one
+        host each.
+
+        @param cluster: ClusterManager.Cluster object the host belongs to
+        @param host: ClusterManager.Host object
+        @param started: list of unames of hosts started so far, appended to
+        @raise ClusterManagerException: when any of the stages fails
+        '''
+        # disks are part of the domain definition, present at boot
+        self.createDisks(host)
+        self.defineHost(host)
+
+        if host.bootImage:
+            # machine defines custom boot image
+            LOGGER.info("Using custom image %s for machine %s." % \
+                        (host.bootImage, host.uname))
+            # get full path from storage pool
+            host.bootImage = self.findStorageVolume(self.storagePool,
+                                                    host.bootImage)
+        else:
+            # machine uses default boot image
+            LOGGER.info("Using default image %s for machine %s." % \
+                        (cluster.defaultHost.bootImage, host.uname))
+            host.bootImage = cluster.defaultHost.bootImage
+
+        if host.cacheBootImage or not os.path.exists(host.runningDiskImage):
+            self.updateState(Cluster.S_COPYING_IMAGES, cluster.name, host.uname)
+            self.createOverlay(host)
+
         try:
-            if cluster.hosts and len(cluster.hosts):
-                # number of machines that need additional thread to copy their 
-                # source images
-                needCopy = []
-                
-                waitingForCreate = []
-                
-                for h in cluster.hosts:
-                    self.defineHost(h)
-                    waitingForCreate.append(h.uname)
-                        
-                    if h.bootImage:
-                        # machine defines custom boot image
-                        LOGGER.info("Using custom image %s for machine %s." % \
-                                    (h.bootImage, h.uname))
-                        # get full path from storage pool
-                        h.bootImage = self.findStorageVolume(self.storagePool, h.bootImage)
-                    else:
-                        # machine uses default boot image
-                        LOGGER.info("Using default image %s for machine %s." % \
-                                    (cluster.defaultHost.bootImage, h.uname))
-                        # get full path from storage pool
-                        h.bootImage = cluster.defaultHost.bootImage   
-                    
-                    if h.cacheBootImage:
-                        # machine uses cached image
-                        LOGGER.info("Retrieving cached image for machine %s." % (h.uname))
-                        
-                        try: 
-                            self.findStorageVolume(self.storagePool, h.uname + '.img.cache')
-                        except:
-                            # make a copy from original image
-                            LOGGER.info("Cached image doesn't exist for machine %s. Copying from %s" % \
-                                        (h.uname, h.bootImage))
-                            needCopy.append( h )
-
-                #wait for all threads to copy images
-                n = 0
-                for h in needCopy:
-                    self.copyImg(h.uname)
-                    n += 1
-                    LOGGER.info("Machines images copied: %d of %d" % (n, len(needCopy)))
-
-
-                # remember locally domains created correctly to remove them
-                # in case one can't be created
-                hostsCreated = []
-
-                for host in cluster.hosts:
-                    self.createDisks(host)
+            # start machine - in libvirt aka create domain
+            LOGGER.info("Creating machine %s..." % host.uname)
+            self.hosts[host.uname][0].create()
+        except libvirtError, e:
+            raise ClusterManagerException("Error during creation of " + \
+                                          "machine %s: %s" % (host.uname, e))
+        started.append(host.uname)
+        self.updateState(Cluster.S_CREATING_SLAVES, cluster.name,
+                         "%s started, %d of %d" % \
+                         (host.uname, len(started), len(cluster.hosts)))
 
+    def rollbackHosts(self, cluster):
+        '''
+        Destroy and undefine the hosts of a cluster which failed to be
+        provisioned, whatever stage they reached. Errors are only logged.
+
+        @param cluster: ClusterManager.Cluster object
+        '''
+        for host in cluster.hosts:
+            self.hostsLock.acquire()
+            try:
+                if not self.hosts.has_key(host.uname):
+                    # definition failed
+                    continue
                 try:
-                    # start machines - in libvirt aka create domains
-                    for huname in waitingForCreate:
-                        LOGGER.info("Creating machine %s..." % huname)
-                        self.hosts[huname][0].create()
-                        hostsCreated.append(huname)
+                    if self.hosts[host.uname][0].isActive():
+                        self.hosts[host.uname][0].destroy()
                 except libvirtError, e:
-                    LOGGER.error("Error occured. Undefining created machines.")
-                    innerErrMsg = self.removeHosts(hostsCreated)
-                    self.removeCluster(cluster)
-                    raise ClusterManagerException("Error during " + \
-                          "creation of machine %s: %s. %s" % \
-                          (h.uname, e, innerErrMsg))
-                
-                self.updateState(Cluster.S_ATTACHING_DISKS, cluster.name)
+                    LOGGER.error("Could not destroy machine %s: %s" % \
+                                 (host.uname, e))
                 try:
-                    for host in cluster.hosts:
-                        self.attachDisks(host)
+                    self.removeHost(host.uname)
                 except ClusterManagerException, e:
-                    raise e
-            else:
-                LOGGER.warning("No hosts in cluster defined.")
-        except ClusterManagerException, e:
-            LOGGER.error(e)
-            self.removeNetwork(cluster.network.uname)
-            raise e
+                    LOGGER.error(e)
+            finally:
+                self.hostsLock.release()
 
     #---------------------------------------------------------------------------
     def shutdownCluster( self, clusterName ):
@@ -479,9 +669,291 @@ class ClusterManager:
       LOGGER.info("Shutting down cluster %s." % clusterName)
       cluster = self.clusters[clusterName]
       hostsToShutDown = [h.uname for h in cluster.hosts]
-      self.shutdownHosts(hostsToShutDown)
+      self.shutdownHosts(hostsToShutDown, clusterName)
       LOGGER.info("Cluster %s shut down." % clusterName)
 
+    def resetCluster(self, clusterName, snapName=None):
+        '''
+        Bring machines of a running cluster back to an earlier state. If all
+        of them have the snapshot given, or by default the first snapshot
+        taken, they are reverted to it, in parallel. Otherwise they are
+        brought back to the state of a newly created cluster, for its next
+        lease: machines are powered off, their overlays and disks are
+        created anew, then they are started again and the disks attached.
+        The network and machine definitions are kept.
+        @param clusterName:
+        @param snapName: name of the snapshot to revert to
+        @raise ClusterManagerException: when fails
+        '''
+        if not self.clusters.has_key(clusterName):
+            raise ClusterManagerException(("Cluster %s is not defined.") % \
+                                          clusterName, ERR_CONNECTION)
+
+        cluster = self.clusters[clusterName]
+        unames = [h.uname for h in cluster.hosts]
+        if not snapName and unames:
+            firsts = set([self.snapshotNames(u)[0] if self.snapshotNames(u) \
+                          else None for u in unames])
+            if len(firsts) == 1:
+                snapName = firsts.pop()
+
+        if snapName:
+            if not all([snapName in self.snapshotNames(u) for u in unames]):
+                raise ClusterManagerException(("Cluster %s has no snapshot" + \
+                                               " %s.") % (clusterName, snapName))
+            LOGGER.info("Reverting cluster %s to snapshot %s." % \
+                        (clusterName, snapName))
+            self.updateState(Cluster.S_RESETTING_CLUSTER, clusterName)
+            start = time.time()
+            errors = self.parallel(lambda u: self.revertHost(u, snapName),
+                                   unames)
+            if errors:
+                raise ClusterManagerException(("Could not revert cluster " + \
+                                               "%s: %s") % (clusterName, \
+                                               ', '.join(map(str, errors))))
+            LOGGER.info("Cluster %s reverted to snapshot %s in %.1fs." % \
+                        (clusterName, snapName, time.time() - start))
+            return
+
+        LOGGER.info("Resetting cluster %s." % clusterName)
+        self.updateState(Cluster.S_RESETTING_CLUSTER, clusterName)
+        try:
+            for host in cluster.hosts:
+                domain = self.hosts[host.uname][0]
+                if domain.isActive():
+                    domain.destroy()
+        except libvirtError, e:
+            raise ClusterManagerException("Could not power off machine " + \
+                                          "%s: %s" % (host.uname, e))
+
+        for host in cluster.hosts:
+            self.dropSnapshots(host)
+            if host.cacheBootImage:
+                self.createOverlay(host)
+            self.createDisks(host)
+
+        try:
+            for host in cluster.hosts:
+                self.hosts[host.uname][0].create()
+        except libvirtError, e:
+            raise ClusterManagerException("Could not start machine " + \
+                                          "%s: %s" % (host.uname, e))
+        LOGGER.info("Cluster %s reset." % clusterName)
+
+    def snapshotCluster(self, clusterName, snapName):
+        '''
+        Take an external snapshot of disks and memory of every machine of a
+        running cluster, in parallel. Machines which already have a snapshot
+        of the name are left alone.
+        @param clusterName:
+        @param snapName: name of the snapshot
+        @raise ClusterManagerException: when fails
+        '''
+        if not self.clusters.has_key(clusterName):
+            raise ClusterManagerException(("Cluster %s is not defined.") % \
+                                          clusterName, ERR_CONNECTION)
+
+        LOGGER.info("Taking snapshot %s of cluster %s." % \
+                    (snapName, clusterName))
+        self.updateState(Cluster.S_SNAPSHOTTING, clusterName)
+        start = time.time()
+        unames = [h.uname for h in self.clusters[clusterName].hosts \
+                  if not snapName in self.snapshotNames(h.uname)]
+        errors = self.parallel(lambda u: self.snapshotHost(u, snapName),
+                               unames)
+        if errors:
+            raise ClusterManagerException(("Could not take snapshot of " + \
+                                           "cluster %s: %s") % (clusterName, \
+                                           ', '.join(map(str, errors))))
+        LOGGER.info("Snapshot %s of cluster %s taken in %.1fs." % \
+                    (snapName, clusterName, time.time() - start))
+
+    def snapshotNames(self, hostUName):
+        '''
+        @param hostUName: host.uname host unique name
+        @return: names of snapshots of the host, in order of taking
+        '''
+        return [s[0] for s in self.snapshots.get(hostUName, [])]
+
+    def domainDisks(self, domain):
+        '''
+        Parse the XML description of a running domain.
+        @param domain: libvirt domain
+        @return: list of (target device, source file, format) of its disks
+        '''
+        from xml.dom.minidom import parseString
+        doc = parseString(domain.XMLDesc(0))
+        disks = []
+        for disk in doc.getElementsByTagName('disk'):
+            source = disk.getElementsByTagName('source')
+            target = disk.getElementsByTagName('target')
+            driver = disk.getElementsByTagName('driver')
+            if disk.getAttribute('device') != 'disk' or not source or \
+                not source[0].getAttribute('file') or not target:
+                continue
+            fmt = driver and driver[0].getAttribute('type') or 'raw'
+            disks.append((target[0].getAttribute('dev'),
+                          source[0].getAttribute('file'), fmt))
+        return disks
+
+    def snapshotHost(self, hostUName, snapName):
+        '''
+        Take an external snapshot of a running machine: its memory is saved
+        to a file and its disks continue on new qcow2 overlays, backed by
+        the disk images as they were. The domain is left running. No libvirt
+        snapshot metadata is kept, reverting is done by revertHost.
+        @param hostUName: host.uname host unique name
+        @param snapName: name of the snapshot
+        @raise ClusterManagerException: when fails
+        '''
+        domain = self.hosts[hostUName][0]
+        prefix = os.path.join(self.findStoragePool(self.storagePool), \
+                              '%s.%s' % (hostUName, snapName))
+        memFile = prefix + '.mem'
+        try:
+            overlays = [(dev, src, fmt, '%s.%s.qcow2' % (prefix, dev)) \
+                        for (dev, src, fmt) in self.domainDisks(domain)]
+        except libvirtError, e:
+            raise ClusterManagerException("Could not describe machine " + \
+                                          "%s: %s" % (hostUName, e))
+        self.removeSnapshotFiles((snapName, memFile, None, overlays))
+
+        xml = "<domainsnapshot><name>%s</name>" % snapName + \
+              "<memory snapshot='external' file='%s'/><disks>" % memFile
+        for (dev, src, fmt, overlay) in overlays:
+            xml += ("<disk name='%s' snapshot='external'>" + \
+                    "<driver type='qcow2'/><source file='%s'/></disk>") % \
+                    (dev, overlay)
+        xml += "</disks></domainsnapshot>"
+
+        try:
+            domain.snapshotCreateXML(xml, \
+                        libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_NO_METADATA | \
+                        libvirt.VIR_DOMAIN_SNAPSHOT_CREATE_ATOMIC)
+            liveXml = domain.XMLDesc(0)
+        except libvirtError, e:
+            raise ClusterManagerException("Could not take snapshot of " + \
+                                          "machine %s: %s" % (hostUName, e))
+        self.snapshots.setdefault(hostUName, []).append((snapName, memFile,
+                                                         liveXml, overlays))
+        LOGGER.info("Snapshot %s of machine %s taken." % (snapName, hostUName))
+
+    def revertHost(self, hostUName, snapName):
+        '''
+        Revert a machine to one of its snapshots: it is powered off, the
+        snapshots taken later are dropped, its overlays are created anew,
+        i.e. empty, and its memory is restored from the snapshot.
+        @param hostUName: host.uname host unique name
+        @param snapName: name of the snapshot
+        @raise ClusterManagerException: when fails
+        '''
+        snapshots = self.snapshots.get(hostUName, [])
+        i = self.snapshotNames(hostUName).index(snapName)
+        (name, memFile, liveXml, overlays) = snapshots[i]
+
+        try:
+            domain = self.hosts[hostUName][0]
+            if domain.isActive():
+                domain.destroy()
+        except libvirtError, e:
+            raise ClusterManagerException("Could not power off machine " + \
+                                          "%s: %s" % (hostUName, e))
+
+        for snapshot in snapshots[i + 1:]:
+            self.removeSnapshotFiles(snapshot)
+        del snapshots[i + 1:]
+
+        for (dev, backing, fmt, overlay) in overlays:
+            if os.path.exists(overlay):
+                os.remove(overlay)
+            output, retcode = Command(('qemu-img create -f qcow2 -o ' + \
+                                       'backing_fmt=%s -b %s %s') % \
+                                      (fmt, backing, overlay), '.').execute()
+            if retcode:
+                raise ClusterManagerException(("Could not create overlay " + \
+                                               "%s: %s") % (overlay, output))
+
+        try:
+            self.virtconnect().restoreFlags(memFile, liveXml, 0)
+        except libvirtError, e:
+            raise ClusterManagerException("Could not restore machine " + \
+                                          "%s: %s" % (hostUName, e))
+        LOGGER.info("Machine %s reverted to snapshot %s." % \
+                    (hostUName, snapName))
+
+    def dropSnapshots(self, host):
+        '''
+        Forget snapshots of a powered off machine and define it again, as
+        its definition refers to the overlays of the last snapshot.
+        @param host: ClusterManager.Host object
+        @raise ClusterManagerException: when fails
+        '''
+        snapshots = self.snapshots.pop(host.uname, [])
+        if not snapshots:
+            return
+
+        for snapshot in snapshots:
+            self.removeSnapshotFiles(snapshot)
+        try:
+            hostdef = self.virtconnect().defineXML(host.xmlDesc)
+        except libvirtError, e:
+            raise ClusterManagerException("Could not define machine " + \
+                                          "%s: %s" % (host.uname, e))
+        self.hosts[host.uname] = (hostdef,) + self.hosts[host.uname][1:]
+
+    def removeSnapshotFiles(self, snapshot):
+        '''
+        Remove memory and overlay files of a snapshot, errors are only
+        logged.
+        @param snapshot: tuple as kept in self.snapshots
+        '''
+        (name, memFile, liveXml, overlays) = snapshot
+        for path in [memFile] + [o[3] for o in overlays]:
+            try:
+                if os.path.exists(path):
+                    os.remove(path)
+            except OSError, e:
+                LOGGER.error("Could not remove snapshot file %s: %s" % \
+                             (path, e))
+
+    def parallel(self, function, args, workers=None, failFast=False):
+        '''
+        Call the function for every argument in separate threads and wait
+        for all of them to finish.
+        @param function: function of one argument
+        @param args: list of arguments
+        @param workers: maximum number of threads, one per argument if None
+        @param failFast: do not start calls for remaining arguments once
+                         one of the calls failed
+        @return: list of exceptions raised
+        '''
+        errors = []
+        pending = list(args)
+        lock = threading.Lock()
+        def work():
+            while True:
+                lock.acquire()
+                try:
+                    if not pending or (failFast and errors):
+                        return
+                    arg = pending.pop(0)
+                finally:
+                    lock.release()
+                try:
+                    function(arg)
+                except Exception, e:
+                    lock.acquire()
+                    errors.append(e)
+                    lock.release()
+
+        threads = [threading.Thread(target=work) for i in \
+                   range(min(workers or len(pending), len(pending)))]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return errors
+
     def removeCluster(self, clusterName):
         if not self.clusters.has_key(clusterName):
             LOGGER.error(("No cluster %s defined via cluster manager.") % clusterName)
@@ -495,6 +967,8 @@ class ClusterManager:
         hostsToRemove = [h.uname for h in cluster.hosts]
         removeErr += self.removeHosts(hostsToRemove)
 
+        if cluster.network:
+            self.removeTunnel(cluster.network)
         if cluster.network and self.nets.has_key(cluster.network.uname):
             try:
                 self.removeNetwork(cluster.network.uname)
@@ -508,66 +982,151 @@ class ClusterManager:
             del self.clusters[clusterName]
 
     def createDisks(self, host):
+        '''
+        Create the storage disks of a host, all of them at once.
+        @param host: ClusterManager.Host object
+        @raise ClusterManagerException: when any of the disks fails
+        '''
         if len(host.disks):
             LOGGER.info('Creating storage disks to machine %s' % host.uname)
-            
-            for disk in host.disks:
-                try:
-                    self.createDisk(host.uname, disk.name, disk.size, disk.cache)
-                    LOGGER.info('Created storage disk.')
-                except (ClusterManagerException, Exception), e:
-                    raise ClusterManagerException('Failure creating disks: %s' % e)
 
-    def createDisk(self, host, diskName, diskSize, cache):
+            errors = self.parallel(lambda d: self.createDisk(host.uname, d),
+                                   host.disks)
+            if errors:
+                raise ClusterManagerException('Failure creating disks: %s' % \
+                                              ', '.join(map(str, errors)))
+            LOGGER.info('Created storage disks.')
+
+    def createDisk(self, host, disk):
+        '''
+        Create a storage disk as a copy-on-write overlay of the template of
+        its size and filesystem. An existing disk is kept if it is cached.
+        @param host: name of the host the disk belongs to
+        @param disk: ClusterUtils.Disk object, its path and format are set
+        '''
         diskPath = os.path.join(self.findStoragePool(self.storagePool), \
-                                '%s_%s' % (host, diskName))
+                                '%s_%s' % (host, disk.name))
+        disk.path = diskPath
 
-        if not os.path.exists(diskPath) or not cache:
-            LOGGER.info('Creating storage disk %s_%s' % (host, diskName))
+        if os.path.exists(diskPath) and disk.cache:
+            # disk may still be a formatted raw image
+            disk.format = self.imageFormat(diskPath)
+            return
 
-            try:
-                with open(diskPath, 'w') as f:
-                    f.truncate(int(diskSize))
-                Command('mkfs.ext4 -F %s' % diskPath, '.').execute()
-            except Exception, e:
-                LOGGER.error(e)
-                raise ClusterManagerException('Disk creation error: %s' % e)
-            
-    def attachDisks(self, host):
-        
-        if len(host.disks):
-            LOGGER.info('Attaching storage disks to machine %s' % host.uname)
-            
-            for disk in host.disks:
-                try:
-                    self.attachDisk(host.uname, disk.name, disk.device)
-                    LOGGER.info('Attached storage disk.')
-                except (ClusterManagerException, Exception), e:
-                    raise ClusterManagerException('Failure attaching disks: %s' % e)
-        
-    def attachDisk(self, host, diskName, device):
-        ''' 
-        :param host: name of the host to attach to
+        LOGGER.info('Creating storage disk %s_%s' % (host, disk.name))
+        template = self.diskTemplate(disk)
+        output, retcode = Command('qemu-img create -f qcow2 -o ' + \
+                                  'backing_fmt=raw -b %s %s' % \
+                                  (template, diskPath), '.').execute()
+        if retcode:
+            raise ClusterManagerException('Disk creation error: %s' % output)
+        disk.format = 'qcow2'
+
+    def diskTemplate(self, disk):
         '''
-        diskPath = os.path.join(self.findStoragePool(self.storagePool), \
-                                '%s_%s' % (host, diskName))
-        
-        output = Command('virsh attach-disk %s %s %s' % 
-                (host, diskPath, device), '.').execute()
-        if output[1] != 0:
-            raise ClusterManagerException('Attaching disk failed: %s' % output)
+        Get the formatted image disks of the same size, filesystem and mkfs
+        options are overlays of. It is created on first use and kept in the
+        storage pool, as the overlays depend on it.
+        @param disk: ClusterUtils.Disk object
+        @raise ClusterManagerException: when formatting fails
+        @return: path of the template
+        '''
+        name = 'template_%d_%s' % (int(disk.size), disk.fsType)
+        if disk.mkfsOptions:
+            name += '_' + md5(disk.mkfsOptions).hexdigest()[:8]
+        path = os.path.join(self.findStoragePool(self.storagePool), \
+                            name + '.img')
 
-            
-    def updateState(self, state, clusterName):
-        ''' Send a progress update message to the master. '''
+        self.templateLocksLock.acquire()
+        lock = self.templateLocks.setdefault(path, threading.Lock())
+        self.templateLocksLock.release()
+
+        lock.acquire()
+        try:
+            if os.path.exists(path):
+                return path
+
+            LOGGER.info('Formatting disk template %s' % path)
+            tmpPath = path + '.part'
+            cmd = ['mkfs', '-t', disk.fsType]
+            if disk.fsType.startswith('ext'):
+                cmd.append('-F')
+            if disk.mkfsOptions:
+                cmd.append(disk.mkfsOptions)
+            cmd.append(tmpPath)
+            # mkfs reports errors on stderr
+            cmd.append('2>&1')
+            try:
+                with open(tmpPath, 'w') as f:
+                    f.truncate(int(disk.size))
+                output, retcode = Command(' '.join(cmd), '.').execute()
+                if retcode:
+                    raise ClusterManagerException('Disk template ' + \
+                                                  'creation error: %s' % \
+                                                  output.strip())
+                os.rename(tmpPath, path)
+            except (IOError, OSError), e:
+                raise ClusterManagerException('Disk template creation ' + \
+                                              'error: %s' % e)
+            finally:
+                # left only if the template was not created
+                if os.path.exists(tmpPath):
+                    os.remove(tmpPath)
+            return path
+        finally:
+            lock.release()
+
+    def updateState(self, state, clusterName, desc=''):
+        '''
+        Send a progress update message to the master.
+        @param desc: additional description of the state, e.g. the host
+        '''
         msg = XrdMessage(XrdMessage.M_CLUSTER_STATE)
-        msg.state = State(state)
+        msg.state = State(state, desc)
         msg.clusterName = clusterName
+        self.sendLock.acquire()
         try:
-            self.sockStream.send(msg)
-        except Exception, e:
-            LOGGER.error('Error updating state: %s' % e)
+            try:
+                self.sockStream.send(msg)
+            except Exception, e:
+                LOGGER.error('Error updating state: %s' % e)
+        finally:
+            self.sendLock.release()
     
+    def getCapacity(self):
+        '''
+        Get resources of this hypervisor: RAM, CPUs, free space and volumes
+        of the storage pool and clusters running.
+
+        @return: Capacity object, with the resources which could not be
+                 determined left empty
+        '''
+        capacity = Capacity()
+        # clusters are created and removed by other threads meanwhile
+        clusters = self.clusters.values()
+        capacity.clusters = [c.name for c in clusters]
+        for cluster in clusters:
+            capacity.committedRam += cluster.requiredRam()
+            capacity.committedVcpus += cluster.requiredVcpus()
+
+        con = self.virtconnect()
+        if not con:
+            return capacity
+        try:
+            info = con.getInfo()
+            capacity.totalRam = info[1] * 1024
+            capacity.vcpus = info[2]
+            capacity.freeRam = con.getFreeMemory() / 1024
+
+            # keeps the storage catalog fresh as a side effect
+            entry = self.storageCatalog.refresh(self.storagePool)
+            capacity.freeStorage = entry.pool.info()[3]
+            capacity.images = set(entry.volumes.keys())
+        except libvirtError, e:
+            self.storageCatalog.invalidate()
+            LOGGER.error('Cannot determine hypervisor capacity: %s' % e)
+        return capacity
+
     def getPoolPath(self, poolXML):
         '''Parse the given storage pool XML description and return its
         path. '''
@@ -576,61 +1135,29 @@ class ClusterManager:
         return doc.getElementsByTagName('target')[0].getElementsByTagName('path')[0].firstChild.nodeValue
     
     def findStoragePool(self, poolname):
-        '''Attempt to find a storage pool with the given name. '''
-        con = self.virtconnect()
-        pool = ''
-        
+        '''Attempt to find a storage pool with the given name and return its
+        path. Answered from the storage catalog. '''
         try:
-            pools = con.listStoragePools()
-            for p in pools:
-                if p == poolname:
-                    pool = con.storagePoolLookupByName(poolname)
-            
-            if not pool:
-                LOGGER.warning('Storage pool %s not found. Using default.' % poolname)
-                pool = con.storagePoolLookupByName('default')
-            
-            poolXML = pool.XMLDesc(0)
-            path = self.getPoolPath(poolXML)
-            return path
-
+            return self.storageCatalog.poolPath(poolname)
         except libvirtError, e:
+            self.storageCatalog.invalidate()
             raise ClusterManagerException(e)
-            
-    
+
     def findStorageVolume(self, poolname, volumename):
         '''Attempt to find a storage volume (file) in the specified libvirt storage
-        pool. If the volume is not found, the default pool will be searched. Return
-        the full path to the volume.'''
-        con = self.virtconnect()
-        pool = ''
-        volume = ''
-        
+        pool. If the pool is not found, the default pool will be searched. Return
+        the full path to the volume. The pool is refreshed only if the volume is
+        not in the storage catalog or the catalog is older than its TTL.'''
         try:
-            pools = con.listStoragePools()
-            for p in pools:
-                if p == poolname:
-                    pool = con.storagePoolLookupByName(poolname)
-            
-            if not pool:
-                LOGGER.warning('Storage pool %s not found. Using default.' % poolname)
-                pool = con.storagePoolLookupByName('default')
-        
-            # The pool might have changed, so refresh it
-            pool.refresh(0)
-            volumes = pool.listVolumes()
-            for v in volumes:
-                if v == volumename:
-                    volume = pool.storageVolLookupByName(v)
-                    volume = volume.path()
-                    
-            if not volume:
-                raise ClusterManagerException(('Volume %s not found in pool %s or in the default pool.' \
-                                               % (volumename, poolname)))
-            return volume
-            
+            volume = self.storageCatalog.volumePath(poolname, volumename)
         except libvirtError, e:
+            self.storageCatalog.invalidate()
             raise ClusterManagerException(e)
+
+        if not volume:
+            raise ClusterManagerException(('Volume %s not found in pool %s or in the default pool.' \
+                                           % (volumename, poolname)))
+        return volume
             
     
     
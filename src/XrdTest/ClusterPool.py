@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+#-------------------------------------------------------------------------------
+#
+# Copyright (c) 2011-2012 by European Organization for Nuclear Research (CERN)
+# Author: Justin Salmon <jsalmon@cern.ch>
+#
+# This file is part of XrdTest.
+#
+# XrdTest is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# XrdTest is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with XrdTest.  If not, see <http://www.gnu.org/licenses/>.
+#
+#-------------------------------------------------------------------------------
+#
+# File:    ClusterPool
+# Desc:    Warm clusters kept running between test suite runs, reset to a
+#          clean state and leased to the next job group which needs them,
+#          and clusters started ahead of scheduled test suite runs.
+#
+#-------------------------------------------------------------------------------
+from Utils import Logger
+LOGGER = Logger(__name__).setup()
+
+try:
+    import sys
+    import time
+except ImportError, e:
+    LOGGER.error(str(e))
+    sys.exit(1)
+
+
+class ClusterPool(object):
+    '''
+    Book-keeping of warm clusters. A cluster whose job group finished is
+    reset and parked in the pool instead of being stopped. It is leased to
+    the next job group starting it, or evicted, i.e. stopped, when it has
+    been idle too long, when more clusters are idle than allowed, when its
+    definition changed or when its resources are needed for another cluster.
+    A cluster started ahead of a scheduled run is reserved for the run: it is
+    kept idle until the run leases it or the reservation ends.
+    '''
+    # Seconds an idle cluster is kept, 0 disables the pool
+    IDLE_TIMEOUT = 900
+    # Maximum number of idle clusters
+    MAX_IDLE = 4
+    # Number of recent start durations remembered per cluster
+    HISTORY = 5
+
+    def __init__(self, idleTimeout=IDLE_TIMEOUT, maxIdle=MAX_IDLE):
+        '''
+        @param idleTimeout: seconds an idle cluster is kept
+        @param maxIdle: maximum number of idle clusters
+        '''
+        self.idleTimeout = idleTimeout
+        self.maxIdle = maxIdle
+        # Idle clusters. Key: cluster name, Value: time it was parked
+        self.idle = {}
+        # Names of clusters being stopped to reclaim their resources
+        self.evicting = set()
+        # Names of running clusters whose definition changed since start
+        self.stale = set()
+        # Number of leases of running clusters. Key: cluster name
+        self.leases = {}
+        # Time the start command of a cluster was sent, until all of its
+        # slaves are connected. Key: cluster name
+        self.starting = {}
+        # Recent durations of starts in seconds. Key: cluster name
+        self.durations = {}
+        # Time until which an idle cluster is reserved. Key: cluster name
+        self.reserved = {}
+
+    @property
+    def enabled(self):
+        return self.idleTimeout > 0 and self.maxIdle > 0
+
+    def isIdle(self, clusterName):
+        return self.idle.has_key(clusterName)
+
+    def canPark(self, clusterName):
+        '''
+        @return: True if the cluster may be kept warm after its lease
+        '''
+        return self.enabled and not clusterName in self.stale and \
+               not clusterName in self.evicting
+
+    def park(self, clusterName):
+        '''
+        Put a reset cluster into the pool.
+        '''
+        self.idle[clusterName] = time.time()
+        LOGGER.info("Cluster %s kept warm after %d lease(s)" % \
+                    (clusterName, self.leases.get(clusterName, 0) + 1))
+
+    def lease(self, clusterName):
+        '''
+        Take an idle cluster out of the pool.
+
+        @return: True if the cluster was idle
+        '''
+        if not self.idle.has_key(clusterName):
+            return False
+        idleFor = time.time() - self.idle.pop(clusterName)
+        self.leases[clusterName] = self.leases.get(clusterName, 0) + 1
+        self.reserved.pop(clusterName, None)
+        LOGGER.info("Warm cluster %s leased after %.0fs idle" % \
+                    (clusterName, idleFor))
+        return True
+
+    def evict(self, clusterName):
+        '''
+        Mark an idle cluster as being stopped.
+        '''
+        if self.idle.has_key(clusterName):
+            del self.idle[clusterName]
+        self.evicting.add(clusterName)
+
+    def invalidate(self, clusterName):
+        '''
+        Mark a running cluster as not to be kept warm, as its definition
+        changed.
+        '''
+        self.stale.add(clusterName)
+
+    def forget(self, clusterName):
+        '''
+        Drop all records of a stopped cluster.
+        '''
+        self.idle.pop(clusterName, None)
+        self.leases.pop(clusterName, None)
+        self.starting.pop(clusterName, None)
+        self.reserved.pop(clusterName, None)
+        self.evicting.discard(clusterName)
+        self.stale.discard(clusterName)
+
+    def startSent(self, clusterName):
+        '''
+        Record the time the start command of a cluster was sent.
+        '''
+        self.starting[clusterName] = time.time()
+
+    def startDone(self, clusterName):
+        '''
+        Record the duration of a start, once all slaves of the cluster are
+        connected.
+        '''
+        if not self.starting.has_key(clusterName):
+            return
+        took = time.time() - self.starting.pop(clusterName)
+        durations = self.durations.setdefault(clusterName, [])
+        durations.append(took)
+        del durations[:-self.HISTORY]
+        LOGGER.info("Cluster %s started in %.0fs" % (clusterName, took))
+
+    def startDuration(self, clusterName, default):
+        '''
+        @param default: duration assumed for a cluster never started
+        @return: longest of the recent start durations of the cluster
+        '''
+        if not self.durations.get(clusterName):
+            return default
+        return max(self.durations[clusterName])
+
+    def reserve(self, clusterName, until):
+        '''
+        Keep a cluster for a scheduled run, idle until the given time.
+        '''
+        self.reserved[clusterName] = until
+
+    def leastRecentlyUsed(self):
+        '''
+        @return: name of the cluster idle for the longest time, preferring
+                 clusters not reserved, or None
+        '''
+        if not self.idle:
+            return None
+        return min(self.idle.keys(), key=lambda n: (self.reserved.has_key(n),
+                                                    self.idle[n]))
+
+    def expired(self, now=None):
+        '''
+        @param now: current time
+        @return: names of clusters idle for longer than the idle timeout or
+                 whose reservation ended, and of the least recently used
+                 others exceeding the maximum number of idle clusters -
+                 reserved clusters only if the unreserved ones do not suffice
+        '''
+        now = now or time.time()
+        names = sorted(self.idle.keys(),
+                       key=lambda n: (self.reserved.has_key(n), self.idle[n]))
+        expired = [n for n in names if \
+                   (now > self.reserved[n] if self.reserved.has_key(n) else \
+                    now - self.idle[n] > self.idleTimeout)]
+        kept = [n for n in names if not n in expired]
+        return expired + kept[:max(0, len(kept) - self.maxIdle)]
@@ -35,8 +35,10 @@ try:
     import socket
     import random
     import hashlib
+    from copy import deepcopy
     from uuid import uuid1    
     from Utils import State
+    from DefinitionCache import definitionFiles
     from string import join
 except ImportError, e:
     LOGGER.error(str(e))
@@ -83,13 +85,121 @@ def getFileContent(filePath):
 
     return xmlDesc
 
+class Tunnel(object):
+    '''
+    Bridges the network of a part of a cluster split across hypervisors to
+    the networks of its other parts. Tunnel devices are added to the bridge
+    of the network. DHCP and ARP of the network's gateway address are not
+    let through tunnels, so every part keeps its own DHCP server and
+    gateway, while hosts of all parts share one layer 2 segment.
+
+    VXLAN tunnels connect all parts with each other, as VXLAN does not
+    forward between remote peers. GRE tunnels are point-to-point, so they
+    connect the first part with every other part, avoiding loops.
+
+    Tunnels add headers to every frame, and frames too large for the
+    network between hypervisors are dropped without notice. The MTU of the
+    tunnel devices, the bridge and the hosts is lowered by the size of the
+    headers.
+    '''
+    M_VXLAN = 'vxlan'
+    M_GRE = 'gre'
+    MODES = (M_VXLAN, M_GRE)
+
+    VXLAN_PORT = 4789
+
+    # bytes of headers added to every frame, IPv4 underlay
+    OVERHEAD = {M_VXLAN: 50, M_GRE: 38}
+    # MTU of the network between hypervisors
+    UNDERLAY_MTU = 1500
+
+    def __init__(self, mode, key, local, peers, index,
+                 underlayMtu=UNDERLAY_MTU):
+        '''
+        @param mode: M_VXLAN or M_GRE
+        @param key: VXLAN network identifier or GRE key, same for all parts
+        @param local: address of this part's hypervisor
+        @param peers: addresses of hypervisors of parts tunnelled to
+        @param index: number of this part
+        @param underlayMtu: MTU of the network between hypervisors
+        '''
+        self.mode = mode
+        self.key = key
+        self.local = local
+        self.peers = peers
+        self.index = index
+        self.mtu = underlayMtu - self.OVERHEAD[mode]
+
+    def devices(self):
+        '''
+        @return: list of (device name, remote address) tuples, remote address
+                 is None for a device reaching all peers
+        '''
+        prefix = '%s%06x' % (self.mode[:2], self.key)
+        if self.mode == Tunnel.M_VXLAN:
+            return [(prefix, None)]
+        return [('%s_%d' % (prefix, i), peer) for (i, peer) in \
+                enumerate(self.peers)]
+
+    def upCommands(self, bridge, gateway):
+        '''
+        Commands creating tunnel devices, adding them to a bridge and
+        filtering DHCP and ARP of the gateway on them.
+
+        @param bridge: name of the bridge of the network
+        @param gateway: IP address of the network on the bridge
+        @return: list of shell commands
+        '''
+        cmds = []
+        for (dev, remote) in self.devices():
+            if remote is None:
+                cmds.append(('ip link add %s mtu %d type vxlan id %d ' + \
+                             'dstport %d local %s') % (dev, self.mtu, self.key,
+                                                       self.VXLAN_PORT,
+                                                       self.local))
+                for peer in self.peers:
+                    cmds.append(('bridge fdb append 00:00:00:00:00:00 ' + \
+                                 'dev %s dst %s') % (dev, peer))
+            else:
+                cmds.append(('ip link add %s mtu %d type gretap ' + \
+                             'local %s remote %s key %d') % (dev, self.mtu,
+                                                             self.local,
+                                                             remote, self.key))
+            cmds.append('ip link set %s master %s' % (dev, bridge))
+            cmds.append('ip link set %s up' % dev)
+            cmds += ['ebtables -A %s' % r for r in self.filters(dev, gateway)]
+        return cmds
+
+    def downCommands(self, gateway):
+        '''
+        Commands removing what upCommands created.
+
+        @param gateway: IP address of the network on the bridge
+        @return: list of shell commands
+        '''
+        cmds = []
+        for (dev, remote) in self.devices():
+            cmds += ['ebtables -D %s' % r for r in self.filters(dev, gateway)]
+            cmds.append('ip link del %s' % dev)
+        return cmds
+
+    def filters(self, dev, gateway):
+        dhcp = '-p IPv4 --ip-proto udp --ip-dport 67:68 -j DROP'
+        return ['FORWARD -i %s %s' % (dev, dhcp),
+                'FORWARD -o %s %s' % (dev, dhcp),
+                'INPUT -i %s %s' % (dev, dhcp),
+                'OUTPUT -o %s -p IPv4 --ip-proto udp --ip-sport 67:68 -j DROP' \
+                % dev,
+                'INPUT -i %s -p ARP --arp-ip-dst %s -j DROP' % (dev, gateway),
+                'OUTPUT -o %s -p ARP --arp-ip-src %s -j DROP' % (dev, gateway)]
+
 class Network(object):
     '''
     Represents a virtual network
     '''
     # XML pattern representing XML configuration of libvirt network
     xmlDescPattern = """
-<network>
+<network xmlns:dnsmasq="http://libvirt.org/schemas/network/dnsmasq/1.0">
   <name>%(name)s</name>
   <dns>
       <txt name="xrd.test" value="Welcome to xrd testing framework domain." />
@@ -100,14 +210,22 @@ class Network(object):
   </dns>
   <forward mode="nat"/>
   <bridge name="%(bridgename)s" />
+  %(mtuxml)s
   <ip address="%(ip)s" netmask="%(netmask)s">
     <dhcp>
       <range start="%(rangestart)s" end="%(rangeend)s" />
     %(hostsxml)s
     </dhcp>
   </ip>
+  %(dnsmasqxml)s
 </network>
 """
+    # MTU of the bridge and the hosts' interfaces, also announced to the
+    # hosts by DHCP (option 26) for guests not taking it from virtio
+    xmlMtuPattern = """<mtu size="%(mtu)d"/>"""
+    xmlDnsmasqMtuPattern = """<dnsmasq:options>
+    <dnsmasq:option value="dhcp-option=option:mtu,%(mtu)d"/>
+  </dnsmasq:options>"""
     xmlHostPattern = """
       <host mac="%(mac)s" name="%(name)s" ip="%(ip)s" />
 """
@@ -129,6 +247,8 @@ class Network(object):
         self.DHCPHosts = []
         self.DnsHosts = []
         self.lbHosts = []
+        # Tunnel to networks of other parts of a split cluster
+        self.tunnel = None
 
         self.clusterName = clusterName
         self.xrdTestMasterIP = socket.gethostbyname(socket.gethostname())
@@ -193,8 +313,14 @@ class Network(object):
                   "rangeend": self.DHCPRange[1],
                   "hostsxml": hostsXML,
                   "dnshostsxml" : dnsHostsXML,
-                  "xrdTestMasterIP": self.xrdTestMasterIP
+                  "xrdTestMasterIP": self.xrdTestMasterIP,
+                  "mtuxml": "",
+                  "dnsmasqxml": ""
                   }
+        if self.tunnel:
+            mtu = {"mtu": self.tunnel.mtu}
+            values["mtuxml"] = Network.xmlMtuPattern % mtu
+            values["dnsmasqxml"] = Network.xmlDnsmasqMtuPattern % mtu
         self.__xmlDesc = Network.xmlDescPattern % values
         LOGGER.debug(self.__xmlDesc)
         return self.__xmlDesc
@@ -225,7 +351,7 @@ class Host(object):
   <devices>
     <emulator>%(emulatorPath)s</emulator>
     <disk type='file' device='disk'>
-      <driver name='qemu' type='raw'/>
+      <driver name='qemu' type='%(runningDiskFormat)s'/>
       <source file='%(runningDiskImage)s'/>
       <target dev='hda' bus='ide'/>
       <address type='drive' controller='0' bus='0' unit='0'/>
@@ -235,7 +361,7 @@ class Host(object):
       <target dev='hdc' bus='ide'/>
       <readonly/>
       <address type='drive' controller='0' bus='1' unit='0'/>
-    </disk>
+    </disk>%(disksxml)s
     <controller type='ide' index='0'>
       <address type='pci' domain='0x0000' bus='0x00' slot='0x01'
       function='0x1'/>
@@ -262,6 +388,13 @@ class Host(object):
 </domain>
 
 """
+    # XML pattern of a storage disk of the domain
+    xmlDiskPattern = """
+    <disk type='file' device='disk'>
+      <driver name='qemu' type='%(format)s'/>
+      <source file='%(path)s'/>
+      <target dev='%(device)s' bus='virtio'/>
+    </disk>"""
 
     def __init__(self, name="", ip="", net="", ramSize="", arch="", \
                  bootImage=None, cacheBootImage=True, emulatorPath="", uuid="",
@@ -285,6 +418,7 @@ class Host(object):
         self.clusterName = ""
         self.disks = {}
         self.runningDiskImage = ""
+        self.runningDiskFormat = "raw"
 
         # private properties
         self.__xmlDesc = ""
@@ -302,9 +436,14 @@ class Host(object):
 
     @property
     def xmlDesc(self):
-        values = self.__dict__
+        values = dict(self.__dict__)
         values['uname'] = self.uname
         values['net'] = self.clusterName + "_" + self.net
+        # storage disks which were created on the hypervisor
+        values['disksxml'] = ''.join([self.xmlDiskPattern % \
+                             {'format': d.format, 'path': d.path,
+                              'device': d.device} \
+                             for d in self.disks if d.path])
         self.__xmlDesc = self.xmlDomainPattern % values
 
         return self.__xmlDesc
@@ -319,14 +458,21 @@ class Host(object):
 
 
 class Disk(object):
-    
-    def __init__(self, name, size, device='vda', mountPoint='/data', cache=True):
+    def __init__(self, name, size, device='vda', mountPoint='/data', cache=True,
+                 fsType='ext4', mkfsOptions=''):
         self.name = name
         self.size = self.parseDiskSize(size)
         self.readableSize = size
         self.device = device
         self.mountPoint = mountPoint
         self.cache = cache
+        # filesystem the disk is formatted with and options passed to mkfs
+        self.fsType = fsType
+        self.mkfsOptions = mkfsOptions
+
+        #filled automatically
+        self.format = 'raw'
+        self.path = ''
         
     def parseDiskSize(self, size):
         '''
@@ -342,6 +488,33 @@ class Disk(object):
         else:
             raise ClusterManagerException('Invalid disk size definition for disk %s' % self.name)
 
+class Capacity(object):
+    '''
+    Resources of a hypervisor, reported by it to the master for placement
+    of clusters.
+    '''
+    def __init__(self):
+        # RAM of the hypervisor and RAM not in use, in KiB
+        self.totalRam = 0
+        self.freeRam = 0
+        # number of logical CPUs
+        self.vcpus = 0
+        # free space of the storage pool in bytes
+        self.freeStorage = 0
+        # names of volumes in the storage pool, i.e. cached images
+        self.images = set()
+        # names of clusters running on the hypervisor
+        self.clusters = []
+        # RAM in KiB and vCPUs of domains of running clusters
+        self.committedRam = 0
+        self.committedVcpus = 0
+
+    def __str__(self):
+        return ('%d/%d MiB RAM free, %d/%d vCPUs committed, %d GiB storage ' + \
+                'free, %d clusters') % (self.freeRam / 1024,
+                self.totalRam / 1024, self.committedVcpus, self.vcpus,
+                self.freeStorage / 1024 ** 3, len(self.clusters))
+
 class Cluster(Utils.Stateful):
 
     S_ERROR = (-4, "Cluster error")
@@ -354,13 +527,16 @@ class Cluster(Utils.Stateful):
     S_STARTING_CLUSTER = (2, 'Starting cluster.')
     S_CREATING_NETWORK = (3, 'Creating network.')
     S_CREATING_SLAVES = (4, 'Creating slaves.')
-    S_COPYING_IMAGES = (5, 'Copying slave images.')
+    S_COPYING_IMAGES = (5, 'Creating slave overlay images.')
     S_ATTACHING_DISKS = (6, 'Attaching slave disks.')
     S_WAITING_SLAVES = (7, 'Waiting for slaves to connect.')
     S_ACTIVE = (8, "Cluster active.")
     S_STOPCOMMAND_SENT = (9, "Cluster stop command sent to hypervisor.")
     S_DESTROYING_CLUSTER = (10, 'Destroying cluster')
     S_STOPPED = (11, "Cluster stopped.")
+    S_RESETTING_CLUSTER = (12, 'Resetting cluster.')
+    S_IDLE = (13, 'Cluster idle, kept warm for the next lease.')
+    S_SNAPSHOTTING = (14, 'Taking snapshot of cluster.')
     '''
     Represents a cluster comprised of hosts connected through network.
     '''
@@ -370,6 +546,13 @@ class Cluster(Utils.Stateful):
         self.hosts = []
         self.name = name
         self.info = None
+        # Allow splitting the cluster across hypervisors if no single one
+        # has enough resources for it, tunnelling its network with
+        # tunnelMode (Tunnel.M_VXLAN or Tunnel.M_GRE) over a network of
+        # underlayMtu between the hypervisors
+        self.split = False
+        self.tunnelMode = Tunnel.M_VXLAN
+        self.underlayMtu = Tunnel.UNDERLAY_MTU
         self.defaultHost = Host()
         self.defaultHost.net = self.name + '_net'
         self.__network = Network( self.defaultHost.net, name )
@@ -409,6 +592,69 @@ class Cluster(Utils.Stateful):
         return self.__network
     network = property(networkGet, networkSet)
 
+    def requiredRam(self):
+        '''
+        @return: RAM of all hosts in KiB
+        '''
+        ram = 0
+        for h in self.hosts:
+            try:
+                ram += int(h.ramSize)
+            except (TypeError, ValueError):
+                pass
+        return ram
+
+    def requiredVcpus(self):
+        '''
+        @return: number of vCPUs of all hosts, one per host domain
+        '''
+        return len(self.hosts)
+
+    def requiredStorage(self):
+        '''
+        @return: size of disks of all hosts in bytes
+        '''
+        return sum([int(d.size) for h in self.hosts for d in h.disks \
+                    if isinstance(d, Disk)])
+
+    def bootImages(self):
+        '''
+        @return: set of names of boot images of all hosts
+        '''
+        images = set([h.bootImage or self.defaultHost.bootImage \
+                      for h in self.hosts])
+        images.discard(None)
+        return images
+
+    def partitions(self, parts):
+        '''
+        Split the cluster into parts, each with its hosts and a network
+        tunnelled to the networks of the other parts. All parts keep DNS
+        entries of all hosts, DHCP entries only of their own hosts.
+
+        @param parts: list of (hypervisor address, host names) tuples
+        @return: list of Cluster objects, one per part
+        '''
+        key = int(hashlib.md5(self.name).hexdigest()[:6], 16)
+        addresses = [a for (a, names) in parts]
+
+        clusters = []
+        for (i, (address, names)) in enumerate(parts):
+            if self.tunnelMode == Tunnel.M_GRE:
+                peers = addresses[1:] if i == 0 else addresses[:1]
+            else:
+                peers = addresses[:i] + addresses[i + 1:]
+
+            part = deepcopy(self)
+            part.hosts = [h for h in part.hosts if h.name in names]
+            macs = set([h.mac for h in part.hosts])
+            part.network.DHCPHosts = [d for d in part.network.DHCPHosts \
+                                      if d[0] in macs]
+            part.network.tunnel = Tunnel(self.tunnelMode, key, address,
+                                         peers, i, self.underlayMtu)
+            clusters.append(part)
+        return clusters
+
     def setEmulatorPath(self, emulator_path):
         if len(self.hosts):
             for h in self.hosts:
@@ -447,6 +693,11 @@ class Cluster(Utils.Stateful):
                                            ' first address') \
                                           % (self.network.name, \
                                              self.definitionFile))
+        if self.split and not self.tunnelMode in Tunnel.MODES:
+            raise ClusterManagerException(('Unknown tunnel mode %s of ' + \
+                                           'cluster %s, expected one of %s') \
+                                          % (self.tunnelMode, self.name, \
+                                             ', '.join(Tunnel.MODES)))
 
     def validateAgainstSystem(self, clusters):
         '''
@@ -491,18 +742,31 @@ def extractClusterName(path):
     (modName, ext) = os.path.splitext(modFile)
     return (modName, ext, modPath, modFile)
 
-def loadClusterDef(fp, clusters = [], validateWithRest=True):
+def loadClusterDef(fp, clusters = [], validateWithRest=True, cache=None):
     (modName, ext, modPath, modFile) = extractClusterName(fp)
 
     cl = None
     if os.path.isfile(fp) and ext == '.py':
+        # The definition may import helpers from its directory
+        files = definitionFiles(modPath)
+        if cache:
+            cl = cache.get(fp, files)
+            if cl:
+                if validateWithRest:
+                    cl.validateAgainstSystem(clusters)
+                return cl
+
         mod = None
         try:
             if not modPath in sys.path:
                 sys.path.insert(0, modPath)
     
-            if sys.modules.has_key(modName):
-                del sys.modules[modName]
+            # helpers from the directory of the definition are imported
+            # anew as well, they may have changed
+            for (name, m) in sys.modules.items():
+                f = getattr(m, '__file__', None)
+                if f and os.path.dirname(os.path.abspath(f)) == modPath:
+                    del sys.modules[name]
             mod = __import__(modName, globals(), {}, ['getCluster'])
     
             cl = mod.getCluster()
@@ -514,6 +778,8 @@ def loadClusterDef(fp, clusters = [], validateWithRest=True):
             #after load, check if cluster definition is correct
             cl.state = State(Cluster.S_UNKNOWN)
             cl.validateStatic()
+            if cache:
+                cache.put(fp, files, cl)
             if validateWithRest:
                 cl.validateAgainstSystem(clusters)
         except ImportError, e:
@@ -530,26 +796,47 @@ def loadClusterDef(fp, clusters = [], validateWithRest=True):
                                        (modFile))
     return cl
 
-def loadClustersDefs(path):
+def loadClustersDefs(path, cache=None):
     '''
     Loads cluster definitions from .py files stored in path directory
     @param path: path for .py files, storing cluster definitions
+    @param cache: DefinitionCache to get unchanged definitions from
     '''
     clusters = []
     if os.path.exists(path):
         for f in os.listdir(path):
-            if not f.startswith('cluster') or not f.endswith('.py'):
+            if not isClusterDefFile(f):
                 continue
-            cp = path + os.sep + f
-            try:
-                clu = loadClusterDef(cp, clusters)
-                if clu:
-                    clu.state = State(Cluster.S_DEFINED)
-                    clusters.append(clu)
-            except ClusterManagerException, e:
-                LOGGER.error("Error in cluster definition %s: %s" % (f, str(e)))
-                clu = Cluster(f+"_BROKEN")
-                clu.state = State((-1, e.desc))
+            clu = loadClusterFile(path + os.sep + f, clusters, cache)
+            if clu:
                 clusters.append(clu)
 
     return clusters
+
+def isClusterDefFile(fileName):
+    '''
+    Check if the file name is one of a cluster definition file.
+    @param fileName:
+    '''
+    return fileName.startswith('cluster') and fileName.endswith('.py')
+
+def loadClusterFile(cp, clusters, cache=None):
+    '''
+    Loads a single cluster definition file. If the definition is invalid,
+    a cluster in error state is returned.
+
+    @param cp: path of the cluster definition file
+    @param clusters: other clusters, to validate the definition against
+    @param cache: DefinitionCache to get unchanged definition from
+    @return: Cluster object or None
+    '''
+    f = os.path.basename(cp)
+    try:
+        clu = loadClusterDef(cp, clusters, cache=cache)
+        if clu:
+            clu.state = State(Cluster.S_DEFINED)
+    except ClusterManagerException, e:
+        LOGGER.error("Error in cluster definition %s: %s" % (f, str(e)))
+        clu = Cluster(f+"_BROKEN")
+        clu.state = State((-1, e.desc))
+    return clu
@@ -0,0 +1,199 @@
+#!/usr/bin/env python
+#-------------------------------------------------------------------------------
+#
+# Copyright (c) 2011-2012 by European Organization for Nuclear Research (CERN)
+# Author: Justin Salmon <jsalmon@cern.ch>
+#
+# This file is part of XrdTest.
+#
+# XrdTest is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# XrdTest is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with XrdTest.  If not, see <http://www.gnu.org/licenses/>.
+#
+#-------------------------------------------------------------------------------
+#
+# File:    DefinitionCache
+# Desc:    Persistent cache of loaded cluster and test suite definitions, so
+#          that unchanged definitions are not imported and their scripts are
+#          not read again.
+#
+#-------------------------------------------------------------------------------
+from Utils import Logger
+LOGGER = Logger(__name__).setup()
+
+try:
+    import sys
+    import os
+    import shelve
+    import hashlib
+except ImportError, e:
+    LOGGER.error(str(e))
+    sys.exit(1)
+
+
+class DefinitionCache(object):
+    '''
+    Cache of definition objects (Cluster, TestSuite) keyed by path of the
+    definition file. An entry is valid as long as the files the definition was
+    built from are unchanged: their modification times and sizes are compared
+    first and only if these differ, the hash of their content is compared.
+    Entries are stored in a python shelve, so they survive master restarts and
+    every retrieved object is a fresh copy. Every entry carries the version of
+    the code which built it, as objects built by other code may lack
+    attributes or have them in another form, and is dropped when the version
+    differs.
+    '''
+    # version of the format of entries, to be increased when it changes
+    FORMAT = 1
+    # modules defining the classes of cached objects
+    MODULES = ('ClusterUtils.py', 'TestUtils.py', 'Utils.py')
+
+    def __init__(self, path):
+        '''
+        @param path: path of the shelve file
+        '''
+        self.path = path
+        self.version = self.codeVersion()
+        # keys retrieved or stored since the cache was opened
+        self.used = set()
+        self.store = None
+        try:
+            self.store = shelve.open(path)
+        except Exception, e:
+            LOGGER.error('Cannot open definition cache %s: %s' % (path, e))
+
+    def codeVersion(self):
+        '''
+        Get version of the code building cached objects: the entry format and
+        the hash of the modules defining their classes.
+
+        @return: tuple (format, hex digest)
+        '''
+        base = os.path.dirname(os.path.abspath(__file__))
+        modules = [os.path.join(base, m) for m in self.MODULES]
+        return (self.FORMAT, self.digest([m for m in modules \
+                                          if os.path.exists(m)]))
+
+    def stamp(self, files):
+        '''
+        Get modification times and sizes of files.
+
+        @param files: list of file paths
+        @return: tuple of (path, mtime, size) tuples
+        '''
+        stamp = []
+        for f in files:
+            st = os.stat(f)
+            stamp.append((f, st.st_mtime, st.st_size))
+        return tuple(stamp)
+
+    def digest(self, files):
+        '''
+        Get hash of names and content of files.
+
+        @param files: list of file paths
+        @return: hex digest
+        '''
+        h = hashlib.sha1()
+        for f in files:
+            h.update(f)
+            with open(f, 'rb') as fd:
+                h.update(fd.read())
+        return h.hexdigest()
+
+    def get(self, key, files):
+        '''
+        Get the cached definition object if the files it was built from have
+        not changed.
+
+        @param key: path of the definition file
+        @param files: files the definition depends on
+        @return: definition object or None
+        '''
+        if self.store is None:
+            return None
+        try:
+            if not self.store.has_key(key):
+                return None
+            entry = self.store[key]
+            if len(entry) != 4 or entry[0] != self.version:
+                LOGGER.debug('Definition %s cached by other code' % key)
+                del self.store[key]
+                return None
+            (version, stamp, digest, obj) = entry
+
+            curStamp = self.stamp(files)
+            if curStamp != stamp:
+                if self.digest(files) != digest:
+                    return None
+                # touched, but not changed
+                self.store[key] = (version, curStamp, digest, obj)
+        except Exception, e:
+            LOGGER.warning('Invalid definition cache entry %s: %s' % (key, e))
+            return None
+
+        self.used.add(key)
+        LOGGER.debug('Definition %s unchanged, using cached one' % key)
+        return obj
+
+    def put(self, key, files, obj):
+        '''
+        Store a definition object built from given files.
+
+        @param key: path of the definition file
+        @param files: files the definition depends on
+        @param obj: definition object
+        '''
+        if self.store is None:
+            return
+        try:
+            self.store[key] = (self.version, self.stamp(files),
+                               self.digest(files), obj)
+            self.used.add(key)
+        except Exception, e:
+            LOGGER.warning('Cannot cache definition %s: %s' % (key, e))
+
+    def prune(self):
+        '''
+        Remove entries of definitions neither retrieved nor stored since the
+        cache was opened, i.e. of definitions which no longer exist.
+        '''
+        if self.store is None:
+            return
+        for key in self.store.keys():
+            if not key in self.used:
+                del self.store[key]
+        self.sync()
+
+    def sync(self):
+        if self.store is not None:
+            self.store.sync()
+
+    def close(self):
+        if self.store is not None:
+            self.store.close()
+            self.store = None
+
+def definitionFiles(path):
+    '''
+    Get all files of a definition directory, recursively, omitting compiled
+    python files.
+
+    @param path: directory
+    @return: sorted list of file paths
+    '''
+    files = []
+    for root, dirs, names in os.walk(path):
+        for name in names:
+            if not name.endswith('.pyc'):
+                files.append(os.path.join(root, name))
+    return sorted(files)
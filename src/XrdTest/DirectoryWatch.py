@@ -34,6 +34,8 @@ try:
     import sys
     import types
     import os
+    import threading
+    import time
     
     from pyinotify import WatchManager, ThreadedNotifier, ProcessEvent, WatchManagerError, EventsCodes
     from apscheduler.scheduler import Scheduler
@@ -55,6 +57,8 @@ class DirectoryWatch(object):
     IN_DELETE = 0x00000200L                 # was delete
     IN_MODIFY = 0x00000002L                 # was modified
     mask = IN_DELETE | IN_CREATE | IN_MOVED | IN_MODIFY 
+    # default time in seconds to wait for more changes before reloading
+    RELOAD_DELAY = 2.0
     
     def __init__(self, repo, config, callback, watch_type=None):
         '''
@@ -91,12 +95,18 @@ class DirectoryWatch(object):
         wm = WatchManager()
         wm2 = WatchManager()
         
+        delay = self.RELOAD_DELAY
+        if self.config.has_option('general', 'definition_reload_delay'):
+            delay = self.config.getfloat('general', 'definition_reload_delay')
+
         clusterNotifier = ThreadedNotifier(wm, \
                             ClustersDefinitionsChangeHandler(\
-                            masterCallback=self.callback))
+                            masterCallback=ChangeBatch("CLUSTER", \
+                                                       self.callback, delay)))
         suiteNotifier = ThreadedNotifier(wm2, \
                             SuiteDefinitionsChangeHandler(\
-                            masterCallback=self.callback))
+                            masterCallback=ChangeBatch("SUITE", \
+                                                       self.callback, delay)))
         clusterNotifier.start()
         suiteNotifier.start()
         
@@ -123,6 +133,63 @@ class DirectoryWatch(object):
             LOGGER.error(e)
 
 
+class ChangeBatch(object):
+    '''
+    Coalesces bursts of directory change events, e.g. from an editor save or
+    a git pull, into a single callback invocation with all the changed paths.
+    The callback is run once no more events came within the delay, but not
+    later than a few delays after the first event of the burst.
+    '''
+    def __init__(self, defType, callback, delay):
+        '''
+        @param defType: type of definitions watched: CLUSTER or SUITE
+        @param callback: function called with defType and list of paths
+        @param delay: time in seconds to wait for more events
+        '''
+        self.defType = defType
+        self.callback = callback
+        self.delay = delay
+        self.maxDelay = delay * 5
+        self.lock = threading.Lock()
+        self.paths = set()
+        self.first = None
+        self.timer = None
+
+    def __call__(self, event):
+        '''
+        Add changed path of the event to the batch and restart the timer.
+        @param event:
+        '''
+        self.lock.acquire()
+        try:
+            now = time.time()
+            self.paths.add(os.path.join(event.path, event.name))
+            if self.timer:
+                self.timer.cancel()
+            else:
+                self.first = now
+            wait = min(self.delay, self.first + self.maxDelay - now)
+            self.timer = threading.Timer(max(wait, 0), self.flush)
+            self.timer.daemon = True
+            self.timer.start()
+        finally:
+            self.lock.release()
+
+    def flush(self):
+        '''
+        Pass all the paths collected so far to the callback.
+        '''
+        self.lock.acquire()
+        try:
+            paths = sorted(self.paths)
+            self.paths = set()
+            self.timer = None
+        finally:
+            self.lock.release()
+
+        if paths:
+            self.callback(self.defType, paths)
+
 class ClustersDefinitionsChangeHandler(ProcessEvent):
     '''
     If cluster definition file changes - it runs.
@@ -141,7 +208,7 @@ class ClustersDefinitionsChangeHandler(ProcessEvent):
         Actual method that handle incoming dir change event.
         @param event:
         '''
-        self.callback("CLUSTER", event)
+        self.callback(event)
 
 class SuiteDefinitionsChangeHandler(ProcessEvent):
     '''
@@ -161,5 +228,5 @@ class SuiteDefinitionsChangeHandler(ProcessEvent):
         Actual method that handle incoming dir change event.
         @param event:
         '''
-        self.callback("SUITE", event)
+        self.callback(event)
         
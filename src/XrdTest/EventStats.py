@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+#-------------------------------------------------------------------------------
+#
+# Copyright (c) 2011-2012 by European Organization for Nuclear Research (CERN)
+# Author: Justin Salmon <jsalmon@cern.ch>
+#
+# This file is part of XrdTest.
+#
+# XrdTest is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# XrdTest is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with XrdTest.  If not, see <http://www.gnu.org/licenses/>.
+#
+#-------------------------------------------------------------------------------
+#
+# File:    EventStats
+# Desc:    Instrumentation of the master's main event loop: time events wait
+#          in the main events queue, handler latencies per event type and
+#          message name, queue depth, slow handler and backlog alarms.
+#
+#-------------------------------------------------------------------------------
+from Utils import Logger
+LOGGER = Logger(__name__).setup()
+
+try:
+    import sys
+    import time
+
+    from threading import Lock
+    from XrdTest.TCPServer import MasterEvent
+except ImportError, e:
+    LOGGER.error(str(e))
+    sys.exit(1)
+
+
+class LatencyHistogram(object):
+    '''
+    Counts of durations in buckets of exponentially growing upper bounds.
+    '''
+    # Upper bounds of buckets in seconds, the last bucket is unbounded
+    BOUNDS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 60)
+
+    def __init__(self):
+        self.buckets = [0] * (len(self.BOUNDS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, seconds):
+        '''
+        @param seconds: duration to be counted
+        '''
+        i = 0
+        while i < len(self.BOUNDS) and seconds > self.BOUNDS[i]:
+            i += 1
+        self.buckets[i] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def toDict(self):
+        '''
+        @return: counts and durations, buckets keyed by their upper bound
+        '''
+        buckets = [('le_%g' % b, n) for (b, n) in \
+                   zip(self.BOUNDS, self.buckets)]
+        buckets.append(('inf', self.buckets[-1]))
+        return {'count': self.count,
+                'total': self.total,
+                'mean': self.mean,
+                'max': self.max,
+                'buckets': buckets}
+
+class EventLoopStats(object):
+    '''
+    Statistics of the master's main event loop. Updated by the main loop
+    thread and read by the web interface threads.
+    '''
+    # Handlers running longer than this many seconds are logged
+    SLOW_HANDLER = 1.0
+    # Queue depth at which a backlog alarm is raised
+    BACKLOG_ALARM = 500
+
+    def __init__(self, slowHandler=SLOW_HANDLER, backlogAlarm=BACKLOG_ALARM):
+        '''
+        @param slowHandler: threshold of slow handler logging in seconds
+        @param backlogAlarm: queue depth at which a backlog alarm is raised
+        '''
+        self.slowHandler = slowHandler
+        self.backlogAlarm = backlogAlarm
+        self.lock = Lock()
+        self.started = time.time()
+        # Time events spent in the queue
+        self.wait = LatencyHistogram()
+        # Handler latencies, key: event type name
+        self.byType = {}
+        # Handler latencies, key: message name
+        self.byMessage = {}
+        # Latencies of other steps of the loop, e.g. starting jobs
+        self.bySection = {}
+        self.slowHandlers = 0
+        self.maxDepth = 0
+        # Time the current backlog alarm was raised, None if there is none
+        self.backlogSince = None
+
+    def eventName(self, evt):
+        return MasterEvent.NAMES.get(evt.type, str(evt.type))
+
+    def messageName(self, evt):
+        if evt.type in (MasterEvent.M_UNKNOWN, MasterEvent.M_HYPERV_MSG,
+                        MasterEvent.M_SLAVE_MSG) and hasattr(evt.data, 'name'):
+            return evt.data.name
+        return None
+
+    def eventDequeued(self, evt, depth):
+        '''
+        Record the time an event waited in the queue and the depth of the
+        queue, raising or clearing the backlog alarm.
+
+        @param evt: MasterEvent object
+        @param depth: number of events left in the queue
+        '''
+        now = time.time()
+        self.lock.acquire()
+        try:
+            self.wait.add(max(0.0, now - evt.created))
+            self.maxDepth = max(self.maxDepth, depth)
+            if depth >= self.backlogAlarm and self.backlogSince is None:
+                self.backlogSince = now
+                LOGGER.warning('Main events queue backlog: %d events ' % \
+                               depth + 'waiting, last one waited %.3fs' % \
+                               (now - evt.created))
+            elif depth < self.backlogAlarm / 2 and \
+                self.backlogSince is not None:
+                LOGGER.info('Main events queue backlog cleared after %.1fs' % \
+                            (now - self.backlogSince))
+                self.backlogSince = None
+        finally:
+            self.lock.release()
+
+    def eventHandled(self, evt, seconds):
+        '''
+        Record the latency of a handled event and log it if it is slow.
+
+        @param evt: MasterEvent object
+        @param seconds: time the handler took
+        '''
+        evtName = self.eventName(evt)
+        msgName = self.messageName(evt)
+        self.lock.acquire()
+        try:
+            self.byType.setdefault(evtName, LatencyHistogram()).add(seconds)
+            if msgName:
+                self.byMessage.setdefault(msgName, \
+                                          LatencyHistogram()).add(seconds)
+            if seconds >= self.slowHandler:
+                self.slowHandlers += 1
+        finally:
+            self.lock.release()
+
+        if seconds >= self.slowHandler:
+            LOGGER.warning('Slow handler of %s%s event: %.3fs' % \
+                           (evtName, ' ' + msgName if msgName else '', seconds))
+
+    def sectionDone(self, name, seconds):
+        '''
+        Record the latency of another step of the loop.
+
+        @param name: name of the step
+        @param seconds: time the step took
+        '''
+        self.lock.acquire()
+        try:
+            self.bySection.setdefault(name, LatencyHistogram()).add(seconds)
+        finally:
+            self.lock.release()
+        if seconds >= self.slowHandler:
+            LOGGER.warning('Slow %s in main loop: %.3fs' % (name, seconds))
+
+    def toDict(self, depths=None):
+        '''
+        @param depths: current queue depths, key: priority
+        @return: all statistics as a dictionary of plain types
+        '''
+        self.lock.acquire()
+        try:
+            hist = lambda d: dict([(k, v.toDict()) for (k, v) in d.iteritems()])
+            depths = depths or {}
+            return {'uptime': time.time() - self.started,
+                    'queue': {'depth': sum(depths.itervalues()),
+                              'by_priority': dict([(str(p), n) for (p, n) \
+                                                   in depths.iteritems()]),
+                              'max_depth': self.maxDepth,
+                              'backlog_alarm': self.backlogSince is not None,
+                              'backlog_since': self.backlogSince},
+                    'wait': self.wait.toDict(),
+                    'handlers': {'by_event': hist(self.byType),
+                                 'by_message': hist(self.byMessage),
+                                 'by_section': hist(self.bySection)},
+                    'slow_handlers': self.slowHandlers,
+                    'slow_handler_threshold': self.slowHandler}
+        finally:
+            self.lock.release()
@@ -32,6 +32,7 @@ LOGGER = Logger(__name__).setup()
 try:
     import sys
     import os
+    import time
     from Utils import Command
     from ConfigParser import NoOptionError
 except ImportError, e:
@@ -39,7 +40,7 @@ except ImportError, e:
     sys.exit(1)
     
 
-def sync_remote_git(repo, config):
+def sync_remote_git(repo, config, timeout=None):
     '''
     Fetch the status of a remote git repository for new commits. If
     new commits, pull the new changes.
@@ -49,7 +50,14 @@ def sync_remote_git(repo, config):
     
     @param repo: 
     @param config: configuration file containing repository information
+    @param timeout: time in seconds for the whole synchronization, git
+                    commands still running afterwards are killed
     '''
+    deadline = None
+    if timeout is not None:
+        deadline = time.time() + timeout
+    remaining = lambda: deadline - time.time() if deadline else None
+
     try:
         remote_repo = config.get(repo, 'remote_repo')
         local_repo = config.get(repo, 'local_path')
@@ -57,51 +65,76 @@ def sync_remote_git(repo, config):
         remote_branch = config.get(repo, 'remote_branch')
         LOGGER.debug('Syncing %s' % remote_repo)
         
-        # Clone the repo if we don't have it yet.
-        if not os.path.exists(local_repo):
-            git_clone(remote_repo, local_repo, local_repo)
-        
-        output = git_fetch(local_repo)
-        diff = git_diff(local_branch, remote_branch, local_repo)
-        
-        # If git-diff prints to stdout, then we have changes (or an error).
-        # TODO: handle errors with incorrect branch names
-        if diff[0]:
-            LOGGER.info('Remote branch on repository %s has changes. Pulling.' \
-                        % remote_repo)
-            git_pull(local_repo)
-        return diff
+        try:
+            # Clone the repo if we don't have it yet.
+            if not os.path.exists(local_repo):
+                git_clone(remote_repo, local_repo, local_repo, remaining())
+
+            output = git_fetch(local_repo, remaining())
+            diff = git_diff(local_branch, remote_branch, local_repo,
+                            remaining())
+
+            # If git-diff prints to stdout, then we have changes (or an error).
+            # TODO: handle errors with incorrect branch names
+            if diff[0]:
+                LOGGER.info(('Remote branch on repository %s has changes. ' + \
+                             'Pulling.') % remote_repo)
+                git_pull(local_repo, remaining())
+            return diff
+        finally:
+            # A git command killed on timeout leaves its lock behind, which
+            # would make every later synchronization fail
+            if deadline and time.time() >= deadline:
+                remove_index_lock(local_repo)
 
     except NoOptionError, e:
         LOGGER.error(e)    
 
-def git_diff(local_branch, remote_branch, cwd):
+def remove_index_lock(cwd):
+    '''
+    Remove the index lock of a repository, left by a killed git command.
+
+    @param cwd: the working directory of the repository.
+    '''
+    lock = os.path.join(cwd, '.git', 'index.lock')
+    if not os.path.exists(lock):
+        return
+    LOGGER.warning('Removing stale lock %s' % lock)
+    try:
+        os.remove(lock)
+    except OSError, e:
+        LOGGER.error('Could not remove %s: %s' % (lock, e))
+
+def git_diff(local_branch, remote_branch, cwd, timeout=None):
     '''
     Perform a diff operation between a local and remote repository.
     
     @param local_branch: the local repository branch name.
     @param remote_branch: the remote branch name.
     @param cwd: the working directory in which to execute.
+    @param timeout: time in seconds after which the command is killed.
     '''
-    return Command('git diff %s %s' % (local_branch, remote_branch), cwd).execute()
+    return Command('git diff %s %s' % (local_branch, remote_branch), cwd).execute(timeout)
 
-def git_fetch(cwd):
+def git_fetch(cwd, timeout=None):
     '''
     Fetch objects and refs from a remote repository.
     
     @param cwd: the working directory in which to execute.
+    @param timeout: time in seconds after which the command is killed.
     '''
-    return Command('git fetch', cwd).execute()
+    return Command('git fetch', cwd).execute(timeout)
 
-def git_pull(cwd):
+def git_pull(cwd, timeout=None):
     '''
     Fetch from and merge with a remote repository.
     
     @param cwd: the working directory in which to execute.
+    @param timeout: time in seconds after which the command is killed.
     '''
-    return Command('git pull', cwd).execute()
+    return Command('git pull', cwd).execute(timeout)
 
-def git_clone(remote_repo, local_repo, cwd):
+def git_clone(remote_repo, local_repo, cwd, timeout=None):
     '''
     Clone a remote repository into a new local directory. Must have key-based
     authentication set up for this to work.
@@ -111,8 +144,9 @@ def git_clone(remote_repo, local_repo, cwd):
     @param remote_repo: the repository repo on the remote host. 
     @param local_repo: the local repo in which to clone the new repo.
     @param cwd: the working directory in which to execute.
+    @param timeout: time in seconds after which the command is killed.
     '''
     os.mkdir(local_repo)
-    Command('git clone %s %s' % (remote_repo, local_repo), cwd).execute()
+    Command('git clone %s %s' % (remote_repo, local_repo), cwd).execute(timeout)
     
     
\ No newline at end of file
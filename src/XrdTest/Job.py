@@ -22,7 +22,8 @@
 #-------------------------------------------------------------------------------
 #
 # File:   Job
-# Desc:   TODO:
+# Desc:   Jobs run by the master and the queue holding them, split into
+#         chains of job groups.
 #-------------------------------------------------------------------------------
 from Utils import Logger
 LOGGER = Logger(__name__).setup()
@@ -30,8 +31,11 @@ LOGGER = Logger(__name__).setup()
 try:
     import sys
     import datetime
+    import itertools
     import re
+    from collections import deque, OrderedDict
     from string import maketrans
+    from threading import RLock
 except ImportError, e:
     LOGGER.error(str(e))
     sys.exit(1)
@@ -58,13 +62,46 @@ class Job(object):
     START_CLUSTER = 6
     STOP_CLUSTER = 7
 
-    def __init__(self, job, groupId="", args=None):
+    SNAPSHOT_CLUSTER = 8
+    RESET_CLUSTER = 9
+
+    # names of jobs' types, used in textual representation of jobs
+    NAMES = {INITIALIZE_TEST_SUITE: "initSuite",
+             FINALIZE_TEST_SUITE: "finalizeSuite",
+             INITIALIZE_TEST_CASE: "initTest",
+             RUN_TEST_CASE: "runTest",
+             FINALIZE_TEST_CASE: "finalizeTest",
+             START_CLUSTER: "startCluster",
+             STOP_CLUSTER: "stopCluster",
+             SNAPSHOT_CLUSTER: "snapshotCluster",
+             RESET_CLUSTER: "resetCluster"}
+
+    # types of jobs concerning a single cluster, which are run at once with
+    # the following jobs of the same type, e.g. all clusters of a suite are
+    # started in parallel
+    CONCURRENT = (START_CLUSTER, STOP_CLUSTER, SNAPSHOT_CLUSTER, RESET_CLUSTER)
+
+    def __init__(self, job, groupId="", args=None, suiteName=None):
         self.job = job              # job type
         self.state = Job.S_ADDED    # initial job state
         self.args = args            # additional job's attributes
                                     # e.g. suite name or cluster_name
         self.groupId = groupId      # group of jobs to which this one belongs
+        self.suiteName = suiteName  # test suite run by the group of jobs
 
+    def __str__(self):
+        '''
+        Textual representation of a job, for debugging.
+        '''
+        if self.job in (Job.START_CLUSTER, Job.INITIALIZE_TEST_CASE,
+                        Job.RUN_TEST_CASE, Job.FINALIZE_TEST_CASE):
+            arg = self.args[0] if self.job == Job.START_CLUSTER \
+                               else self.args[1]
+        elif self.job in (Job.SNAPSHOT_CLUSTER, Job.RESET_CLUSTER):
+            arg = "%s:%s" % self.args
+        else:
+            arg = self.args
+        return "%s(%s)" % (Job.NAMES.get(self.job, self.job), arg)
 
     @staticmethod
     def genJobGroupId(suite_name):
@@ -76,4 +113,298 @@ class Job(object):
         r = "%s-%s" % (suite_name, d.isoformat())
         r = re.sub('-:.', '', r) # remove special
         return r
-    
+
+
+class JobQueue(object):
+    '''
+    Jobs enqueued to be run, split into chains - one for every job group.
+    Jobs of a chain are run one after another, so only the front of a chain
+    may be started: its first job, together with the jobs following it if
+    they are cluster jobs of the same type. Jobs are indexed by group, by
+    suite and by type and a started job is found and removed in constant
+    time once completed.
+    Synchronized, as it's read by the web interface threads as well.
+    '''
+    def __init__(self):
+        self.lock = RLock()
+        # Chains of jobs, in order of enqueuing. Key: groupId, Value: deque
+        # of jobs of the group
+        self.chains = OrderedDict()
+        # Job groups running a test suite. Key: suite name, Value: list of
+        # groupIds
+        self.suiteGroups = {}
+        # Test suite run by a job group. Key: groupId, Value: suite name
+        self.groupSuite = {}
+        # Enqueued jobs of every type, in order of enqueuing. Key: job type,
+        # Value: OrderedDict with jobs as keys
+        self.typeJobs = {}
+        # Started jobs. Key: tuple (job type, job args), Value: job
+        self.startedJobs = {}
+        # number of enqueued jobs
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def __contains__(self, job):
+        return job in self.typeJobs.get(job.job, {})
+
+    def __iter__(self):
+        '''
+        Iterate over all jobs, group after group.
+        '''
+        return iter(self.jobs())
+
+    def add(self, job):
+        '''
+        Append job at the end of its group's chain.
+        @param job:
+        '''
+        self.lock.acquire()
+        try:
+            if not self.chains.has_key(job.groupId):
+                self.chains[job.groupId] = deque()
+                self.groupSuite[job.groupId] = job.suiteName
+                self.suiteGroups.setdefault(job.suiteName, []).append(\
+                                                                job.groupId)
+            self.chains[job.groupId].append(job)
+            self.typeJobs.setdefault(job.job, OrderedDict())[job] = None
+            self.size += 1
+        finally:
+            self.lock.release()
+
+    def jobs(self, groupId=None, jobType=None):
+        '''
+        Return list of enqueued jobs, optionally only ones of the given
+        group and/or type, in order of running.
+        @param groupId:
+        @param jobType:
+        '''
+        self.lock.acquire()
+        try:
+            if groupId is not None:
+                jobs = list(self.chains.get(groupId, []))
+                if jobType is not None:
+                    jobs = [j for j in jobs if j.job == jobType]
+            elif jobType is not None:
+                jobs = self.typeJobs.get(jobType, {}).keys()
+            else:
+                jobs = [j for g in self.chains.itervalues() for j in g]
+            return jobs
+        finally:
+            self.lock.release()
+
+    def groups(self, suiteName=None):
+        '''
+        Return ids of job groups with enqueued jobs in order of enqueuing,
+        optionally only groups running the given test suite.
+        @param suiteName:
+        '''
+        self.lock.acquire()
+        try:
+            if suiteName is not None:
+                return list(self.suiteGroups.get(suiteName, []))
+            return self.chains.keys()
+        finally:
+            self.lock.release()
+
+    def head(self, groupId):
+        '''
+        Return first job of the group's chain, i.e. the one to be run next,
+        or None if the group has no more jobs.
+        @param groupId:
+        '''
+        self.lock.acquire()
+        try:
+            chain = self.chains.get(groupId)
+            return chain[0] if chain else None
+        finally:
+            self.lock.release()
+
+    def heads(self):
+        '''
+        Return list of tuples (groupId, first job of the chain) of all job
+        groups in order of enqueuing.
+        '''
+        self.lock.acquire()
+        try:
+            return [(g, c[0]) for g, c in self.chains.iteritems()]
+        finally:
+            self.lock.release()
+
+    def front(self, groupId):
+        '''
+        Return list of jobs of the group which may be run at once: the first
+        job of the chain and, if it is of a concurrent type, the jobs of the
+        same type following it.
+        @param groupId:
+        '''
+        self.lock.acquire()
+        try:
+            chain = self.chains.get(groupId)
+            if not chain:
+                return []
+            jobs = [chain[0]]
+            if chain[0].job in Job.CONCURRENT:
+                for j in itertools.islice(chain, 1, None):
+                    if j.job != chain[0].job:
+                        break
+                    jobs.append(j)
+            return jobs
+        finally:
+            self.lock.release()
+
+    def start(self, job):
+        '''
+        Mark job as started.
+        @param job: job at the front of a chain
+        '''
+        self.lock.acquire()
+        try:
+            job.state = Job.S_STARTED
+            self.startedJobs[(job.job, job.args)] = job
+        finally:
+            self.lock.release()
+
+    def complete(self, job_pattern):
+        '''
+        Remove started job of the same type and arguments as job_pattern.
+        @param job_pattern: pattern of a job to be removed
+        @return: removed job or None if no such job was started
+        '''
+        self.lock.acquire()
+        try:
+            job = self.startedJobs.get((job_pattern.job, job_pattern.args))
+            if job:
+                self.remove(job)
+            return job
+        finally:
+            self.lock.release()
+
+    def remove(self, job):
+        '''
+        Remove a job from the queue. Cheap for the first job of a chain.
+        @param job:
+        '''
+        self.lock.acquire()
+        try:
+            chain = self.chains[job.groupId]
+            if chain[0] is job:
+                chain.popleft()
+            else:
+                chain.remove(job)
+            self._unindex(job)
+            if not chain:
+                self._removeChain(job.groupId)
+        finally:
+            self.lock.release()
+
+    def admitGroups(self, runningSuites, clusterOwners, suiteClusters):
+        '''
+        Choose waiting job groups which may begin: no other run of the same
+        test suite is in progress and none of the suite's clusters is held
+        by another job group or awaited by a group enqueued earlier. A group
+        which finished running its suite does not hold the suite any more.
+        A cluster held by a group about to stop it is handed over if the
+        waiting group begins with starting the same cluster.
+        @param runningSuites: dict of groupIds running test suites, keyed
+                              by suite name
+        @param clusterOwners: dict of groupIds holding clusters, keyed by
+                              cluster name
+        @param suiteClusters: dict of lists of cluster names, keyed by
+                              suite name
+        @return: list of tuples (groupId, suite name, list of tuples (stop
+                 job, start job) of clusters handed over)
+        '''
+        self.lock.acquire()
+        try:
+            running = set(runningSuites.values())
+            active = running | set(clusterOwners.values())
+            reservedSuites = set()
+            reservedClusters = set()
+            admitted = []
+
+            for groupId, chain in self.chains.iteritems():
+                suiteName = self.groupSuite[groupId]
+                if groupId in active:
+                    if groupId in running:
+                        reservedSuites.add(suiteName)
+                    reservedClusters.update([j.args[0] for j in chain \
+                                             if j.job == Job.START_CLUSTER])
+                    continue
+
+                clusters = suiteClusters.get(suiteName, [])
+                startable = not suiteName in reservedSuites and \
+                            not runningSuites.has_key(suiteName)
+                starts = dict([(j.args[0], j) for j in self.front(groupId) \
+                               if j.job == Job.START_CLUSTER])
+                handOvers = []
+                for c in clusters:
+                    if c in reservedClusters:
+                        startable = False
+                    elif clusterOwners.has_key(c):
+                        stops = [j for j in self.front(clusterOwners[c]) \
+                                 if j.job == Job.STOP_CLUSTER and \
+                                 j.args == c and j.state != Job.S_STARTED]
+                        if starts.has_key(c) and stops:
+                            handOvers.append((stops[0], starts[c]))
+                        else:
+                            startable = False
+
+                reservedSuites.add(suiteName)
+                reservedClusters.update(clusters)
+
+                if startable:
+                    admitted.append((groupId, suiteName, handOvers))
+            return admitted
+        finally:
+            self.lock.release()
+
+    def removeGroup(self, groupId, jobTypes=None, testName=None):
+        '''
+        Remove jobs of a job group.
+        @param groupId:
+        @param jobTypes: remove only jobs of these types, all if None
+        @param testName: remove only jobs concerning this test case
+        @return: list of removed jobs
+        '''
+        self.lock.acquire()
+        try:
+            if not self.chains.has_key(groupId):
+                return []
+            removed = []
+            kept = deque()
+            for j in self.chains[groupId]:
+                if (jobTypes is None or j.job in jobTypes) and \
+                    (testName is None or j.args[1] == testName):
+                    self._unindex(j)
+                    removed.append(j)
+                else:
+                    kept.append(j)
+            self.chains[groupId] = kept
+            if not kept:
+                self._removeChain(groupId)
+            return removed
+        finally:
+            self.lock.release()
+
+    def debug(self, limit=None):
+        '''
+        Return textual representation of enqueued jobs.
+        @param limit: maximum number of jobs to be returned
+        '''
+        return [str(j) for j in self.jobs()[:limit]]
+
+    def _unindex(self, job):
+        del self.typeJobs[job.job][job]
+        key = (job.job, job.args)
+        if self.startedJobs.get(key) is job:
+            del self.startedJobs[key]
+        self.size -= 1
+
+    def _removeChain(self, groupId):
+        del self.chains[groupId]
+        suiteName = self.groupSuite.pop(groupId)
+        self.suiteGroups[suiteName].remove(groupId)
+        if not self.suiteGroups[suiteName]:
+            del self.suiteGroups[suiteName]
@@ -0,0 +1,470 @@
+#!/usr/bin/env python
+#-------------------------------------------------------------------------------
+#
+# Copyright (c) 2011-2012 by European Organization for Nuclear Research (CERN)
+# Author: Justin Salmon <jsalmon@cern.ch>
+#
+# This file is part of XrdTest.
+#
+# XrdTest is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# XrdTest is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with XrdTest.  If not, see <http://www.gnu.org/licenses/>.
+#
+#-------------------------------------------------------------------------------
+#
+# File:    SessionStore
+# Desc:    Storage of test suite sessions and their stage results in a SQLite
+#          database. Stage results are append-only, so storing a session
+#          writes only the results added since it was last stored. Stage
+#          outputs, logs and core dump backtraces are stored compressed and
+#          deduplicated by their content hash.
+#
+#-------------------------------------------------------------------------------
+from Utils import Logger
+LOGGER = Logger(__name__).setup()
+
+try:
+    import sys
+    import sqlite3
+    import hashlib
+    import zlib
+    import cPickle as pickle
+
+    from copy import copy
+    from threading import Lock
+except ImportError, e:
+    LOGGER.error(str(e))
+    sys.exit(1)
+
+
+class SessionStoreException(Exception):
+    '''
+    General Exception raised by SessionStore.
+    '''
+    def __init__(self, desc):
+        '''
+        Constructs Exception
+        @param desc: description of an error
+        '''
+        self.desc = desc
+
+    def __str__(self):
+        '''
+        Returns textual representation of an error
+        '''
+        return repr(self.desc)
+
+class BlobRef(object):
+    '''
+    Reference to a text in the blob store, stored in stage results in place
+    of the text.
+    '''
+    def __init__(self, digest):
+        self.digest = digest
+
+class BlobText(str):
+    '''
+    Text retrieved from the blob store. The digest it is stored under allows
+    to stream it again, e.g. to the web interface.
+    '''
+    digest = None
+
+class SessionStore(object):
+    '''
+    Test suite sessions indexed by suite name, initialization date and status.
+    A session is stored as a row with its header, i.e. the pickled session
+    without stage results, and a row per stage result. The database is in WAL
+    mode with synchronous=NORMAL, so commits do not wait for the disk and
+    fsyncs are batched at WAL checkpoints.
+
+    Texts of stage results (output, error output, logs and core dump
+    backtraces) of at least BLOB_MIN_SIZE bytes are stored in the blobs
+    table, compressed and keyed by their SHA1 digest, so texts repeated by
+    many runs are stored once. Stage results hold references to them.
+    '''
+    # Texts shorter than this are kept inline in stage results
+    BLOB_MIN_SIZE = 256
+    # Size of chunks in which texts are decompressed when streamed
+    BLOB_CHUNK_SIZE = 64 * 1024
+    # user_version of the database once sessions of older versions are
+    # imported
+    IMPORTED = 1
+
+    SCHEMA = '''
+        CREATE TABLE IF NOT EXISTS sessions (
+            uid TEXT PRIMARY KEY,
+            name TEXT NOT NULL,
+            init_date TEXT NOT NULL,
+            state_id INTEGER,
+            failed INTEGER NOT NULL DEFAULT 0,
+            timeout INTEGER NOT NULL DEFAULT 0,
+            header BLOB NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS sessions_name_date
+            ON sessions (name, init_date);
+        CREATE INDEX IF NOT EXISTS sessions_date ON sessions (init_date);
+        CREATE INDEX IF NOT EXISTS sessions_status
+            ON sessions (failed, init_date);
+        CREATE TABLE IF NOT EXISTS stages (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            session_uid TEXT NOT NULL,
+            stage_uid TEXT,
+            slave TEXT,
+            state BLOB NOT NULL,
+            result BLOB NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS stages_session ON stages (session_uid);
+        CREATE TABLE IF NOT EXISTS blobs (
+            digest TEXT PRIMARY KEY,
+            size INTEGER NOT NULL,
+            refs INTEGER NOT NULL DEFAULT 0,
+            data BLOB NOT NULL
+        );
+    '''
+
+    def __init__(self, path):
+        '''
+        Opens the database, creating it if necessary.
+
+        @param path: path of the database file
+        '''
+        self.path = path
+        # Connection is shared by the main loop and web interface threads
+        self.lock = Lock()
+        # Number of stage results already stored of sessions still running,
+        # key: session uid
+        self.storedStages = {}
+        try:
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute('PRAGMA journal_mode=WAL')
+            self.db.execute('PRAGMA synchronous=NORMAL')
+            self.db.executescript(self.SCHEMA)
+            self.db.commit()
+            self.imported = self.db.execute('PRAGMA user_version' \
+                                            ).fetchone()[0] >= self.IMPORTED
+        except sqlite3.Error, e:
+            raise SessionStoreException('Cannot open session store %s: %s' % \
+                                        (path, e))
+
+    def __len__(self):
+        self.lock.acquire()
+        try:
+            return self.db.execute('SELECT COUNT(*) ' + \
+                                   'FROM sessions').fetchone()[0]
+        finally:
+            self.lock.release()
+
+    def has_key(self, uid):
+        self.lock.acquire()
+        try:
+            return self.db.execute('SELECT 1 FROM sessions WHERE uid = ?',
+                                   (uid,)).fetchone() is not None
+        finally:
+            self.lock.release()
+
+    def store(self, tss):
+        '''
+        Store the session header and its stage results added since it was
+        last stored.
+
+        @param tss: TestSuiteSession object
+        '''
+        header = copy(tss)
+        header.stagesResults = []
+
+        self.lock.acquire()
+        try:
+            stored = self.storedStages.get(tss.uid)
+            if stored is None:
+                stored = self.db.execute('SELECT COUNT(*) FROM stages ' + \
+                                         'WHERE session_uid = ?',
+                                         (tss.uid,)).fetchone()[0]
+            newStages = tss.stagesResults[stored:]
+
+            state_id = tss.state.id if hasattr(tss.state, 'id') else None
+            self.db.execute('INSERT OR REPLACE INTO sessions ' + \
+                            '(uid, name, init_date, state_id, failed, ' + \
+                            'timeout, header) VALUES (?, ?, ?, ?, ?, ?, ?)',
+                            (tss.uid, tss.name, tss.initDate.isoformat(),
+                             state_id, int(bool(tss.failed)),
+                             int(bool(tss.timeout)), self._dump(header)))
+            self.db.executemany('INSERT INTO stages (session_uid, ' + \
+                                'stage_uid, slave, state, result) ' + \
+                                'VALUES (?, ?, ?, ?, ?)',
+                                [(tss.uid, uid, slave, self._dump(state),
+                                  self._dump(self._putBlobs(result))) \
+                                 for (state, result, uid, slave) in newStages])
+            self.db.commit()
+            self.storedStages[tss.uid] = stored + len(newStages)
+        except sqlite3.Error, e:
+            self.db.rollback()
+            LOGGER.error('Cannot store session %s: %s' % (tss.uid, e))
+        finally:
+            self.lock.release()
+
+    def get(self, uid):
+        '''
+        Retrieve a session with all its stage results.
+
+        @param uid: uid of the session
+        @return: TestSuiteSession object or None
+        '''
+        self.lock.acquire()
+        try:
+            row = self.db.execute('SELECT header FROM sessions WHERE uid = ?',
+                                  (uid,)).fetchone()
+            if not row:
+                return None
+            tss = self._load(row[0])
+            tss.stagesResults = self._stages(uid)
+            return tss
+        finally:
+            self.lock.release()
+
+    def query(self, name=None, since=None, until=None, failed=None,
+              offset=0, limit=None):
+        '''
+        Retrieve sessions without their stage results, newest first. Stage
+        results of a session are loaded with stages() or get().
+
+        @param name: only sessions of test suite with this name
+        @param since: only sessions initialized at or after this datetime
+        @param until: only sessions initialized before this datetime
+        @param failed: only failed (True) or successful (False) sessions
+        @param offset: number of matching sessions to skip
+        @param limit: maximum number of sessions to retrieve
+        @return: list of TestSuiteSession objects
+        '''
+        (where, args) = self._where(name, since, until, failed)
+        query = 'SELECT header FROM sessions' + where + \
+                ' ORDER BY init_date DESC LIMIT ? OFFSET ?'
+        args += [-1 if limit is None else limit, offset]
+
+        self.lock.acquire()
+        try:
+            return [self._load(header) for (header,) in \
+                    self.db.execute(query, args).fetchall()]
+        finally:
+            self.lock.release()
+
+    def count(self, name=None, since=None, until=None, failed=None):
+        '''
+        Count sessions matching the query() conditions of the same names.
+        '''
+        (where, args) = self._where(name, since, until, failed)
+        self.lock.acquire()
+        try:
+            return self.db.execute('SELECT COUNT(*) FROM sessions' + where,
+                                   args).fetchone()[0]
+        finally:
+            self.lock.release()
+
+    def stages(self, uid):
+        '''
+        Retrieve stage results of a session.
+
+        @param uid: uid of the session
+        @return: list of (state, result, stage uid, slave) tuples
+        '''
+        self.lock.acquire()
+        try:
+            return self._stages(uid)
+        finally:
+            self.lock.release()
+
+    def forget(self, uid):
+        '''
+        Stop tracking stage results stored of a session which is not
+        running anymore. Should it be stored again, they are counted in the
+        database.
+
+        @param uid: uid of the session
+        '''
+        self.lock.acquire()
+        try:
+            if self.storedStages.has_key(uid):
+                del self.storedStages[uid]
+        finally:
+            self.lock.release()
+
+    def delete(self, uid):
+        '''
+        Remove a session with its stage results.
+
+        @param uid: uid of the session
+        '''
+        self.lock.acquire()
+        try:
+            results = self.db.execute('SELECT result FROM stages ' + \
+                                      'WHERE session_uid = ?',
+                                      (uid,)).fetchall()
+            for (result,) in results:
+                for ref in self._blobRefs(self._load(result)):
+                    self.db.execute('UPDATE blobs SET refs = refs - 1 ' + \
+                                    'WHERE digest = ?', (ref.digest,))
+            self.db.execute('DELETE FROM blobs WHERE refs <= 0')
+            self.db.execute('DELETE FROM stages WHERE session_uid = ?', (uid,))
+            self.db.execute('DELETE FROM sessions WHERE uid = ?', (uid,))
+            self.db.commit()
+            if self.storedStages.has_key(uid):
+                del self.storedStages[uid]
+        except Exception, e:
+            # not to leave decremented references pending for the next commit
+            self.db.rollback()
+            LOGGER.error('Cannot delete session %s: %s' % (uid, e))
+        finally:
+            self.lock.release()
+
+    def blob(self, digest):
+        '''
+        Retrieve a text from the blob store.
+
+        @param digest: digest of the text
+        @return: iterator over chunks of the text or None if there is none
+        '''
+        self.lock.acquire()
+        try:
+            row = self.db.execute('SELECT data FROM blobs WHERE digest = ?',
+                                  (digest,)).fetchone()
+        finally:
+            self.lock.release()
+        if not row:
+            return None
+        return self._decompress(str(row[0]))
+
+    def _decompress(self, data):
+        d = zlib.decompressobj()
+        for i in xrange(0, len(data), self.BLOB_CHUNK_SIZE):
+            yield d.decompress(data[i:i + self.BLOB_CHUNK_SIZE])
+        yield d.flush()
+
+    def setImported(self):
+        '''
+        Record that sessions of older versions are all imported.
+        '''
+        self.lock.acquire()
+        try:
+            self.db.execute('PRAGMA user_version = %d' % self.IMPORTED)
+            self.db.commit()
+            self.imported = True
+        except sqlite3.Error, e:
+            self.db.rollback()
+            LOGGER.error('Cannot mark sessions imported: %s' % e)
+        finally:
+            self.lock.release()
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            self.db.commit()
+            self.db.close()
+        finally:
+            self.lock.release()
+
+    def _where(self, name, since, until, failed):
+        cond = []
+        args = []
+        if name is not None:
+            cond.append('name = ?')
+            args.append(name)
+        if since is not None:
+            cond.append('init_date >= ?')
+            args.append(since.isoformat())
+        if until is not None:
+            cond.append('init_date < ?')
+            args.append(until.isoformat())
+        if failed is not None:
+            cond.append('failed = ?')
+            args.append(int(bool(failed)))
+
+        if not cond:
+            return ('', args)
+        return (' WHERE ' + ' AND '.join(cond), args)
+
+    def _putBlob(self, text):
+        '''
+        Store a text in the blob store, unless it is too short to be worth it.
+
+        @return: BlobRef object or the text itself
+        '''
+        if not isinstance(text, basestring) or len(text) < self.BLOB_MIN_SIZE:
+            return text
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+
+        digest = hashlib.sha1(text).hexdigest()
+        self.db.execute('INSERT OR IGNORE INTO blobs (digest, size, data) ' + \
+                        'VALUES (?, ?, ?)', (digest, len(text),
+                        sqlite3.Binary(zlib.compress(text))))
+        self.db.execute('UPDATE blobs SET refs = refs + 1 WHERE digest = ?',
+                        (digest,))
+        return BlobRef(digest)
+
+    def _getBlob(self, ref):
+        if not isinstance(ref, BlobRef):
+            return ref
+        row = self.db.execute('SELECT data FROM blobs WHERE digest = ?',
+                              (ref.digest,)).fetchone()
+        if not row:
+            LOGGER.error('Missing blob %s in session store' % ref.digest)
+            return ''
+        text = BlobText(zlib.decompress(str(row[0])))
+        text.digest = ref.digest
+        return text
+
+    def _mapTexts(self, result, func):
+        '''
+        Apply func to texts of a stage result, i.e. to output, error output,
+        custom logs and core dump backtraces.
+
+        @param result: (output, error output, return code, logs, dumps) tuple
+        @return: new stage result
+        '''
+        result = list(result)
+        for i in (0, 1):
+            if len(result) > i:
+                result[i] = func(result[i])
+        if len(result) > 3 and isinstance(result[3], dict):
+            result[3] = dict([(k, func(v)) for (k, v) in \
+                              result[3].iteritems()])
+        if len(result) > 4 and isinstance(result[4], list):
+            result[4] = [func(d) for d in result[4]]
+        return tuple(result)
+
+    def _putBlobs(self, result):
+        return self._mapTexts(result, self._putBlob)
+
+    def _getBlobs(self, result):
+        return self._mapTexts(result, self._getBlob)
+
+    def _blobRefs(self, result):
+        refs = []
+        def collect(text):
+            if isinstance(text, BlobRef):
+                refs.append(text)
+            return text
+        self._mapTexts(result, collect)
+        return refs
+
+    def _stages(self, uid):
+        return [(self._load(state), self._getBlobs(self._load(result)),
+                 stage_uid, slave) \
+                for (state, result, stage_uid, slave) in \
+                self.db.execute('SELECT state, result, stage_uid, slave ' + \
+                                'FROM stages WHERE session_uid = ? ' + \
+                                'ORDER BY id', (uid,)).fetchall()]
+
+    def _dump(self, obj):
+        return sqlite3.Binary(pickle.dumps(obj, pickle.HIGHEST_PROTOCOL))
+
+    def _load(self, blob):
+        return pickle.loads(str(blob))
@@ -40,22 +40,34 @@ class PriorityBlockingQueue(object):
     '''
     Synchronized priority queue.
     Pattern for entries is a tuple in the form: (priority_number, data).
-    Lowest valued entries are retrieved first.
+    Lowest valued entries are retrieved first, entries of equal priority in
+    the order they were put.
     '''
     def __init__(self):
+        # entries in the form: (priority_number, sequence_number, data)
         self.heap = []
+        # number of the next entry put, to keep entries of equal priority
+        # in FIFO order and to never compare their data
+        self.seq = 0
+        # number of entries, key: priority
+        self.depths = {}
         self.lock = Lock()
         self.criticalSection = Condition(self.lock)
 
+    def __len__(self):
+        return len(self.heap)
+
     def put(self, elem):
         '''
         Puts element to the queue.
         @param elem: a tuple in the form: (priority_number[int], data).
         '''
         self.criticalSection.acquire()
-        heappush(self.heap, elem)
-        if len(self.heap) == 1:
-            self.criticalSection.notify()
+        heappush(self.heap, (elem[0], self.seq, elem[1]))
+        self.seq += 1
+        self.depths[elem[0]] = self.depths.get(elem[0], 0) + 1
+        # every element wakes up one waiting consumer
+        self.criticalSection.notify()
 
         self.criticalSection.release()
 
@@ -68,9 +80,10 @@ class PriorityBlockingQueue(object):
         while len(self.heap) <= 0:
             self.criticalSection.wait()
         elem = heappop(self.heap)
+        self.removed(elem)
         self.criticalSection.release()
 
-        return elem
+        return (elem[0], elem[2])
 
     def get(self):
         '''
@@ -79,6 +92,46 @@ class PriorityBlockingQueue(object):
         '''
         return self.rawGet()[1]
 
+    def depth(self):
+        '''
+        @return: number of elements in the queue, key: priority
+        '''
+        self.criticalSection.acquire()
+        try:
+            return dict(self.depths)
+        finally:
+            self.criticalSection.release()
+
+    def removed(self, elem):
+        self.depths[elem[0]] -= 1
+        if not self.depths[elem[0]]:
+            del self.depths[elem[0]]
+
+    def get_many(self, maxItems=None):
+        '''
+        Waits for at least one element and retrieves data of all elements
+        in the queue, in the order get() would retrieve them, with one lock
+        round trip.
+        @param maxItems: retrieve at most that many elements
+        @return: list of data
+        '''
+        self.criticalSection.acquire()
+        while len(self.heap) <= 0:
+            self.criticalSection.wait()
+        if maxItems is None or maxItems >= len(self.heap):
+            elems = sorted(self.heap)
+            self.heap = []
+        else:
+            elems = [heappop(self.heap) for i in xrange(maxItems)]
+        for e in elems:
+            self.removed(e)
+        # elements left for other consumers
+        if len(self.heap):
+            self.criticalSection.notify()
+        self.criticalSection.release()
+
+        return [e[2] for e in elems]
+
 class XrdMessage(object):
     '''
     Network message passed between Xrd Testing Framework nodes.
@@ -87,6 +140,8 @@ class XrdMessage(object):
     M_HELLO = 'hello'
     M_START_CLUSTER = 'start_cluster'
     M_STOP_CLUSTER = 'stop_cluster'
+    M_RESET_CLUSTER = 'reset_cluster'
+    M_SNAPSHOT_CLUSTER = 'snapshot_cluster'
     M_CLUSTER_STATE = 'cluster_state'
     M_HYPERVISOR_STATE = 'hypervisor_state'
 
@@ -201,5 +256,11 @@ class FixedSockStream(object):
             obj = msg
         return obj
 
+    def shutdown(self):
+        '''
+        End the connection, waking up a thread blocked receiving from it.
+        '''
+        self.sock.shutdown(socket.SHUT_RDWR)
+
     def close(self):
         self.sock.close()
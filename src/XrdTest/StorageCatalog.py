@@ -0,0 +1,164 @@
+#!/usr/bin/env python
+#-------------------------------------------------------------------------------
+#
+# Copyright (c) 2011-2012 by European Organization for Nuclear Research (CERN)
+# Author: Justin Salmon <jsalmon@cern.ch>
+#
+# This file is part of XrdTest.
+#
+# XrdTest is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# XrdTest is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with XrdTest.  If not, see <http://www.gnu.org/licenses/>.
+#
+#-------------------------------------------------------------------------------
+#
+# File:    StorageCatalog
+# Desc:    Cache of libvirt storage pool paths and volumes, refreshed when
+#          its entries get older than a TTL or a volume is not found.
+#
+#-------------------------------------------------------------------------------
+from Utils import Logger
+LOGGER = Logger(__name__).setup()
+
+try:
+    import sys
+    import time
+
+    from threading import RLock
+    from xml.dom.minidom import parseString
+except ImportError, e:
+    LOGGER.error(str(e))
+    sys.exit(1)
+
+
+class PoolEntry(object):
+    '''
+    Cached information about a storage pool.
+    '''
+    def __init__(self, pool, path):
+        '''
+        @param pool: libvirt storage pool object
+        @param path: directory of the pool
+        '''
+        self.pool = pool
+        self.path = path
+        # Key: volume name, Value: volume path
+        self.volumes = {}
+        # Time the volumes were last listed, 0 if never
+        self.listed = 0
+
+class StorageCatalog(object):
+    '''
+    Storage pools and their volumes as last seen on a libvirt connection.
+    Lookups are answered from the cache. The volumes of a pool are listed
+    again when they are older than the TTL or when a volume is not found,
+    only the paths of volumes which appeared being looked up. Everything is
+    forgotten when the connection changes, as pool objects belong to it.
+    '''
+    # Seconds volumes of a pool are trusted without listing them again
+    TTL = 60
+
+    def __init__(self, connect, ttl=TTL):
+        '''
+        @param connect: function returning the libvirt connection
+        @param ttl: seconds volumes of a pool are trusted
+        '''
+        self.connect = connect
+        self.ttl = ttl
+        self.lock = RLock()
+        self.conn = None
+        # Key: requested pool name, Value: PoolEntry
+        self.pools = {}
+
+    def invalidate(self, poolname=None):
+        '''
+        Forget the volumes of a pool, or everything if no pool is given.
+        '''
+        self.lock.acquire()
+        try:
+            if poolname is None:
+                self.pools = {}
+            elif self.pools.has_key(poolname):
+                self.pools[poolname].listed = 0
+        finally:
+            self.lock.release()
+
+    def entry(self, poolname):
+        '''
+        @param poolname: name of the pool, the default pool is used if there
+                         is no pool of this name
+        @raise libvirtError: when the pool can not be looked up
+        @return: PoolEntry object
+        '''
+        conn = self.connect()
+        if conn is not self.conn:
+            self.conn = conn
+            self.pools = {}
+
+        if not self.pools.has_key(poolname):
+            if poolname in conn.listStoragePools():
+                pool = conn.storagePoolLookupByName(poolname)
+            else:
+                LOGGER.warning('Storage pool %s not found. Using default.' % \
+                               poolname)
+                pool = conn.storagePoolLookupByName('default')
+            doc = parseString(pool.XMLDesc(0))
+            path = doc.getElementsByTagName('target')[0] \
+                      .getElementsByTagName('path')[0].firstChild.nodeValue
+            self.pools[poolname] = PoolEntry(pool, path)
+        return self.pools[poolname]
+
+    def refresh(self, poolname):
+        '''
+        Refresh the pool in libvirt and update its volumes, looking up the
+        paths of new volumes only.
+
+        @return: PoolEntry object
+        '''
+        self.lock.acquire()
+        try:
+            entry = self.entry(poolname)
+            entry.pool.refresh(0)
+            names = set(entry.pool.listVolumes())
+            for name in set(entry.volumes.keys()) - names:
+                del entry.volumes[name]
+            for name in names - set(entry.volumes.keys()):
+                entry.volumes[name] = \
+                                entry.pool.storageVolLookupByName(name).path()
+            entry.listed = time.time()
+            return entry
+        finally:
+            self.lock.release()
+
+    def poolPath(self, poolname):
+        '''
+        @return: directory of the pool
+        '''
+        self.lock.acquire()
+        try:
+            return self.entry(poolname).path
+        finally:
+            self.lock.release()
+
+    def volumePath(self, poolname, volumename):
+        '''
+        @return: full path of the volume or None if it is not in the pool
+        '''
+        self.lock.acquire()
+        try:
+            entry = self.entry(poolname)
+            if time.time() - entry.listed > self.ttl or \
+                not entry.volumes.has_key(volumename):
+                entry = self.refresh(poolname)
+            return entry.volumes.get(volumename)
+        finally:
+            self.lock.release()
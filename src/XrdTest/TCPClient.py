@@ -102,6 +102,8 @@ class Hypervisor(TCPClient):
     def __init__(self, socket, hostname, address, state):
         TCPClient.__init__(self, socket, hostname, address, state)
         self.runningClusterDefs = {}
+        # resources last reported by the hypervisor, None until it reports
+        self.capacity = None
 
     def __str__(self):
         return "Hypervisor %s [%s]" % (self.hostname, self.address)
@@ -123,5 +125,149 @@ class Slave(TCPClient):
     S_TEST_FINALIZE_SENT = (25, "Sent test case finalize to slave")
     S_TEST_FINALIZED = (26, "Test case finalized")
 
+    def __init__(self, socket, hostname, address, state):
+        # registry indexing this slave, notified on every state change
+        self.registry = None
+        TCPClient.__init__(self, socket, hostname, address, state)
+
+    def setState(self, state):
+        prev = self.getState()
+        Stateful.setState(self, state)
+        if self.registry:
+            self.registry.stateChanged(self, prev)
+
+    state = property(Stateful.getState, setState)
+
     def __str__(self):
         return "Slave %s [%s]" % (self.hostname, self.address)
+
+class SlaveRegistry(object):
+    '''
+    Connected slaves, keyed by address tuple like a plain dictionary, and
+    additionally indexed by hostname, by current state and by the test suite
+    the slave's state belongs to. Indexes are updated incrementally on every
+    slave state change, so lookups do not need to scan all slaves.
+    '''
+    def __init__(self):
+        # key: address tuple, value: Slave object
+        self.byAddress = {}
+        # key: hostname, value: Slave object
+        self.byHostname = {}
+        # key: state id, value: set of hostnames
+        self.byState = {}
+        # key: suite name, value: set of hostnames
+        self.bySuite = {}
+
+    def __len__(self):
+        return len(self.byAddress)
+
+    def __contains__(self, address):
+        return address in self.byAddress
+
+    def __getitem__(self, address):
+        return self.byAddress[address]
+
+    def __setitem__(self, address, slave):
+        if self.byAddress.has_key(address):
+            del self[address]
+        # a stale connection of the same host is superseded by the new one
+        old = self.byHostname.get(slave.hostname)
+        if old:
+            LOGGER.warning("%s replaced by a new connection" % old)
+            del self[old.address]
+
+        self.byAddress[address] = slave
+        self.byHostname[slave.hostname] = slave
+        slave.registry = self
+        self._index(slave, slave.state)
+
+    def __delitem__(self, address):
+        slave = self.byAddress.pop(address)
+        if self.byHostname.get(slave.hostname) is slave:
+            del self.byHostname[slave.hostname]
+        self._unindex(slave, slave.state)
+        slave.registry = None
+
+    def has_key(self, address):
+        return self.byAddress.has_key(address)
+
+    def keys(self):
+        return self.byAddress.keys()
+
+    def values(self):
+        return self.byAddress.values()
+
+    def items(self):
+        return self.byAddress.items()
+
+    def iterkeys(self):
+        return iter(self.byAddress.keys())
+
+    def itervalues(self):
+        return iter(self.byAddress.values())
+
+    def iteritems(self):
+        return iter(self.byAddress.items())
+
+    def get(self, hostname):
+        '''
+        Get connected slave by its hostname.
+
+        @param hostname: fully qualified hostname
+        @return: Slave object or None if not connected
+        '''
+        return self.byHostname.get(hostname)
+
+    def find(self, hostnames, state=None, suiteName=None):
+        '''
+        Get connected slaves among given hosts, optionally only those in
+        given state and/or those whose state belongs to given test suite.
+
+        @param hostnames: set of hostnames
+        @param state: required slave state
+        @param suiteName: name of the test suite of slave's state
+        @return: list of Slave objects
+        '''
+        hosts = hostnames
+        if state:
+            hosts = hosts & self.byState.get(state.id, set())
+        if suiteName:
+            hosts = hosts & self.bySuite.get(suiteName, set())
+
+        return [self.byHostname[h] for h in hosts \
+                if self.byHostname.has_key(h)]
+
+    def stateChanged(self, slave, prev):
+        '''
+        Move the slave between state indexes.
+
+        @param slave: Slave object
+        @param prev: state the slave has just left
+        '''
+        if self.byHostname.get(slave.hostname) is not slave:
+            return
+        self._unindex(slave, prev)
+        self._index(slave, slave.state)
+
+    def _index(self, slave, state):
+        if not state:
+            return
+        self.byState.setdefault(state.id, set()).add(slave.hostname)
+        suiteName = getattr(state, 'suiteName', None)
+        if suiteName:
+            self.bySuite.setdefault(suiteName, set()).add(slave.hostname)
+
+    def _unindex(self, slave, state):
+        if not state:
+            return
+        self._discard(self.byState, state.id, slave.hostname)
+        suiteName = getattr(state, 'suiteName', None)
+        if suiteName:
+            self._discard(self.bySuite, suiteName, slave.hostname)
+
+    def _discard(self, index, key, hostname):
+        hosts = index.get(key)
+        if hosts is not None:
+            hosts.discard(hostname)
+            if not hosts:
+                del index[key]
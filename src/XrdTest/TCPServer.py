@@ -31,6 +31,7 @@ try:
     import ssl 
     import sys
     import threading
+    import time
     import SocketServer
     
     from XrdTest.SocketUtils import FixedSockStream, SocketDisconnectedError
@@ -158,8 +159,21 @@ class MasterEvent(object):
     M_JOB_ENQUEUE = 6
     M_RELOAD_CLUSTER_DEF = 7
     M_RELOAD_SUITE_DEF = 8
+    M_EVICT_CLUSTERS = 9
+
+    NAMES = {M_UNKNOWN: "unknown",
+             M_CLIENT_CONNECTED: "clientConnected",
+             M_CLIENT_DISCONNECTED: "clientDisconnected",
+             M_HYPERV_MSG: "hypervisorMsg",
+             M_SLAVE_MSG: "slaveMsg",
+             M_JOB_ENQUEUE: "jobEnqueue",
+             M_RELOAD_CLUSTER_DEF: "reloadClusterDef",
+             M_RELOAD_SUITE_DEF: "reloadSuiteDef",
+             M_EVICT_CLUSTERS: "evictClusters"}
 
     def __init__(self, e_type, e_data, msg_sender_addr=None):
         self.type = e_type
         self.data = e_data
         self.sender = msg_sender_addr
+        # time of creation, i.e. of queueing, for queue wait statistics
+        self.created = time.time()
@@ -48,6 +48,7 @@ try:
     
     from Utils import State, Stateful
     from EmailNotifier import EmailNotifier
+    from DefinitionCache import definitionFiles
     from string import maketrans 
     from copy import copy
 except ImportError, e:
@@ -151,6 +152,9 @@ class TestSuite(Stateful):
         self.alert_success = ''
         # Test suite failure email alert policy.
         self.alert_failure = ''
+        # When clusters of the suite are reverted to a snapshot: 'SUITE'
+        # after the run, 'CASE' also before every test case but the first.
+        self.cluster_reset = 'SUITE'
         
     def __getstate__(self):
         state = self.__dict__.copy()
@@ -187,6 +191,11 @@ class TestSuite(Stateful):
                 raise TestSuiteException(("No TestCase %s was defined, but was used" + \
                                          " in TestSuite definition.") % str(t), \
                                           TestSuiteException.ERR_CRITICAL)
+        if not self.cluster_reset in ('SUITE', 'CASE'):
+            raise TestSuiteException(("Invalid cluster reset policy %s " + \
+                                      "in TestSuite %s definition.") % \
+                                      (self.cluster_reset, self.name), \
+                                      TestSuiteException.ERR_CRITICAL)
         return True
 
     def checkIfDefComplete(self, clusters):
@@ -430,6 +439,50 @@ class TestSuiteSession(Stateful):
             if type is not None: self.notifier.notify_success(args, desc, type)
            
 
+class StageBarrier(object):
+    '''
+    Barrier of a single stage of a test suite session, e.g. run of a test
+    case, which completes when the stage finished on all the machines it was
+    sent to. Keeps the set of machines still being waited for.
+    '''
+    def __init__(self, name, hostnames):
+        '''
+        @param name: description of the stage
+        @param hostnames: machines the stage was sent to
+        '''
+        self.name = name
+        self.expected = frozenset(hostnames)
+        # machines that have not yet reported the stage result
+        self.outstanding = set(hostnames)
+        # machines that reported an error
+        self.errors = set()
+        self.done = False
+
+    def arrive(self, hostname, error=False):
+        '''
+        Record the stage result of a machine.
+
+        @param hostname: machine reporting the result
+        @param error: True if the stage failed on the machine
+        @return: True if this result completed the stage. It is returned
+                 only once, duplicate or unexpected results are ignored.
+        '''
+        if self.done or not hostname in self.outstanding:
+            return False
+
+        self.outstanding.remove(hostname)
+        if error:
+            self.errors.add(hostname)
+
+        if not self.outstanding:
+            self.done = True
+            return True
+        return False
+
+    def __str__(self):
+        return "%s waiting for %s" % (self.name,
+                                      ', '.join(sorted(self.outstanding)))
+
 def extractSuiteName(path):
     '''
     Return the suite name from the given path.
@@ -474,20 +527,31 @@ def loadTestCasesDefs(path, tests):
 
     return testCases
 
-def loadTestSuiteDef(path):
+def loadTestSuiteDef(path, cache=None):
     '''
     Load a single test suite definition.
 
     @param path: path to the suite definition to be loaded.
+    @param cache: DefinitionCache to get unchanged definition from
     '''
     fp = path
     (modName, ext, modPath, modFile) = extractSuiteName(fp)
     obj = None
     if os.path.isfile(fp) and ext == '.py':
+        # The definition depends on all files in the suite directory
+        files = definitionFiles(modPath)
+        if cache:
+            obj = cache.get(fp, files)
+            if obj:
+                return obj
+
         mod = None
         try:
-            if not modPath in sys.path:
-                sys.path.insert(0, modPath)
+            # All suite modules are named alike, so the directory of this one
+            # has to be searched first.
+            if modPath in sys.path:
+                sys.path.remove(modPath)
+            sys.path.insert(0, modPath)
 
             method = 'getTestSuite'
             if sys.modules.has_key(modName):
@@ -499,6 +563,11 @@ def loadTestSuiteDef(path):
 
             obj.definitionFile = modFile
             
+            # Scripts outside of the suite directory may change unnoticed
+            external = [s for s in (obj.initialize, obj.finalize) \
+                        if s and (s.startswith('file:///') or \
+                                  s.startswith('http://'))]
+
             # Resolve script URLs into actual text
             root_path = os.sep.join(path.split(os.sep)[:-1])
             obj.initialize = resolveScript(obj.initialize, root_path) 
@@ -509,6 +578,9 @@ def loadTestSuiteDef(path):
             
             #after load, check if testSuite definition is correct
             obj.validateStatic()
+
+            if cache and not external:
+                cache.put(fp, files, obj)
         except TypeError, e:
             raise TestSuiteException(("TypeError in test suite definition " + \
                   "file %s: %s") % (modFile, e))
@@ -530,12 +602,13 @@ def loadTestSuiteDef(path):
               "seems not to be a test suite definition.") % fp)
     return obj
 
-def loadTestSuiteDefs(path):
+def loadTestSuiteDefs(path, cache=None):
     '''
     Loads TestSuite and TestCase definitions from .py files
     stored in path directory.
 
     @param path: path for .py files, storing cluster definitions
+    @param cache: DefinitionCache to get unchanged definitions from
     '''
     testSuites = []
     
@@ -545,23 +618,41 @@ def loadTestSuiteDefs(path):
             if not os.path.isdir(tsDir):
                 continue
 
-            fp = path + os.sep + f + os.sep + 'test_suite.py'
-            if not os.path.isfile(fp):
-                continue
-            try:
-                ts = loadTestSuiteDef(fp)
-                if ts:
-                    ts.state = State(TestSuite.S_DEF_OK)
-                    testSuites.append(ts)
-            except TestSuiteException, e:
-                ts = TestSuite(f+"_ERROR")
-                ts.name = f
-                ts.state = State((-1, e.desc))
+            ts = loadTestSuiteDir(tsDir, cache)
+            if ts:
                 testSuites.append(ts)
-                LOGGER.error(e)
 
     return testSuites
 
+def loadTestSuiteDir(tsDir, cache=None):
+    '''
+    Loads the test suite defined by test_suite.py file in the given directory.
+    If the definition is invalid, a suite in error state is returned.
+
+    @param tsDir: directory of a test suite
+    @param cache: DefinitionCache to get unchanged definition from
+    @return: TestSuite object or None, if there is no definition
+    '''
+    fp = tsDir + os.sep + 'test_suite.py'
+    if not os.path.isfile(fp):
+        return None
+
+    try:
+        ts = loadTestSuiteDef(fp, cache)
+        if ts:
+            ts.state = State(TestSuite.S_DEF_OK)
+    except TestSuiteException, e:
+        f = os.path.basename(tsDir)
+        ts = TestSuite(f+"_ERROR")
+        ts.name = f
+        ts.state = State((-1, e.desc))
+        LOGGER.error(e)
+
+    if ts:
+        # directory the suite was loaded from, used to reload it on change
+        ts.definitionDir = tsDir
+    return ts
+
 def resolveScript(definition, root_path):
     '''
     Grabs a script from some arbitrary path and appends a set of util functions
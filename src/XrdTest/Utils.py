@@ -29,6 +29,7 @@ import datetime
 import subprocess
 import os
 import sys
+import signal
 import threading
 
 from copy import copy
@@ -123,12 +124,30 @@ class Command(object):
         self.cmd = cmd
         self.cwd = cwd
     
-    def execute(self):
+    def execute(self, timeout=None):
+        '''
+        Run the command and wait for its completion.
+
+        @param timeout: time in seconds after which the command and all its
+                        subprocesses are killed
+        @return: tuple (output, return code)
+        '''
         LOGGER.debug('Running command: %s' % self.cmd)
+        # with timeout, run in own process group to be able to kill all of it
         proc = subprocess.Popen(self.cmd, shell=True, stdout=subprocess.PIPE,
-                                             cwd=self.cwd)
+                                cwd=self.cwd, preexec_fn=os.setsid \
+                                if timeout is not None else None)
+        timer = None
+        if timeout is not None:
+            timer = threading.Timer(max(timeout, 0), self.kill, [proc])
+            timer.daemon = True
+            timer.start()
+
         stdout = proc.communicate()[0]
         retcode = proc.returncode
+        if timer:
+            timer.cancel()
+            timer.join()
         
         if retcode != 0:
             LOGGER.error('Command returned with non-zero exit code: %s' % retcode)
@@ -139,6 +158,13 @@ class Command(object):
         #else: 
             #LOGGER.debug('Command output: \n%s' % output.rstrip('\n'))
         return (output, retcode)
+
+    def kill(self, proc):
+        LOGGER.error('Command timed out: %s' % self.cmd)
+        try:
+            os.killpg(proc.pid, signal.SIGKILL)
+        except OSError:
+            pass
     
 class Logger(object):
     '''
@@ -32,8 +32,12 @@ try:
     import os
     import socket
     import cherrypy
+    import json
+    import urllib
+    import urlparse
     
     from Utils import Command
+    from datetime import datetime, timedelta
     from Cheetah.Template import Template
     from cherrypy.lib.static import serve_file
 except ImportError, e:
@@ -79,6 +83,8 @@ class WebInterface:
         self.suiteRunPass = ''
         # default page title
         self.title = 'XRootD Testing Framework - Web Interface'
+        # number of runs per page of test suite history
+        self.historyPageSize = 20
         
         # override default web root if specified in config
         if self.config.has_option('webserver', 'webpage_dir'):
@@ -102,6 +108,10 @@ class WebInterface:
         # ..and the suite run password
         if self.config.has_option('webserver', 'suite_run_pass'):
             self.suiteRunPass = self.config.get('webserver', 'suite_run_pass')    
+
+        if self.config.has_option('webserver', 'history_page_size'):
+            self.historyPageSize = \
+                max(1, self.config.getint('webserver', 'history_page_size'))
         
         cherrypy.config.update({'tools.allow.on': True,
                                 'request.error_response': self.handleCherrypyError,
@@ -143,10 +153,10 @@ class WebInterface:
         
     def vars(self):
         '''Return the variables necessary for a webpage template.'''
-        current_run = None
-        if self.testMaster.runningSuite:
-            current_run = self.testMaster.retrieveSuiteSession(self.testMaster.runningSuite.name)
-            
+        running_runs = {}
+        for name in self.testMaster.runningSuites.iterkeys():
+            running_runs[name] = self.testMaster.retrieveSuiteSession(name)
+
         tvars = {   
                     'title' : self.title,
                     'webroot' : self.webroot,
@@ -155,45 +165,116 @@ class WebInterface:
                     'clusters' : self.testMaster.clusters,
                     'hypervisors': self.testMaster.hypervisors,
                     'suite_hist' : self.testMaster.suiteSessions,
-                    'current_run': current_run,
+                    'running_runs': running_runs,
                     'running_suite_uids' : self.testMaster.runningSuiteUids,
+                    'stage_barriers': self.testMaster.stageBarriers,
                     'slaves': self.testMaster.slaves,
                     'hostname': socket.gethostname(),
                     'testsuites': self.testMaster.testSuites,
-                    'pending_jobs': self.testMaster.pendingJobs,
-                    'pending_jobs_dbg': self.testMaster.pendingJobsDbg,
+                    'pending_jobs': self.testMaster.jobQueue,
+                    'pending_jobs_dbg': self.testMaster.jobQueue.debug(),
                     'user_msgs' : self.testMaster.userMsgs,
+                    'event_stats': self.eventStats(),
                     'test_master': self.testMaster, 
                 }
         return tvars
     
-    def ts_vars(self, ts_name):
+    def eventStats(self):
+        '''Return statistics of the master's main loop.'''
+        return self.testMaster.eventStats.toDict(\
+                                        self.testMaster.recvQueue.depth())
+
+    def ts_vars(self, ts_name, run=None, page=None, status=None, since=None,
+                until=None):
+        '''
+        Return the variables of a test suite page. Only one page of the run
+        history is retrieved and only the stage results of the shown run.
+
+        @param ts_name: name of the test suite
+        @param run: uid of the shown run, defaults to the newest one listed
+        @param page: page of the run history, newest runs first
+        @param status: 'success' or 'failure' to list only such runs
+        @param since: list runs started on or after this date (YYYY-MM-DD)
+        @param until: list runs started on or before this date (YYYY-MM-DD)
+        '''
         vars = self.vars()
         vars['testsuite'] = self.testMaster.testSuites[ts_name] \
             if self.testMaster.testSuites.has_key(ts_name) else ts_name
-        
-        inner = []
-        outer = {}
-        all_runs = self.testMaster.retrieveAllSuiteSessions()
-        for key, runs in all_runs.iteritems():
-            for run in runs.itervalues():
-                if run.name == ts_name:
-                    inner.append(run)
-            outer.update({key: sorted(inner, key=lambda x: x.initDate, reverse=True)})
-
-        vars['all_runs'] = outer
+
+        store = self.testMaster.suiteSessions
+        failed = {'success': False, 'failure': True}.get(status)
+        sinceDate = self.parseDate(since)
+        untilDate = self.parseDate(until)
+        if untilDate:
+            untilDate += timedelta(days=1)
+
+        total = store.count(ts_name, sinceDate, untilDate)
+        failedRuns = store.count(ts_name, sinceDate, untilDate, True)
+        listed = total
+        if failed is not None:
+            listed = failedRuns if failed else total - failedRuns
+
+        pages = max(1, (listed + self.historyPageSize - 1) / \
+                       self.historyPageSize)
+        try:
+            page = min(max(1, int(page)), pages)
+        except (TypeError, ValueError):
+            page = 1
+
+        runs = store.query(ts_name, sinceDate, untilDate, failed,
+                           (page - 1) * self.historyPageSize,
+                           self.historyPageSize)
+
+        # stage results only of the shown run
+        shown = None
+        if not run and runs:
+            run = runs[0].uid
+        if run:
+            shown = self.testMaster.retrieveSuiteSession(ts_name)
+            if not shown or shown.uid != run:
+                shown = store.get(run)
+            if shown and shown.name != ts_name:
+                shown = None
+
+        histFilter = {'status': status if failed is not None else '',
+                      'since': since if sinceDate else '',
+                      'until': until if untilDate else ''}
+        vars['run_hist'] = runs
+        vars['run_shown'] = [shown] if shown else []
+        vars['success_runs'] = total - failedRuns
+        vars['failed_runs'] = failedRuns
+        vars['hist_page'] = page
+        vars['hist_pages'] = pages
+        vars['hist_filter'] = histFilter
+        # query string of the filter, for links to other runs and pages
+        vars['hist_query'] = urllib.urlencode(\
+                        [(k, v) for (k, v) in sorted(histFilter.items()) if v])
         return vars
 
+    def parseDate(self, date):
+        '''
+        @param date: date in YYYY-MM-DD format
+        @return: datetime object or None if date is empty or invalid
+        '''
+        if not date:
+            return None
+        try:
+            return datetime.strptime(date, '%Y-%m-%d')
+        except ValueError:
+            LOGGER.debug('Invalid date in history query: %s' % date)
+            return None
+
     @cherrypy.expose
     def index(self):
         cherrypy.tools.allow.callable()
         return self.disp("index.html", self.vars())
     
     @cherrypy.expose
-    def testsuites(self, ts_name=None):
+    def testsuites(self, ts_name=None, run=None, page=None, status=None,
+                   since=None, until=None):
         cherrypy.tools.allow.callable()
         if ts_name:
-            vars = self.ts_vars(ts_name)
+            vars = self.ts_vars(ts_name, run, page, status, since, until)
             return self.disp("testsuite.html", vars)
         else:
             return self.disp("testsuites.html", self.vars())
@@ -232,6 +313,34 @@ class WebInterface:
         cherrypy.tools.allow.callable()
         return self.disp('err/unsupported.html', {})
 
+    @cherrypy.expose
+    def stats(self):
+        '''
+        Statistics of the master's main loop in JSON: queue depth, time
+        events wait in the queue and handler latencies.
+        '''
+        cherrypy.tools.allow.callable()
+        cherrypy.response.headers['Content-Type'] = 'application/json'
+        return json.dumps(self.eventStats(), indent=2, sort_keys=True)
+
+    @cherrypy.expose
+    def output(self, digest=None):
+        '''
+        Stream a stage output or log stored in the session store as text.
+
+        @param digest: digest of the output
+        '''
+        cherrypy.tools.allow.callable()
+        chunks = None
+        if digest:
+            chunks = self.testMaster.suiteSessions.blob(digest)
+        if chunks is None:
+            raise cherrypy.HTTPError(404)
+
+        cherrypy.response.headers['Content-Type'] = 'text/plain'
+        return chunks
+    output._cp_config = {'response.stream': True}
+
     @cherrypy.expose
     def downloadScript(self, *script_name):
         '''
@@ -403,9 +512,13 @@ class WebInterface:
         if '#' in path:
             path = path.split('#')[0]
 
-        file = path.split(os.sep)[-1]
+        url = urlparse.urlparse(path)
+        file = url.path.split(os.sep)[-1]
         if file in self.testMaster.testSuites.keys():
-            vars.update(self.ts_vars(file))
+            query = dict(urlparse.parse_qsl(url.query))
+            vars.update(self.ts_vars(file, query.get('run'),
+                                     query.get('page'), query.get('status'),
+                                     query.get('since'), query.get('until')))
             file = 'testsuite'
         
         if not file: file = 'index'
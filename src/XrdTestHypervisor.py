@@ -106,6 +106,15 @@ class XrdTestHypervisor(Runnable):
         # Blocking queue of commands received from XrdTestMaster
         self.recvQueue = Queue.Queue()
         self.stopEvent = threading.Event()
+        # Clusters with a command being handled, commands of different
+        # clusters running in parallel. Key: cluster name, Value: list of
+        # commands waiting for the one being handled
+        self.clusterCommands = {}
+        # Threads handling the commands. Key: cluster name
+        self.clusterCommandThreads = {}
+        # Cleared while clusters are being torn down
+        self.acceptClusterCommands = True
+        self.clusterCommandsLock = threading.Lock()
         # Reference to cluster manager, which is abstraction layer to 
         # virtualization library - in our case libvirt
         self.clusterManager = ClusterManager()
@@ -113,6 +122,15 @@ class XrdTestHypervisor(Runnable):
         if self.config.has_option('virtual_machines', 'storage_pool'):
             self.storagePool = self.config.get('virtual_machines', 'storage_pool')
         self.clusterManager.storagePool = self.storagePool
+        if self.config.has_option('virtual_machines', 'provision_workers'):
+            self.clusterManager.provisionWorkers = self.config.getint(
+                                    'virtual_machines', 'provision_workers')
+        if self.config.has_option('virtual_machines', 'shutdown_timeout'):
+            self.clusterManager.shutdownTimeout = self.config.getint(
+                                    'virtual_machines', 'shutdown_timeout')
+        if self.config.has_option('virtual_machines', 'storage_cache_ttl'):
+            self.clusterManager.storageCatalog.ttl = self.config.getint(
+                                    'virtual_machines', 'storage_cache_ttl')
 
     def __del__(self):
         ''' TODO: '''
@@ -132,6 +150,7 @@ class XrdTestHypervisor(Runnable):
                 thTcpReceive = threading.Thread(target=tcpReceiveTh.run)
                 thTcpReceive.start()
                 self.clusterManager.sockStream = self.sockStream  
+                self.sendCapacity()
                 return sock
             time.sleep(5)
         return None
@@ -255,11 +274,153 @@ class XrdTestHypervisor(Runnable):
 
         return resp
 
+    def handleResetCluster(self, msg):
+        '''
+        Handle reset cluster message from a master - reset a running cluster
+        to keep it warm, or revert it to the snapshot given in the message.
+        A cluster which can not be reset to keep it warm is removed.
+        '''
+        resp = XrdMessage(XrdMessage.M_CLUSTER_STATE)
+        resp.clusterName = msg.clusterDef.name
+        resp.snapshot = getattr(msg, 'snapshot', None)
+
+        try:
+            self.clusterManager.resetCluster(resp.clusterName, resp.snapshot)
+            if resp.snapshot:
+                resp.state = State(Cluster.S_WAITING_SLAVES)
+            else:
+                resp.state = State(Cluster.S_IDLE)
+        except ClusterManagerException, e:
+            LOGGER.error("Error occured during cluster reset: %s" % e)
+            if resp.snapshot:
+                resp.state = State(Cluster.S_ERROR, e)
+                return resp
+            try:
+                self.clusterManager.removeCluster(resp.clusterName)
+            except ClusterManagerException, e2:
+                LOGGER.error("Error occured: %s" % e2)
+            resp.state = State(Cluster.S_ERROR_STOP, e)
+
+        return resp
+
+    def handleSnapshotCluster(self, msg):
+        '''
+        Handle snapshot cluster message from a master - take a snapshot of
+        a running cluster. The cluster stays active even if it fails, it
+        just can not be reverted to the snapshot.
+        '''
+        resp = XrdMessage(XrdMessage.M_CLUSTER_STATE)
+        resp.clusterName = msg.clusterDef.name
+        resp.snapshot = msg.snapshot
+        resp.snapshotTaken = False
+
+        try:
+            self.clusterManager.snapshotCluster(resp.clusterName,
+                                                resp.snapshot)
+            resp.snapshotTaken = True
+            resp.state = State(Cluster.S_ACTIVE)
+        except ClusterManagerException, e:
+            LOGGER.error("Error occured during cluster snapshot: %s" % e)
+            resp.state = State(Cluster.S_ACTIVE, e)
+
+        return resp
+
+    def handleClusterCommand(self, msg):
+        '''
+        Handle a command concerning a cluster and send the answer to the
+        master, followed by resources of this hypervisor if they changed.
+        '''
+        if msg.name == XrdMessage.M_START_CLUSTER:
+            resp = self.handleStartCluster(msg)
+        elif msg.name == XrdMessage.M_STOP_CLUSTER:
+            resp = self.handleStopCluster(msg)
+        elif msg.name == XrdMessage.M_RESET_CLUSTER:
+            resp = self.handleResetCluster(msg)
+        else:
+            resp = self.handleSnapshotCluster(msg)
+
+        self.send(resp)
+        LOGGER.debug("Sent msg: " + str(resp))
+
+        # resources changed with clusters started or stopped
+        if msg.name != XrdMessage.M_SNAPSHOT_CLUSTER:
+            self.sendCapacity()
+
+    def runClusterCommands(self, clusterName, msg):
+        '''
+        Handle commands of a cluster one after another, until there are no
+        more of them queued. Run in a thread of its own.
+        '''
+        while msg:
+            try:
+                self.handleClusterCommand(msg)
+            except SocketDisconnectedError, e:
+                # the receiving thread reconnects
+                LOGGER.error(e)
+            except Exception, e:
+                LOGGER.exception(e)
+
+            self.clusterCommandsLock.acquire()
+            try:
+                if self.clusterCommands[clusterName]:
+                    msg = self.clusterCommands[clusterName].pop(0)
+                else:
+                    del self.clusterCommands[clusterName]
+                    del self.clusterCommandThreads[clusterName]
+                    msg = None
+            finally:
+                self.clusterCommandsLock.release()
+
+    def dispatchClusterCommand(self, msg):
+        '''
+        Handle a command concerning a cluster in the background, so that
+        clusters are started and stopped in parallel. Commands of the same
+        cluster are handled in order of arrival.
+        '''
+        clusterName = msg.clusterDef.name
+        self.clusterCommandsLock.acquire()
+        try:
+            if not self.acceptClusterCommands:
+                LOGGER.warning("Clusters being removed, ignoring %s of " \
+                               "cluster %s" % (msg.name, clusterName))
+                return
+            if self.clusterCommands.has_key(clusterName):
+                self.clusterCommands[clusterName].append(msg)
+                return
+            self.clusterCommands[clusterName] = []
+            th = threading.Thread(target=self.runClusterCommands,
+                                  args=(clusterName, msg))
+            th.daemon = True
+            self.clusterCommandThreads[clusterName] = th
+            th.start()
+        finally:
+            self.clusterCommandsLock.release()
+
+    def drainClusterCommands(self):
+        '''
+        Stop accepting cluster commands and wait until the ones already
+        received are handled, so that no cluster is being started or
+        stopped while all of them are removed.
+        '''
+        self.clusterCommandsLock.acquire()
+        try:
+            self.acceptClusterCommands = False
+            threads = self.clusterCommandThreads.values()
+        finally:
+            self.clusterCommandsLock.release()
+
+        if threads:
+            LOGGER.info("Waiting for commands of %d cluster(s) to finish." \
+                        % len(threads))
+        for th in threads:
+            th.join()
+
     def recvLoop(self):
         '''
         Main loop processing messages from master. It take out jobs
         from blocking queue of received messages, runs appropriate and
-        return answer message.
+        return answer message. Commands concerning clusters are handed
+        to threads, one per cluster.
         '''
         while not self.stopEvent.isSet():
             try:
@@ -275,18 +436,21 @@ class XrdTestHypervisor(Runnable):
                 resp = XrdMessage(XrdMessage.M_UNKNOWN)
                 if msg.name is XrdMessage.M_HELLO:
                     resp = XrdMessage(XrdMessage.M_HELLO)
-                elif msg.name == XrdMessage.M_START_CLUSTER:
-                    resp = self.handleStartCluster(msg)
-                elif msg.name == XrdMessage.M_STOP_CLUSTER:
-                    resp = self.handleStopCluster(msg)
+                elif msg.name in (XrdMessage.M_START_CLUSTER,
+                                  XrdMessage.M_STOP_CLUSTER,
+                                  XrdMessage.M_RESET_CLUSTER,
+                                  XrdMessage.M_SNAPSHOT_CLUSTER):
+                    self.dispatchClusterCommand(msg)
+                    continue
                 elif msg.name == XrdMessage.M_DISCONNECT:
                     #undefine and remove all running machines
+                    self.drainClusterCommands()
                     self.clusterManager.disconnect()
                     break
                 else:
                     LOGGER.info("Received unknown message: " + str(msg.name))
 
-                self.sockStream.send(resp)
+                self.send(resp)
                 LOGGER.debug("Sent msg: " + str(resp))
             except SocketDisconnectedError, e:
                 LOGGER.error(e)
@@ -295,7 +459,8 @@ class XrdTestHypervisor(Runnable):
                 # Try to reconnect
                 self.tryConnect()
                 
-                # Remove clusters
+                # Remove clusters, once commands being handled are done
+                self.drainClusterCommands()
                 if self.clusterManager:
                     clusters = self.clusterManager.clusters.keys()
                     for cluster in clusters:
@@ -304,6 +469,7 @@ class XrdTestHypervisor(Runnable):
                         self.clusterManager.disconnect()
                     except ClusterManagerException, e:
                         LOGGER.error(e)
+                self.acceptClusterCommands = True
 
     def run(self):
         '''
@@ -333,12 +499,34 @@ class XrdTestHypervisor(Runnable):
                 raise XrdTestHypervisorException("Config file %s could not be read" % confFile)
             return config
         
+    def sendCapacity(self):
+        '''
+        Send resources of this hypervisor to the master, which places
+        clusters according to them.
+        '''
+        msg = XrdMessage(XrdMessage.M_HYPERVISOR_STATE)
+        msg.state = None
+        msg.capacity = self.clusterManager.getCapacity()
+        LOGGER.info("Sending capacity: %s" % msg.capacity)
+        self.send(msg)
+
+    def send(self, msg):
+        '''
+        Send a message to the master. Messages are sent by several threads,
+        so they are serialized not to interleave on the connection.
+        '''
+        self.clusterManager.sendLock.acquire()
+        try:
+            self.sockStream.send(msg)
+        finally:
+            self.clusterManager.sendLock.release()
+
     def updateState(self, state, clusterName):
         ''' Send a progress update message to the master. '''
         msg = XrdMessage(XrdMessage.M_CLUSTER_STATE)
         msg.state = State(state)
         msg.clusterName = clusterName
-        self.sockStream.send(msg)
+        self.send(msg)
 
 def main():
     '''
@@ -37,23 +37,28 @@ try:
     import logging
     import sys
     import ConfigParser
-    import random
     import os
     import socket
     import threading
     import shelve
     import cherrypy
     import re
+    import Queue
+    import time
 
     from XrdTest.ClusterUtils import ClusterManagerException, extractClusterName, \
-        loadClusterDef, loadClustersDefs, Cluster
+        isClusterDefFile, loadClusterFile, loadClustersDefs, Cluster, Disk
     from XrdTest.SocketUtils import XrdMessage, PriorityBlockingQueue
     from XrdTest.TCPServer import MasterEvent, ThreadedTCPRequestHandler, \
         ThreadedTCPServer
-    from XrdTest.TCPClient import TCPClient, Hypervisor, Slave
+    from XrdTest.TCPClient import TCPClient, Hypervisor, Slave, SlaveRegistry
     from XrdTest.TestUtils import TestSuiteException, TestSuite, TestSuiteSession, \
-        loadTestSuiteDef, loadTestSuiteDefs, extractSuiteName
-    from XrdTest.Job import Job
+        StageBarrier, loadTestSuiteDir, loadTestSuiteDefs
+    from XrdTest.Job import Job, JobQueue
+    from XrdTest.DefinitionCache import DefinitionCache
+    from XrdTest.SessionStore import SessionStore, SessionStoreException
+    from XrdTest.EventStats import EventLoopStats
+    from XrdTest.ClusterPool import ClusterPool
     from XrdTest.Daemon import Runnable, Daemon, DaemonException
     from XrdTest.Utils import State, redirectOutput, Command
     from XrdTest.GitUtils import sync_remote_git
@@ -109,32 +114,74 @@ class XrdTestMaster(Runnable):
         # Priority queue (locking) with incoming events, i.a. incoming messages
         # Referred to as: main events queue.
         self.recvQueue = PriorityBlockingQueue()
+        # Maximum number of events taken from the queue in one pass
+        self.eventBatchSize = 100
+        # Statistics of the main loop: queue waits, handler latencies
+        self.eventStats = None
         # Connected hypervisors, keys: address tuple, values: Hypervisor object
         self.hypervisors = {}
-        # Connected slaves, keys: address tuple, values: Slave object
-        self.slaves = {}
-        # TestSuites that have ever run, synchronized with a HDD, key is session.uid
+        # Connected slaves, keys: address tuple, values: Slave object.
+        # Also indexed by hostname, state and test suite.
+        self.slaves = SlaveRegistry()
+        # TestSuites that have ever run, stored in a database, key is session.uid
         self.suiteSessions = None
-        # Currently running test suite object, if any.
-        self.runningSuite = None
-        # Mapping from names to uids of running test suits. For retrieval of 
-        # TestSuiteSessions saved in suiteSessions python shelve. 
+        # Sessions of the latest runs kept in memory, key is suite name
+        self.liveSessions = {}
+        # Cache of loaded definitions, synchronized with a HDD
+        self.definitionCache = None
+        # Barriers of stages sent to slaves and not yet finished. Key: suite
+        # name, value: dictionary keyed by (job type, test name).
+        self.stageBarriers = {}
+        # Currently running test suites. Key: suite name, Value: id of the
+        # job group running it. Suites not sharing any cluster run at once.
+        self.runningSuites = {}
+        # Mapping from names to uids of running test suits. For retrieval of
+        # TestSuiteSessions saved in suiteSessions database.
         self.runningSuiteUids = {}
+        # Timeout jobs of running test suites. Key: suite name, Value: job
+        # object returned by the scheduler.
+        self.suiteTimeouts = {}
+        # Job group holding a cluster, from the moment the start command is
+        # sent until the cluster is reported stopped. Key: cluster.name
+        # Value: job group id
+        self.clusterOwners = {}
         # Definitions of clusters loaded from a file, key is cluster.name
         # Refreshed any time definitions change.
         self.clusters = {}
-        # Which hypervisor run given cluster. Key: cluster.name Value: Hypervisor
-        # object
-        self.clustersHypervisor = {}
+        # Which hypervisors run given cluster, more than one if the cluster
+        # is split. Key: cluster.name Value: list of Hypervisor objects
+        self.clusterHypervisors = {}
+        # Addresses of hypervisors running parts of a split cluster which
+        # have not yet reported the state awaited: all parts waiting for
+        # slaves after a start, all parts stopped after a stop.
+        # Key: cluster.name Value: set of addresses
+        self.clusterPartsPending = {}
+        # Warm clusters kept running between leases to job groups
+        self.clusterPool = None
+        # Whether clusters of scheduled test suites are started ahead of
+        # time, the start duration assumed for clusters never started and
+        # seconds a cluster started ahead is kept after the scheduled time
+        self.prestartEnabled = True
+        self.prestartEstimate = 600
+        self.prestartTimeout = 900
+        # Scheduled run a cluster was last started ahead for, so that it is
+        # started once per run. Key: cluster.name Value: time of the run
+        self.prestartedRuns = {}
+        # Whether snapshots of clusters are taken, to reset them quickly
+        self.clusterSnapshotsEnabled = True
+        # Snapshots taken of running clusters, in order of taking, None if
+        # they can not be taken. Key: cluster.name Value: list of names
+        self.clusterSnapshots = {}
+        # States slaves connect in again after their cluster was reverted
+        # to a snapshot taken during a test suite. Key: slave hostname
+        self.restoredSlaveStates = {}
         # Definitions of test suits loaded from file. Key: testSuite.name 
         # Value: testSuite.definition. Refreshed any time definitions chagne.
         self.testSuites = {}
         # Definitions of all directories being monitored for changes.
         self.watchedDirectories = {}
         # Jobs to run immediately if possible. They are put here by scheduler.
-        self.pendingJobs = []
-        # The same as above, for debugging. Keeps textual representation of jobs.
-        self.pendingJobsDbg = []
+        self.jobQueue = JobQueue()
         # message logging system
         self.userMsgs = []
         # tasks scheduler only instance
@@ -160,233 +207,520 @@ class XrdTestMaster(Runnable):
         LOGGER.info("Using config file: %s" % configFile)
 
         self.loadSuiteSessions()
+        self.loadDefinitionCache()
+        self.loadEventStats()
+        self.loadClusterPool()
+
+    def loadEventStats(self):
+        '''
+        Set up statistics of the main loop with thresholds of slow handler
+        logging and of the backlog alarm from the config.
+        '''
+        slowHandler = EventLoopStats.SLOW_HANDLER
+        backlogAlarm = EventLoopStats.BACKLOG_ALARM
+        if self.config.has_option('general', 'slow_event_threshold'):
+            slowHandler = self.config.getfloat('general',
+                                               'slow_event_threshold')
+        if self.config.has_option('general', 'event_backlog_alarm'):
+            backlogAlarm = self.config.getint('general', 'event_backlog_alarm')
+        self.eventStats = EventLoopStats(slowHandler, backlogAlarm)
+
+    def loadClusterPool(self):
+        '''
+        Set up the pool of warm clusters with its idle timeout and size from
+        the config, and whether clusters are reset by snapshots.
+        '''
+        idleTimeout = ClusterPool.IDLE_TIMEOUT
+        maxIdle = ClusterPool.MAX_IDLE
+        if self.config.has_option('general', 'cluster_idle_timeout'):
+            idleTimeout = self.config.getint('general', 'cluster_idle_timeout')
+        if self.config.has_option('general', 'cluster_pool_size'):
+            maxIdle = self.config.getint('general', 'cluster_pool_size')
+        self.clusterPool = ClusterPool(idleTimeout, maxIdle)
+        if self.config.has_option('general', 'cluster_snapshots'):
+            self.clusterSnapshotsEnabled = self.config.getboolean('general',
+                                                        'cluster_snapshots')
+        if self.config.has_option('general', 'cluster_prestart'):
+            self.prestartEnabled = self.config.getboolean('general',
+                                                          'cluster_prestart')
+        if self.config.has_option('general', 'cluster_start_estimate'):
+            self.prestartEstimate = self.config.getint('general',
+                                                'cluster_start_estimate')
+        if self.config.has_option('general', 'cluster_prestart_timeout'):
+            self.prestartTimeout = self.config.getint('general',
+                                                'cluster_prestart_timeout')
+        # Clusters started ahead wait in the pool
+        self.prestartEnabled = self.prestartEnabled and \
+                               self.clusterPool.enabled
+
+    def loadDefinitionCache(self):
+        '''
+        Open the cache of definitions, by default placed next to the suite
+        sessions file.
+        '''
+        if self.config.has_option('general', 'definition_cache_file'):
+            path = self.config.get('general', 'definition_cache_file')
+        elif self.config.has_option('general', 'suite_sessions_file'):
+            path = os.path.join(os.path.dirname(\
+                        self.config.get('general', 'suite_sessions_file')),
+                        'definition_cache.bin')
+        else:
+            LOGGER.error('Cannot open definition cache file.')
+            return
+        self.definitionCache = DefinitionCache(path)
 
     def loadSuiteSessions(self):
-        if self.config.has_option('general', 'suite_sessions_file'):
-                self.suiteSessions = shelve.open(\
-                             self.config.get('general', 'suite_sessions_file'))
+        '''
+        Open the database of test suite sessions, by default placed next to
+        the suite_sessions_file. Sessions from python shelves used by older
+        versions are imported into the database, again at the next start if
+        the import did not complete.
+        '''
+        if self.config.has_option('general', 'suite_results_db'):
+            path = self.config.get('general', 'suite_results_db')
+        elif self.config.has_option('general', 'suite_sessions_file'):
+            path = os.path.join(os.path.dirname(\
+                        self.config.get('general', 'suite_sessions_file')),
+                        'suite_results.db')
         else:
             LOGGER.error('Cannot open suite session storage file.')
+            return
 
-    def archiveSuiteSessions(self):
-        self.suiteSessions.sync()
-        self.suiteSessions.close()
-        self.suiteSessions = None
+        try:
+            self.suiteSessions = SessionStore(path)
+        except SessionStoreException, e:
+            LOGGER.error(str(e))
+            return
+
+        if not self.suiteSessions.imported and \
+            self.config.has_option('general', 'suite_sessions_file'):
+            if self.importSuiteSessions(\
+                        self.config.get('general', 'suite_sessions_file')):
+                self.suiteSessions.setImported()
+
+    def importSuiteSessions(self, active):
+        '''
+        Import sessions from a python shelve and its archives. Sessions
+        imported before are stored again without duplicating their stage
+        results, so an interrupted import is resumed by running it again.
 
-        active = self.config.get('general', 'suite_sessions_file')
+        @param active: path of the shelve file
+        @return: True if sessions of all the files were imported
+        '''
+        path = os.path.dirname(active) or '.'
+        prefix = os.path.basename(active)
+        if not os.path.isdir(path):
+            return True
 
-        archive = '%s.%s' % (active, datetime.now().strftime('%d%m%y-%H%M%S'))
-        os.rename(active, archive)
+        # dbm modules without a single file format add suffixes
+        names = set()
+        for f in os.listdir(path):
+            if f.startswith(prefix):
+                names.add(re.sub(r'\.(dat|dir|bak)$', '', f))
 
-        self.suiteSessions = shelve.open(active)
+        complete = True
+        for f in sorted(names):
+            try:
+                s = shelve.open(os.path.join(path, f), 'r')
+                for tss in s.itervalues():
+                    self.suiteSessions.store(tss)
+                    self.suiteSessions.forget(tss.uid)
+                LOGGER.info('Imported %d suite sessions from %s' % \
+                            (len(s), f))
+                s.close()
+            except Exception, e:
+                LOGGER.error('Cannot import suite sessions from %s: %s' % \
+                             (f, e))
+                complete = False
+        return complete
 
     def retrieveSuiteSession(self, suite_name):
         '''
-        Retrieve test suite session from shelve self.suiteSessions
+        Retrieve the latest test suite session of a suite.
         @param suite_name:
         '''
+        uid = self.runningSuiteUids.get(suite_name)
+        if not uid:
+            return None
+
+        tss = self.liveSessions.get(suite_name)
+        if tss and tss.uid == uid:
+            return tss
         try:
-            if self.runningSuiteUids.has_key(suite_name) and \
-               self.suiteSessions.has_key(self.runningSuiteUids[suite_name]):
-                    return self.suiteSessions[self.runningSuiteUids[suite_name]]
-            else:
-                return None
+            return self.suiteSessions.get(uid)
         except Exception, e:
                 LOGGER.error('Suite history database corruption, ' + \
                              '(delete suite history file): %s' % e)
 
-    def retrieveAllSuiteSessions(self):
-        all = {}
-
-        active = self.config.get('general', 'suite_sessions_file')
-        path = os.sep.join(active.split(os.sep)[:-1])
-        prefix = active.split(os.sep)[-1:][0]
-
-        for f in os.listdir(path):
-            if f.startswith(prefix):
-                s = shelve.open(os.path.join(path, f))
-                all.update({f:s})
-
-        return all
-
     def storeSuiteSession(self, test_suite_session):
         '''
-        Save test suite session to python shelve self.suiteSessions
+        Save test suite session to the database self.suiteSessions. Only the
+        stage results added since it was stored last time are written.
         @param test_suite_session:
         '''
-        print len(self.suiteSessions)
-        if len(self.suiteSessions) > 30:
-            self.archiveSuiteSessions()
-
         self.runningSuiteUids[test_suite_session.name] = test_suite_session.uid
-        self.suiteSessions[test_suite_session.uid] = test_suite_session
-        self.suiteSessions.sync()
+        self.liveSessions[test_suite_session.name] = test_suite_session
+        self.suiteSessions.store(test_suite_session)
+        if not self.runningSuites.has_key(test_suite_session.name):
+            # stored once the run ended
+            self.suiteSessions.forget(test_suite_session.uid)
 
-    def fireReloadDefinitionsEvent(self, type, dirEvent=None):
+    def fireReloadDefinitionsEvent(self, type, paths=None):
         '''
         Any time something is changed in the directory with config files,
-        it puts proper event into main events queue.
-        @param type:
-        @param dirEvent:
+        it puts proper event into main events queue. Changes coming in a burst
+        are batched by the directory watch, so the event carries all the
+        paths changed.
+        @param type: CLUSTER or SUITE
+        @param paths: list of changed paths
         '''
         evt = None
         if type == "CLUSTER":
-            evt = MasterEvent(MasterEvent.M_RELOAD_CLUSTER_DEF, dirEvent)
+            evt = MasterEvent(MasterEvent.M_RELOAD_CLUSTER_DEF, paths)
         if type == "SUITE":
-            evt = MasterEvent(MasterEvent.M_RELOAD_SUITE_DEF, dirEvent)
+            evt = MasterEvent(MasterEvent.M_RELOAD_SUITE_DEF, paths)
         self.recvQueue.put((MasterEvent.PRIO_IMPORTANT, evt))
 
+    def getRepos(self):
+        '''
+        Get names of config sections of all test repositories.
+        '''
+        return ['test-repo-' + repo.strip() for repo in \
+                self.config.get('general', 'test-repos').split(',') \
+                if repo.strip()]
+
+    def getDefinitionPaths(self, repo):
+        '''
+        Get directories of cluster and test suite definitions of a repository.
+
+        @param repo: config section of the repository
+        @return: tuple (clusters directory, test suites directory), any of them
+                 may be None if not found
+        '''
+        clustDefPath = suiteDefPath = None
+
+        if self.config.has_option(repo, 'local_path'):
+            localPath = self.config.get(repo, 'local_path')
+        else:
+            LOGGER.error('No local path defined for repository %s' % repo)
+            return (clustDefPath, suiteDefPath)
+
+        if self.config.has_option(repo, 'cluster_defs_path'):
+            clustDefPath = os.path.join(localPath, self.config.get(repo, 'cluster_defs_path'))
+        elif os.path.exists(os.path.join(localPath, 'clusters')):
+            clustDefPath = os.path.join(localPath, 'clusters')
+        else:
+            LOGGER.error('No cluster definitions found for repository %s' % repo)
+
+        if self.config.has_option(repo, 'suite_defs_path'):
+            suiteDefPath = os.path.join(localPath, self.config.get(repo, 'suite_defs_path'))
+        elif os.path.exists(os.path.join(localPath, 'test-suites')):
+            suiteDefPath = os.path.join(localPath, 'test-suites')
+        else:
+            LOGGER.error('No test suite definitions found for repository %s' % repo)
+
+        return (clustDefPath, suiteDefPath)
+
     def loadDefinitions(self):
         '''
         Load all definitions of example clusters and test suites at once.
-        If any definitions are invalid, raise exceptions.
+        Remote git repositories are synchronized concurrently. Definitions
+        are loaded in the order of test-repos, those of each repository as
+        soon as it is synchronized, so that a repository listed later
+        overrides definitions of the same name whatever the timing.
         '''
         LOGGER.info("Loading definitions...")
 
-        for repo in map(lambda x: x.strip(), filter(lambda x: x, self.config.get('general', 'test-repos').split(','))):
-            repo = 'test-repo-' + repo
-            LOGGER.info('Setting up repository %s' % repo)
+        repos = self.getRepos()
+        gitRepos = [repo for repo in repos \
+                    if self.config.get(repo, 'type') == 'git']
+
+        synced = dict([(repo, threading.Event()) for repo in gitRepos])
+        if gitRepos:
+            deadline = self.syncRepos(gitRepos, synced)
+
+        incomplete = []
+        # Repository each definition was loaded from. Key: (kind, name)
+        origins = {}
+        for repo in repos:
+            if repo in gitRepos:
+                synced[repo].wait(max(0, deadline - time.time()))
+                if not synced[repo].isSet():
+                    LOGGER.error(('Repository %s not synchronized in ' + \
+                                  'time, using its local copy') % repo)
+            incomplete.extend(self.loadRepoDefinitions(repo, origins))
+
+        # Suites may use clusters of repositories loaded after them
+        for ts in incomplete:
+            if self.testSuites.get(ts.name) is ts:
+                try:
+                    ts.checkIfDefComplete(self.clusters)
+                    ts.state = State(TestSuite.S_DEF_OK)
+                except TestSuiteException:
+                    pass
 
-            # Pull remote git repo if necessary
-            if self.config.get(repo, 'type') == 'git':
-                sync_remote_git(repo, self.config)
+        # Forget definitions which no longer exist
+        if self.definitionCache:
+            self.definitionCache.prune()
 
-            if self.config.has_option(repo, 'local_path'):
-                localPath = self.config.get(repo, 'local_path')
-                LOGGER.info('Using local path %s for test repository %s' % (localPath, repo))
-            else:
-                LOGGER.error('No local path defined for repository %s' % repo)
+    def syncRepos(self, repos, synced):
+        '''
+        Start synchronizing remote git repositories in a pool of worker
+        threads. Each synchronization is limited by a timeout, after which
+        the local copy of the repository is used as it is.
 
-            try:
-                # load cluster definitions
-                if self.config.has_option(repo, 'cluster_defs_path'):
-                    clustDefPath = os.path.join(localPath, self.config.get(repo, 'cluster_defs_path'))
-                elif os.path.exists(os.path.join(localPath, 'clusters')):
-                    clustDefPath = os.path.join(localPath, 'clusters')
-                else:
-                    LOGGER.error('No cluster definitions found for repository %s' % repo)
+        @param repos: config sections of the repositories
+        @param synced: events set by the workers, Key: repository
+        @return: time by which all synchronizations should have ended
+        '''
+        workers = 4
+        if self.config.has_option('general', 'repo_sync_workers'):
+            workers = self.config.getint('general', 'repo_sync_workers')
+        workers = max(1, min(workers, len(repos)))
+        timeout = 120.0
+        if self.config.has_option('general', 'repo_sync_timeout'):
+            timeout = self.config.getfloat('general', 'repo_sync_timeout')
 
-                clusters = loadClustersDefs(clustDefPath)
-                for clu in clusters:
-                    self.clusters[clu.name] = clu
-            except ClusterManagerException, e:
-                LOGGER.error("ClusterManager Exception: %s" % e)
+        pending = Queue.Queue()
+        for repo in repos:
+            pending.put(repo)
+
+        for i in range(workers):
+            t = threading.Thread(target=self.syncReposWorker,
+                                 args=(pending, synced, timeout))
+            t.daemon = True
+            t.start()
+
+        # every worker synchronizes its share of repositories one after
+        # another, 10 seconds of slack cover killing the git commands
+        rounds = (len(repos) + workers - 1) / workers
+        return time.time() + rounds * timeout + 10
+
+    def syncReposWorker(self, pending, synced, timeout):
+        '''
+        Synchronize repositories from the pending queue until it's empty.
+
+        @param pending: queue of repositories to synchronize
+        @param synced: events to set once a repository is synchronized,
+                       Key: repository
+        @param timeout: time in seconds for synchronization of a repository
+        '''
+        while True:
+            try:
+                repo = pending.get_nowait()
+            except Queue.Empty:
+                return
 
+            LOGGER.info('Synchronizing repository %s' % repo)
             try:
-                # load test suite definitions
-                if self.config.has_option(repo, 'suite_defs_path'):
-                    suiteDefPath = os.path.join(localPath, self.config.get(repo, 'suite_defs_path'))
-                elif os.path.exists(os.path.join(localPath, 'test-suites')):
-                    suiteDefPath = os.path.join(localPath, 'test-suites')
-                else:
-                    LOGGER.error('No test suite definitions found for repository %s' % repo)
-
-                testSuites = loadTestSuiteDefs(suiteDefPath)
-                for ts in testSuites:
-                    try:
-                        ts.checkIfDefComplete(self.clusters)
-                    except TestSuiteException, e:
-                        ts.state = State((-1, e.desc))
-                    self.testSuites[ts.name] = ts
-            except TestSuiteException, e:
-                LOGGER.error("Test Suite Exception: %s" % e)
-                suite = TestSuite()
-                suite.name = ts.name
-                suite.state = State((-1, e.desc))
-                self.testSuites[suite.name] = suite
-
-            # add jobs to scheduler if it's enabled
-            if self.config.getint('scheduler', 'enabled') == 1:
-                for ts in self.testSuites.itervalues():
-                    # if there is no scheduling expression defined in suite, continue
-                    if not ts.schedule:
-                        continue
-                    try:
-                        ts.jobFun = self.executeJob(ts.name)
-                        ts.job = self.sched.add_cron_job(ts.jobFun, \
-                                                 **(ts.schedule))
-
-                        LOGGER.info("Adding scheduler job for test suite %s at %s" % \
-                                    (ts.name, str(ts.schedule)))
-                    except Exception, e:
-                        LOGGER.error(("Error while scheduling job " + \
-                                   "for test suite %s: %s") % (ts.name, e))
-
-    def handleSuiteDefinitionChanged(self, dirEvent):
-        '''
-        Handle event created any time definition of test suite changes.
-        @param dirEvent:
+                sync_remote_git(repo, self.config, timeout)
+            except Exception, e:
+                LOGGER.error('Error synchronizing repository %s: %s' % \
+                             (repo, e))
+            synced[repo].set()
+
+    def loadRepoDefinitions(self, repo, origins):
         '''
-        p = os.path.join(dirEvent.path, dirEvent.name)
+        Load definitions of clusters and test suites of a repository.
 
-        # The APScheduler event masks are highly unreliable. Also, we might want
-        # to have a definition reloaded when a change is made to a non-uniquely
-        # named file, such as suite_init.sh. So, when a change is detected, 
-        # all definitions are reloaded from scratch.
+        @param repo: config section of the repository
+        @param origins: repositories definitions were loaded from so far,
+                        Key: ('cluster' or 'suite', name), updated
+        @return: list of loaded suites which are incomplete, i.e. use
+                 clusters not defined so far
+        '''
+        LOGGER.info('Setting up repository %s' % repo)
+        incomplete = []
 
-        LOGGER.info("Suite definition changed (%s) in %s" % (dirEvent.maskname, p))
+        (clustDefPath, suiteDefPath) = self.getDefinitionPaths(repo)
+        if clustDefPath:
+            LOGGER.info('Loading clusters of %s from %s' % \
+                        (repo, clustDefPath))
+            for clu in loadClustersDefs(clustDefPath, self.definitionCache):
+                self.warnRedefined(origins, 'cluster', clu.name, repo)
+                self.clusters[clu.name] = clu
 
-        for ts in self.testSuites.itervalues():
-            if ts.jobFun:
-                self.sched.unschedule_func(ts.jobFun)
+        if suiteDefPath:
+            LOGGER.info('Loading test suites of %s from %s' % \
+                        (repo, suiteDefPath))
+            for ts in loadTestSuiteDefs(suiteDefPath, self.definitionCache):
+                self.warnRedefined(origins, 'suite', ts.name, repo)
+                if not self.defineSuite(ts):
+                    incomplete.append(ts)
 
-        self.testSuites = dict()
+        return incomplete
 
-        self.loadDefinitions()
+    def warnRedefined(self, origins, kind, name, repo):
+        '''
+        Warn if a definition overrides one of the same name loaded from
+        another repository, and record where it comes from.
+        '''
+        other = origins.get((kind, name))
+        if other and other != repo:
+            LOGGER.warning('Definition of %s %s in %s overrides the one in %s' \
+                           % (kind, name, repo, other))
+        origins[(kind, name)] = repo
+
+    def defineSuite(self, ts):
+        '''
+        Check a loaded test suite against cluster definitions, add it to
+        the defined suites and add its job to the scheduler.
 
+        @param ts: TestSuite object
+        @return: False if the suite uses clusters not defined
+        '''
+        if self.testSuites.has_key(ts.name):
+            self.undefineSuite(self.testSuites[ts.name])
 
-#        (modName, ext, modPath, modFile) = extractSuiteName(p)
-#
-#        if ext != ".py":
-#            return
-#
-#        LOGGER.info("Suit def changed (%s) in %s" % (dirEvent.maskname, p))
-#
-#        remMasks = ["IN_DELETE", "IN_MOVED_FROM"]
-#        addMasks = ["IN_CREATE", "IN_MOVED_TO"]
-#
-#        # if removed of modified do tasks necessary while removing job
-#        if dirEvent.maskname in remMasks or dirEvent.maskname == "IN_MODIFY":
-#            try:
-#                LOGGER.info("Undefining test suite: %s" % modName)
-#                if self.testSuites.has_key(modName):
-#                    # unschedule job connected to this test suite
-#                    if self.testSuites[modName].jobFun:
-#                        self.sched.unschedule_func(\
-#                                                self.testSuites[modName].jobFun)
-#                    # remove module from imports
-#                    del sys.modules[modName]
-#                    # remove testSuite from test suits' definitions
-#                    del self.testSuites[modName]
-#            except TestSuiteException, e:
-#                LOGGER.error("Error while undefining: %s" % str(e))
-#            except Exception, e:
-#                LOGGER.error(("Error while defining test suite %s") % e)
-#
-#        #if file added or modified do tasks necessary while adding jobs
-#        if dirEvent.maskname in addMasks or \
-#            dirEvent.maskname == "IN_MODIFY":
-#            try:
-#                # load single test suite definition
-#                LOGGER.info("Defining test suite: %s" % modName)
-#                suite = loadTestSuiteDef(p)
-#                if suite:
-#                    suite.checkIfDefComplete(self.clusters)
-#                    suite.state = State(TestSuite.S_DEF_OK)
-#                    # add job connected to added test suite
-#                    suite.jobFun = self.executeJob(suite.name)
-#                    self.sched.add_cron_job(suite.jobFun, **(suite.schedule))
-#                    self.testSuites[suite.name] = suite
-#            except TestSuiteException, e:
-#                LOGGER.error("Error while defining: %s" % e)
-#                suite = TestSuite()
-#                suite.name = modName
-#                suite.state = State((-1, e.desc))
-#                self.testSuites[suite.name] = suite
-#            except Exception, e:
-#                # in case of any exception thron e.g. from scheduler
-#                LOGGER.error(("Error while defining " + \
-#                            " test suite %s") % e)
+        complete = True
+        try:
+            ts.checkIfDefComplete(self.clusters)
+        except TestSuiteException, e:
+            ts.state = State((-1, e.desc))
+            complete = False
+        self.testSuites[ts.name] = ts
+
+        # add job to scheduler if it's enabled
+        if self.config.getint('scheduler', 'enabled') != 1:
+            return complete
+        # if there is no scheduling expression defined in suite, return
+        if not ts.schedule:
+            return complete
+        try:
+            ts.jobFun = self.executeJob(ts.name)
+            ts.job = self.sched.add_cron_job(ts.jobFun, **(ts.schedule))
+
+            LOGGER.info("Adding scheduler job for test suite %s at %s" % \
+                        (ts.name, str(ts.schedule)))
+        except Exception, e:
+            LOGGER.error(("Error while scheduling job " + \
+                       "for test suite %s: %s") % (ts.name, e))
+        return complete
+
+    def undefineSuite(self, ts):
+        '''
+        Remove a test suite from defined suites and its job from the scheduler.
+
+        @param ts: TestSuite object
+        '''
+        if ts.job:
+            try:
+                self.sched.unschedule_job(ts.job)
+            except KeyError:
+                pass
+        ts.job = None
+        ts.jobFun = None
+
+        if self.testSuites.get(ts.name) is ts:
+            del self.testSuites[ts.name]
+
+    def reloadSuite(self, tsDir):
+        '''
+        Reload the test suite defined in a directory and reschedule it.
+
+        @param tsDir: directory of the test suite
+        '''
+        for ts in self.testSuites.values():
+            if getattr(ts, 'definitionDir', None) == tsDir:
+                LOGGER.info("Undefining test suite: %s" % ts.name)
+                self.undefineSuite(ts)
+
+        ts = loadTestSuiteDir(tsDir, self.definitionCache)
+        if ts:
+            LOGGER.info("Defining test suite: %s" % ts.name)
+            self.defineSuite(ts)
+
+    def handleSuiteDefinitionChanged(self, paths):
+        '''
+        Handle event created any time definitions of test suites change.
+        Only suites whose directories contain the changed files are reloaded.
+        Any file counts as a change, e.g. suite_init.sh or a test case
+        script, as the inotify event masks are unreliable.
+
+        @param paths: list of changed paths
+        '''
+        LOGGER.info("Suite definitions changed: %s" % ', '.join(paths))
+
+        roots = [os.path.abspath(suiteDefPath) for (_, suiteDefPath) \
+                 in map(self.getDefinitionPaths, self.getRepos()) \
+                 if suiteDefPath]
+
+        tsDirs = set()
+        for p in paths:
+            p = os.path.abspath(p)
+            for root in roots:
+                if p.startswith(root + os.sep):
+                    tsDir = p[len(root) + 1:].split(os.sep)[0]
+                    tsDirs.add(root + os.sep + tsDir)
+
+        for tsDir in sorted(tsDirs):
+            self.reloadSuite(tsDir)
+
+        if self.definitionCache:
+            self.definitionCache.sync()
+
+    def handleClusterDefinitionChanged(self, paths):
+        '''
+        Handle event created any time definitions of clusters change. Only
+        changed clusters and the test suites using them are reloaded.
+
+        @param paths: list of changed paths
+        '''
+        LOGGER.info("Cluster definitions changed: %s" % ', '.join(paths))
+
+        roots = [os.path.abspath(clustDefPath) for (clustDefPath, _) \
+                 in map(self.getDefinitionPaths, self.getRepos()) \
+                 if clustDefPath]
+
+        # Cluster definitions depend on all files of their directory
+        defs = set()
+        for p in paths:
+            p = os.path.abspath(p)
+            (modName, ext, modPath, modFile) = extractClusterName(p)
+            if not modPath in roots:
+                continue
+            if isClusterDefFile(modFile):
+                defs.add(p)
+            elif ext != '.pyc' and os.path.isdir(modPath):
+                defs.update([os.path.join(modPath, f) for f in \
+                             os.listdir(modPath) if isClusterDefFile(f)])
+
+        changed = set()
+        for p in sorted(defs):
+            (modName, ext, modPath, modFile) = extractClusterName(p)
+            changed.add(modName)
+
+            # a warm cluster must not outlive its definition
+            if self.clusterPool.isIdle(modName):
+                self.evictCluster(modName)
+            elif self.clusterHypervisors.has_key(modName):
+                self.clusterPool.invalidate(modName)
+
+            # forget the previous definition, broken or not
+            for name in (modName, modFile + "_BROKEN"):
+                if self.clusters.has_key(name):
+                    LOGGER.info("Undefining cluster: %s" % name)
+                    del self.clusters[name]
+
+            if os.path.isfile(p):
+                LOGGER.info("Defining cluster: %s" % modName)
+                clu = loadClusterFile(p, self.clusters.values(),
+                                      self.definitionCache)
+                if clu:
+                    self.clusters[clu.name] = clu
+
+        # Validity of suites using changed clusters might have changed too
+        tsDirs = set()
+        for ts in self.testSuites.values():
+            if set(ts.clusters) & changed and \
+                hasattr(ts, 'definitionDir'):
+                tsDirs.add(ts.definitionDir)
+
+        for tsDir in sorted(tsDirs):
+            self.reloadSuite(tsDir)
+
+        if self.definitionCache:
+            self.definitionCache.sync()
 
     def checkIfSuitsDefsComplete(self):
         '''
@@ -402,76 +736,27 @@ class XrdTestMaster(Runnable):
         except Exception, e:
             raise TestSuiteException("Error in test suite %s: %s." % (ts.name, e))
 
-    def handleClusterDefinitionChanged(self, dirEvent):
-        '''
-        Handle event created any time definition of cluster changes.
-        @param dirEvent:
-        '''
-        p = os.path.join(dirEvent.path, dirEvent.name)
-
-        LOGGER.info("Cluster definition changed (%s) in %s: " % (dirEvent.maskname, p))
-
-        self.clusters = dict()
-        self.loadDefinitions()
-
-
-#        (modName, ext, modPath, modFile) = extractClusterName(p)
-#
-#        if ext != ".py":
-#            return
-#
-#        LOGGER.info("Cluster def changed (%s) in %s: " % (dirEvent.maskname, p))
-#
-#        remMasks = ["IN_DELETE", "IN_MOVED_FROM"]
-#        addMasks = ["IN_CREATE", "IN_MOVED_TO"]
-#
-#        # cluster definition removed or modified (same things in both cases)
-#        if dirEvent.maskname in remMasks or dirEvent.maskname == "IN_MODIFY":
-#            try:
-#                LOGGER.info("Undefining cluster: %s" % modName)
-#                if self.clusters.has_key(modName):
-#                    # remove module from imports
-#                    del sys.modules[modName]
-#                    # remove cluster definition
-#                    del self.clusters[modName]
-#                # check if after deletion all test suits definitions are valid
-#                self.checkIfSuitsDefsComplete()
-#            except TestSuiteException, e:
-#                LOGGER.error("Error while undefining: %s" % e)
-#                for ts in self.testSuites.itervalues():
-#                    if modName in ts.clusters:
-#                        ts.state = State((-1, e.desc))
-#            except ClusterManagerException, e:
-#                LOGGER.error("Error while undefining: %s" % e)
-#        # cluster definition added or modified (same things in both cases)
-#        if dirEvent.maskname in addMasks or dirEvent.maskname == "IN_MODIFY":
-#            try:
-#                LOGGER.info("Defining cluster: %s" % modName)
-#                clu = loadClusterDef(p, self.clusters.values(), True)
-#                self.clusters[clu.name] = clu
-#                # check if after adding some test suits definitions become valid
-#                self.checkIfSuitsDefsComplete()
-#            except (TestSuiteException, ClusterManagerException), e:
-#                LOGGER.error("Error while defining: %s" % e)
-#                clu = Cluster()
-#                clu.name = modName
-#                clu.state = State((-1, e.desc))
-#                self.clusters[clu.name] = clu
-
-
     def slaveState(self, slave_name):
         '''
         Get state of a slave by its name, even if it's not connected.
         @param slave_name: equal to fully qualified hostname
         '''
-        key = [k for k, v in self.slaves.iteritems() \
-               if slave_name == v.hostname]
-        ret = State(TCPClient.S_NOT_CONNECTED)
-        if len(key):
-            key = key[0]
-        if key:
-            ret = self.slaves[key].state
-        return ret
+        slave = self.slaves.get(slave_name)
+        if slave:
+            return slave.state
+        return State(TCPClient.S_NOT_CONNECTED)
+
+    def suiteState(self, test_suite_name):
+        '''
+        Create the initialized state of a slave in the given test suite. The
+        suite name is set before the state is assigned, so that the slave
+        registry indexes the slave under the suite.
+
+        @param test_suite_name:
+        '''
+        state = State(Slave.S_SUITE_INITIALIZED)
+        state.suiteName = test_suite_name
+        return state
 
     def getSuiteSlaves(self, test_suite, slave_state=None, test_case=None):
         '''
@@ -483,31 +768,15 @@ class XrdTestMaster(Runnable):
         @param slave_state: required slave state
         @param test_case: test case defintion
         '''
-        cond_ts = lambda v: (v.hostname in test_suite.machines)
-
-        if not test_case or (test_case and not test_case.machines):
-            cond_tc = lambda v: True
-        else:
-            cond_tc = lambda v: (v.hostname in test_case.machines)
-
-        cond_state = lambda v: True
-        if not slave_state:
-            pass
-        elif slave_state == State(Slave.S_SUITE_INITIALIZED):
-            cond_state = lambda v: \
-                        (self.slaveState(v.hostname) == slave_state and \
-                         v.state.suiteName == test_suite.name)
-        elif slave_state:
-            cond_state = lambda v: \
-                        (self.slaveState(v.hostname) == slave_state)
-        else:
-            pass
-
-        cond = lambda v: cond_ts(v) and cond_tc(v) and cond_state(v)
+        hostnames = set(test_suite.machines)
+        if test_case and test_case.machines:
+            hostnames &= set(test_case.machines)
 
-        testSlaves = [v for v in self.slaves.itervalues() if cond(v)]
+        suiteName = None
+        if slave_state and slave_state == State(Slave.S_SUITE_INITIALIZED):
+            suiteName = test_suite.name
 
-        return testSlaves
+        return self.slaves.find(hostnames, slave_state, suiteName)
 
     def startCluster(self, clusterName, suiteName, jobGroupId):
         '''
@@ -518,42 +787,13 @@ class XrdTestMaster(Runnable):
         @param jobGroupId:
         @return: True/False in case of Success/Failure in sending messages
         '''
-        testSuite = self.testSuites[suiteName]
-        tss = TestSuiteSession(testSuite)
-        tss.state = State(TestSuite.S_IDLE)
-        self.storeSuiteSession(tss)
-
-        # Set one hour timeout
-        # TODO: make timeout value configurable per-suite
-        self.sched.add_date_job(self.cancelTestSuite,
-                           datetime.now() + timedelta(hours=1),
-                           [suiteName, True])
-        self.runningSuite = tss
-
         clusterFound = False
         if self.clusters.has_key(clusterName):
             if self.clusters[clusterName].name == clusterName:
                 clusterFound = True
-                #@todo: choosing hypervisor in more intelligent
-                #choose one Hipervisor arbitrarily
                 if len(self.hypervisors):
-                    msg = XrdMessage(XrdMessage.M_START_CLUSTER)
-                    msg.clusterDef = self.clusters[clusterName]
-                    msg.jobGroupId = jobGroupId
-                    msg.suiteName = suiteName
-
-                    #take random hypervisor and send him cluster def
-                    hyperv = self.selectHypervisor()
-                    hyperv.send(msg)
-
-                    self.clusters[clusterName].state = \
-                        State(Cluster.S_DEFINITION_SENT)
-                    self.clustersHypervisor[clusterName] = hyperv
-                    hyperv.runningClusterDefs[clusterName] = \
-                                            copy(self.clusters[clusterName])
-
-                    LOGGER.info("Cluster start command sent to %s", hyperv)
-                    return True
+                    return self.sendStartCluster(clusterName, suiteName,
+                                                 jobGroupId)
                 else:
                     LOGGER.warning("No hypervisor to run the cluster %s on" % \
                                    clusterName)
@@ -568,26 +808,17 @@ class XrdTestMaster(Runnable):
         '''
         Start a cluster without attaching it to a particular test suite.
         '''
+        if self.clusterOwners.has_key(cluster):
+            LOGGER.warning("Cluster %s is already in use" % cluster)
+            return False
+        if self.leaseCluster(cluster, '0'):
+            return True
+
         if self.clusters.has_key(cluster):
             if self.clusters[cluster].name == cluster:
 
                 if len(self.hypervisors):
-                    msg = XrdMessage(XrdMessage.M_START_CLUSTER)
-                    msg.clusterDef = self.clusters[cluster]
-                    msg.jobGroupId = '0'
-                    msg.suiteName = 'none'
-
-                    hyperv = self.selectHypervisor()
-                    hyperv.send(msg)
-
-                    self.clusters[cluster].state = \
-                        State(Cluster.S_DEFINITION_SENT)
-                    self.clustersHypervisor[cluster] = hyperv
-                    hyperv.runningClusterDefs[cluster] = \
-                                            copy(self.clusters[cluster])
-
-                    LOGGER.info("Cluster start command sent to %s", hyperv)
-                    return True
+                    return self.sendStartCluster(cluster, 'none', '0')
                 else:
                     LOGGER.warning("No hypervisor to run the cluster %s on" % \
                                    cluster)
@@ -598,12 +829,212 @@ class XrdTestMaster(Runnable):
             LOGGER.error("No cluster with name " + str(cluster) + " found")
             return False
 
-    def selectHypervisor(self, hypervisor=None):
-        # Select a random hypervisor.
-        # Todo: choose hypervisor more intelligently
-        hNum = random.randint(0, len(self.hypervisors) - 1)
-        hyperv = [h for h in self.hypervisors.itervalues()][hNum]
-        return hyperv
+    def sendStartCluster(self, clusterName, suiteName, jobGroupId):
+        '''
+        Sends messages to hypervisors to start the cluster, or its parts if
+        it is split across hypervisors.
+
+        @param clusterName:
+        @param suiteName:
+        @param jobGroupId:
+        @return: True
+        '''
+        cluster = self.clusters[clusterName]
+        placement = self.placeCluster(clusterName)
+        hypervs = [hyperv for (hyperv, names) in placement]
+        if len(placement) == 1:
+            parts = [copy(cluster)]
+        else:
+            parts = cluster.partitions([(hyperv.address[0], names) \
+                                        for (hyperv, names) in placement])
+
+        for (hyperv, part) in zip(hypervs, parts):
+            msg = XrdMessage(XrdMessage.M_START_CLUSTER)
+            msg.clusterDef = part
+            msg.jobGroupId = jobGroupId
+            msg.suiteName = suiteName
+            hyperv.send(msg)
+            hyperv.runningClusterDefs[clusterName] = part
+            LOGGER.info("Cluster start command sent to %s", hyperv)
+
+        cluster.state = State(Cluster.S_DEFINITION_SENT)
+        self.clusterPool.startSent(clusterName)
+        self.clusterHypervisors[clusterName] = hypervs
+        self.clusterSnapshots[clusterName] = []
+        self.clusterPartsPending[clusterName] = \
+            set([hyperv.address for hyperv in hypervs])
+        self.clusterOwners[clusterName] = jobGroupId
+        return True
+
+    def freeResources(self, hyperv, vcpuRatio):
+        '''
+        Resources of a hypervisor not used by clusters running on it nor
+        by clusters being started on it.
+
+        @param hyperv: Hypervisor object
+        @param vcpuRatio: vCPUs of domains per CPU of the hypervisor
+        @return: tuple (RAM in KiB, vCPUs, storage in bytes, number of
+                 clusters), resources are None if the hypervisor has not
+                 reported its capacity
+        '''
+        capacity = hyperv.capacity
+        # clusters being started on it, not yet reported running
+        pending = [c for (n, c) in hyperv.runningClusterDefs.iteritems() \
+                   if hyperv in self.clusterHypervisors.get(n, ()) and \
+                   self.clusters.has_key(n) and \
+                   0 < self.clusters[n].state.id < Cluster.S_STOPPED[0] and \
+                   (not capacity or n not in capacity.clusters)]
+
+        if not capacity:
+            return (None, None, None, len(pending))
+
+        # clusters stopped since the hypervisor reported its capacity
+        stopped = [c for (n, c) in hyperv.runningClusterDefs.iteritems() \
+                   if n in capacity.clusters and self.clusters.has_key(n) and \
+                   self.clusters[n].state == State(Cluster.S_STOPPED)]
+        stoppedRam = sum([c.requiredRam() for c in stopped])
+
+        freeRam = min(capacity.totalRam - capacity.committedRam,
+                      capacity.freeRam) + stoppedRam - \
+                  sum([c.requiredRam() for c in pending])
+        freeVcpus = capacity.vcpus * vcpuRatio - capacity.committedVcpus + \
+                    sum([c.requiredVcpus() for c in stopped]) - \
+                    sum([c.requiredVcpus() for c in pending])
+        freeStorage = capacity.freeStorage - \
+                      sum([c.requiredStorage() for c in pending])
+        return (freeRam, freeVcpus, freeStorage,
+                len(capacity.clusters) - len(stopped) + len(pending))
+
+    def vcpuOvercommit(self):
+        '''
+        @return: vCPUs of domains allowed per CPU of a hypervisor
+        '''
+        if self.config.has_option('general', 'vcpu_overcommit'):
+            return self.config.getfloat('general', 'vcpu_overcommit')
+        return 4.0
+
+    def clusterFits(self, clusterName):
+        '''
+        Check if a cluster can be started without overcommitting any
+        hypervisor, i.e. if there is a hypervisor with enough free resources
+        for it or one which has not reported its capacity.
+
+        @param clusterName:
+        @return: True/False
+        '''
+        cluster = self.clusters[clusterName]
+        vcpuRatio = self.vcpuOvercommit()
+        for hyperv in self.hypervisors.itervalues():
+            (freeRam, freeVcpus, freeStorage, running) = \
+                self.freeResources(hyperv, vcpuRatio)
+            if freeRam is None or (freeRam >= cluster.requiredRam() and \
+                freeVcpus >= cluster.requiredVcpus() and \
+                freeStorage >= cluster.requiredStorage()):
+                return True
+        return False
+
+    def placeCluster(self, clusterName):
+        '''
+        Select the hypervisor to run a cluster on. Among hypervisors with
+        enough RAM, vCPUs (up to vcpu_overcommit per CPU) and storage for the
+        cluster, the one with most of the
+        cluster's boot images in its storage pool is preferred, then the one
+        running fewest clusters, then the one with most free RAM. Next come
+        hypervisors which have not reported their capacity. If none of the
+        hypervisors has enough resources, the cluster is split across
+        several hypervisors if its definition allows it, otherwise the least
+        loaded one is taken.
+
+        @param clusterName: name of the cluster
+        @return: list of (Hypervisor object, host names) tuples, one per
+                 part of the cluster, host names are None if the cluster is
+                 not split
+        '''
+        cluster = self.clusters[clusterName]
+        ram = cluster.requiredRam()
+        vcpus = cluster.requiredVcpus()
+        storage = cluster.requiredStorage()
+        images = cluster.bootImages()
+        vcpuRatio = self.vcpuOvercommit()
+
+        candidates = []
+        free = {}
+        for hyperv in self.hypervisors.itervalues():
+            (freeRam, freeVcpus, freeStorage, running) = \
+                self.freeResources(hyperv, vcpuRatio)
+
+            if freeRam is None:
+                candidates.append(((1, running, 0, 0), hyperv))
+                continue
+
+            free[hyperv] = [freeRam, freeVcpus, freeStorage]
+            fits = freeRam >= ram and freeVcpus >= vcpus and \
+                   freeStorage >= storage
+            missing = len(images - hyperv.capacity.images)
+
+            if fits:
+                candidates.append(((0, missing, running, -freeRam), hyperv))
+            else:
+                candidates.append(((2, running, -freeRam, missing), hyperv))
+
+        (rank, hyperv) = min(candidates, key=lambda c: c[0])
+        if rank[0] == 2 and getattr(cluster, 'split', False):
+            parts = self.splitCluster(cluster, free)
+            if parts:
+                LOGGER.info("Splitting cluster %s: %s" % (clusterName, \
+                            '; '.join(['%s on %s' % (', '.join(names), h) \
+                                       for (h, names) in parts])))
+                return parts
+
+        if rank[0] == 2:
+            LOGGER.warning(("No hypervisor has enough resources for " + \
+                            "cluster %s (%d MiB RAM, %d vCPUs), " + \
+                            "overcommitting %s") % (clusterName, ram / 1024,
+                            vcpus, hyperv))
+        elif rank[0] == 0:
+            LOGGER.info("Placing cluster %s on %s (%d boot images missing)" % \
+                        (clusterName, hyperv, rank[1]))
+        return [(hyperv, None)]
+
+    def splitCluster(self, cluster, free):
+        '''
+        Partition hosts of a cluster across hypervisors: each host goes to
+        the first hypervisor, in order of free RAM, with enough resources
+        left for it.
+
+        @param cluster: Cluster object
+        @param free: free [RAM, vCPUs, storage] of hypervisors which reported
+                     their capacity, key: Hypervisor object
+        @return: list of (Hypervisor object, host names) tuples or None if
+                 the hosts do not fit into the hypervisors
+        '''
+        hypervs = sorted(free.keys(), key=lambda h: -free[h][0])
+        if len(hypervs) < 2:
+            return None
+
+        parts = dict([(h, []) for h in hypervs])
+        for host in cluster.hosts:
+            try:
+                ram = int(host.ramSize)
+            except (TypeError, ValueError):
+                ram = 0
+            storage = sum([int(d.size) for d in host.disks \
+                           if isinstance(d, Disk)])
+
+            for hyperv in hypervs:
+                res = free[hyperv]
+                if res[0] >= ram and res[1] >= 1 and res[2] >= storage:
+                    res[0] -= ram
+                    res[1] -= 1
+                    res[2] -= storage
+                    parts[hyperv].append(host.name)
+                    break
+            else:
+                LOGGER.warning(("Cluster %s does not fit into all " + \
+                                "hypervisors either") % cluster.name)
+                return None
+
+        return [(h, parts[h]) for h in hypervs if parts[h]]
 
     def stopCluster(self, clusterName):
         '''
@@ -620,36 +1051,266 @@ class XrdTestMaster(Runnable):
 #                    LOGGER.error("Cluster is not active so it can't be stopped")
 #                    return
 
-                msg = XrdMessage(XrdMessage.M_STOP_CLUSTER)
-                hyperv = self.clustersHypervisor[clusterName]
-                msg.clusterDef = hyperv.runningClusterDefs[clusterName]
-                hyperv.send(msg)
+                hypervs = self.clusterHypervisors[clusterName]
+                for hyperv in hypervs:
+                    msg = XrdMessage(XrdMessage.M_STOP_CLUSTER)
+                    msg.clusterDef = hyperv.runningClusterDefs[clusterName]
+                    hyperv.send(msg)
+                    LOGGER.info("Cluster stop command sent to %s", hyperv)
 
                 self.clusters[clusterName].state = \
                     State(Cluster.S_STOPCOMMAND_SENT)
+                self.clusterPartsPending[clusterName] = \
+                    set([hyperv.address for hyperv in hypervs])
 
-                LOGGER.info("Cluster stop command sent to %s", hyperv)
+                self.forgetClusterSlaves(clusterName)
+                return True
+            return False
+        if not clusterFound:
+            LOGGER.error("No cluster with name " + str(clusterName) + " found")
+            return False
 
-                # Cluster was stopped - remove all slaves.
-                self.slaves = {}
+    def forgetClusterSlaves(self, clusterName):
+        '''
+        Remove slaves of a cluster being stopped or reset. Slaves of other
+        clusters may still be running test suites. Their connections are
+        shut down, as a slave reverted to a snapshot does not close them.
 
-                # Remove timeout job. If we get here because a timeout job fired,
-                # then the job will have been unscheduled automatically.
+        @param clusterName:
+        '''
+        for host in self.clusters[clusterName].hosts:
+            self.restoredSlaveStates.pop(host.name, None)
+            slave = self.slaves.get(host.name)
+            if slave:
                 try:
-                    self.sched.unschedule_func(self.cancelTestSuite)
-                except:
-                    pass
+                    if slave.socket:
+                        slave.socket.shutdown()
+                except socket.error, e:
+                    LOGGER.debug(e)
+                del self.slaves[slave.address]
 
-                return True
+    def sendClusterCommand(self, clusterName, msgName, state, snapshot=None):
+        '''
+        Sends a message to every hypervisor running a part of the cluster,
+        all of which are to report back.
+
+        @param clusterName:
+        @param msgName: XrdMessage name
+        @param state: cluster state until the hypervisors report back
+        @param snapshot: name of the snapshot the message concerns
+        '''
+        hypervs = self.clusterHypervisors[clusterName]
+        for hyperv in hypervs:
+            msg = XrdMessage(msgName)
+            msg.clusterDef = hyperv.runningClusterDefs[clusterName]
+            if snapshot:
+                msg.snapshot = snapshot
+            hyperv.send(msg)
+            LOGGER.info("Cluster %s command sent to %s", msgName, hyperv)
+
+        self.clusters[clusterName].state = State(state)
+        self.clusterPartsPending[clusterName] = \
+            set([hyperv.address for hyperv in hypervs])
+
+    def parkCluster(self, clusterName):
+        '''
+        Keep a cluster whose job group finished with it warm: send messages
+        to hypervisors to reset it to a clean state, after which it waits in
+        the pool for its next lease.
+
+        @param clusterName:
+        @return: True if the cluster is being reset, False if it is to be
+                 stopped instead
+        '''
+        if not self.clusters.has_key(clusterName) or \
+            not self.clusterHypervisors.has_key(clusterName) or \
+            self.clusters[clusterName].state.isError() or \
+            not self.clusterPool.canPark(clusterName):
             return False
-        if not clusterFound:
-            LOGGER.error("No cluster with name " + str(clusterName) + " found")
+
+        self.sendClusterCommand(clusterName, XrdMessage.M_RESET_CLUSTER,
+                                Cluster.S_RESETTING_CLUSTER)
+
+        # Slaves reboot, or are reverted to the first snapshot, and connect
+        # again
+        self.forgetClusterSlaves(clusterName)
+        return True
+
+    def needsSnapshot(self, clusterName, snapName):
+        '''
+        @return: True if the snapshot of the cluster is yet to be taken
+        '''
+        snapshots = self.clusterSnapshots.get(clusterName)
+        return snapshots is not None and not snapName in snapshots
+
+    def hasSnapshot(self, clusterName, snapName):
+        '''
+        @return: True if the cluster can be reverted to the snapshot
+        '''
+        return snapName in (self.clusterSnapshots.get(clusterName) or [])
+
+    def snapshotCluster(self, clusterName, snapName):
+        '''
+        Sends messages to hypervisors to take a snapshot of the cluster,
+        once all of its slaves are connected, so that they are connected
+        again right after the cluster is reverted to the snapshot.
+
+        @param clusterName:
+        @param snapName: name of the snapshot
+        @return: True if the messages were sent
+        '''
+        for host in self.clusters[clusterName].hosts:
+            if not self.slaves.get(host.name):
+                LOGGER.debug("Can't snapshot %s because %s not connected." % \
+                             (clusterName, host.name))
+                return False
+
+        self.sendClusterCommand(clusterName, XrdMessage.M_SNAPSHOT_CLUSTER,
+                                Cluster.S_SNAPSHOTTING, snapName)
+        return True
+
+    def revertCluster(self, clusterName, snapName, suiteName):
+        '''
+        Sends messages to hypervisors to revert the cluster to a snapshot
+        taken during a test suite run. Its slaves connect again in the state
+        they were in when it was taken.
+
+        @param clusterName:
+        @param snapName: name of the snapshot
+        @param suiteName: test suite the snapshot was taken in
+        @return: True
+        '''
+        self.sendClusterCommand(clusterName, XrdMessage.M_RESET_CLUSTER,
+                                Cluster.S_RESETTING_CLUSTER, snapName)
+        self.forgetClusterSlaves(clusterName)
+
+        machines = self.testSuites[suiteName].machines
+        for host in self.clusters[clusterName].hosts:
+            if host.name in machines:
+                self.restoredSlaveStates[host.name] = \
+                    self.suiteState(suiteName)
+        return True
+
+    def leaseCluster(self, clusterName, jobGroupId):
+        '''
+        Give a warm cluster to a job group, if it is idle in the pool.
+
+        @param clusterName:
+        @param jobGroupId:
+        @return: True if the cluster was leased
+        '''
+        if not self.clusterPool.lease(clusterName):
             return False
 
+        self.clusterOwners[clusterName] = jobGroupId
+        self.clusters[clusterName].state = State(Cluster.S_WAITING_SLAVES)
+        return True
+
+    def prestartGroupId(self, clusterName):
+        '''
+        @return: id of the job group holding a cluster started ahead of a
+                 scheduled run until it is ready
+        '''
+        return 'prestart:' + clusterName
+
+    def prestartClusters(self):
+        '''
+        Start clusters of scheduled test suites ahead of time, so that they
+        are ready when the suites are due. A cluster is started once the time
+        left until the run is less than its longest recent start duration.
+        When ready it waits in the pool, reserved for the run until
+        cluster_prestart_timeout seconds after the scheduled time.
+        '''
+        if not self.prestartEnabled or not len(self.hypervisors):
+            return
+
+        now = time.time()
+        for ts in self.testSuites.values():
+            nextRun = ts.getNextRunTime()
+            if not isinstance(nextRun, datetime):
+                continue
+            runTime = time.mktime(nextRun.timetuple())
+            if runTime <= now:
+                continue
+
+            for c in ts.clusters:
+                if not self.clusters.has_key(c) or \
+                    self.prestartedRuns.get(c) == runTime or \
+                    runTime - now > self.clusterPool.startDuration(c,
+                                                    self.prestartEstimate):
+                    continue
+                self.prestartedRuns[c] = runTime
+
+                if self.clusterPool.isIdle(c):
+                    # already warm, keep it for the run
+                    self.clusterPool.reserve(c, runTime + self.prestartTimeout)
+                elif not self.clusterOwners.has_key(c) and \
+                    self.clusterFits(c):
+                    LOGGER.info(("Starting cluster %s ahead of test suite " + \
+                                 "%s due in %ds") % (c, ts.name, runTime - now))
+                    self.clusterPool.reserve(c, runTime + self.prestartTimeout)
+                    self.sendStartCluster(c, ts.name, self.prestartGroupId(c))
+
+    def clusterStarted(self, slaveName):
+        '''
+        Record the start duration of the cluster of a slave which connected,
+        if it was the last of the cluster to connect.
+
+        @param slaveName: hostname of the slave
+        '''
+        for clusterName in self.clusterPool.starting.keys():
+            if not self.clusters.has_key(clusterName):
+                continue
+            hosts = [h.name for h in self.clusters[clusterName].hosts]
+            if slaveName in hosts and \
+                not [h for h in hosts if not self.slaves.get(h)]:
+                self.clusterPool.startDone(clusterName)
+
+    def evictCluster(self, clusterName):
+        '''
+        Stop an idle cluster of the pool. It is held by no job group until
+        it is stopped, so that it is not started meanwhile.
+
+        @param clusterName:
+        '''
+        LOGGER.info("Evicting warm cluster %s" % clusterName)
+        self.clusterPool.evict(clusterName)
+        self.clusterOwners[clusterName] = '0'
+        if not self.stopCluster(clusterName):
+            self.releaseCluster(clusterName)
+            self.clusterPool.forget(clusterName)
+
+    def evictIdleClusters(self):
+        '''
+        Stop warm clusters idle for too long or exceeding the pool size.
+        '''
+        for clusterName in self.clusterPool.expired():
+            self.evictCluster(clusterName)
+
+    def reclaimCluster(self, clusterName):
+        '''
+        Stop the least recently used warm cluster, if there is no room to
+        start a cluster otherwise.
+
+        @param clusterName: name of the cluster to be started
+        @return: True if the start of the cluster should wait for warm
+                 clusters to be stopped
+        '''
+        if self.clusterPool.evicting:
+            return True
+        victim = self.clusterPool.leastRecentlyUsed()
+        if not victim or self.clusterFits(clusterName):
+            return False
+
+        LOGGER.info("Reclaiming resources of warm cluster %s for %s" % \
+                    (victim, clusterName))
+        self.evictCluster(victim)
+        return True
+
     def initializeTestSuite(self, test_suite_name, jobGroupId):
         '''
         Sends initialize message to slaves, creates TestSuite Session
-        and stores it in python shelve.
+        and stores it in the session database.
 
         @param test_suite_name:
         @param jobGroupId:
@@ -694,6 +1355,8 @@ class XrdTestMaster(Runnable):
             sl.send(msg)
             sl.state = State(Slave.S_SUITE_INIT_SENT)
 
+        self.openStageBarrier(tss.name, Job.INITIALIZE_TEST_SUITE, testSlaves)
+
         return True
 
     def finalizeTestSuite(self, test_suite_name):
@@ -736,6 +1399,7 @@ class XrdTestMaster(Runnable):
             sl.state = State(Slave.S_SUITE_FINALIZE_SENT)
             sl.state.sessUid = tss.uid
 
+        self.openStageBarrier(tss.name, Job.FINALIZE_TEST_SUITE, tSlaves)
         tss.state = State(TestSuite.S_WAIT_4_FINALIZE)
 
         return True
@@ -762,6 +1426,17 @@ class XrdTestMaster(Runnable):
                            test_suite_name)
             return False
 
+        # Slaves of clusters reverted to a snapshot connect again
+        unreadyMachines = [m for m in tss.suite.machines \
+                           if not self.slaves.get(m)]
+        if unreadyMachines:
+            LOGGER.debug("Some required machines are not " + \
+                         "connected: %s" % str(unreadyMachines))
+            return False
+        for cluster in tss.suite.clusters:
+            if self.clusters[cluster].state == Cluster.S_WAITING_SLAVES:
+                self.clusters[cluster].state = State(Cluster.S_ACTIVE)
+
         # copy test case to test suite session context
         tc = deepcopy(tss.suite.testCases[test_name])
         tss.addCaseRun(tc)
@@ -780,6 +1455,8 @@ class XrdTestMaster(Runnable):
             sl.send(msg)
             sl.state = State(Slave.S_TEST_INIT_SENT)
 
+        self.openStageBarrier(tss.name, Job.INITIALIZE_TEST_CASE, testSlaves,
+                              tc.name)
         tss.state = State(TestSuite.S_WAIT_4_TEST_INIT)
         self.storeSuiteSession(tss)
 
@@ -820,6 +1497,8 @@ class XrdTestMaster(Runnable):
             sl.send(msg)
             sl.state = State(Slave.S_TEST_RUN_SENT)
 
+        self.openStageBarrier(tss.name, Job.RUN_TEST_CASE, testSlaves,
+                              tc.name)
         tss.state = State(TestSuite.S_WAIT_4_TEST_RUN)
         self.storeSuiteSession(tss)
 
@@ -860,6 +1539,8 @@ class XrdTestMaster(Runnable):
             sl.send(msg)
             sl.state = State(Slave.S_TEST_FINALIZE_SENT)
 
+        self.openStageBarrier(tss.name, Job.FINALIZE_TEST_CASE, testSlaves,
+                              tc.name)
         tss.state = State(TestSuite.S_WAIT_4_TEST_FINALIZE)
         self.storeSuiteSession(tss)
 
@@ -889,9 +1570,11 @@ class XrdTestMaster(Runnable):
             # TODO: disconnect client and end its thread
         else:
             if client_type == self.C_SLAVE:
+                state = self.restoredSlaveStates.pop(client_hostname,
+                                        State(TCPClient.S_CONNECTED_IDLE))
                 clients[client_addr] = Slave(sock_obj, client_hostname,
-                                             client_addr,
-                                             State(TCPClient.S_CONNECTED_IDLE))
+                                             client_addr, state)
+                self.clusterStarted(client_hostname)
             else:
                 clients[client_addr] = Hypervisor(sock_obj, client_hostname,
                                             client_addr,
@@ -906,7 +1589,7 @@ class XrdTestMaster(Runnable):
                 if cluster.state == Cluster.S_UNKNOWN_NOHYPERV:
                     cluster.state = State(Cluster.S_DEFINED)
 
-            if len(self.pendingJobs):
+            if len(self.jobQueue):
                 self.startNextJob()
 
     def handleClientDisconnected(self, client_type, client_addr):
@@ -921,6 +1604,12 @@ class XrdTestMaster(Runnable):
         if client_type == self.C_HYPERV:
             clients = self.hypervisors
 
+        # Slaves of a stopped cluster are forgotten before they disconnect
+        if not clients.has_key(client_addr):
+            LOGGER.info("Disconnected " + str(client_type) + ":" + \
+                        str(client_addr))
+            return
+
         try:
             if clients[client_addr].socket:
                 clients[client_addr].socket.close()
@@ -930,6 +1619,38 @@ class XrdTestMaster(Runnable):
         del clients[client_addr]
         LOGGER.info("Disconnected " + str(client_type) + ":" + str(client_addr))
 
+        # A disconnected hypervisor removes its clusters, warm ones included
+        if client_type == self.C_HYPERV:
+            for name in self.clusterPool.idle.keys():
+                if client_addr in [h.address for h in \
+                                   self.clusterHypervisors.get(name, [])]:
+                    LOGGER.info("Warm cluster %s lost with %s" % \
+                                (name, str(client_addr)))
+                    self.clusterPool.forget(name)
+                    self.clusterSnapshots.pop(name, None)
+                    if self.clusters.has_key(name):
+                        self.clusters[name].state = State(Cluster.S_STOPPED)
+
+    def startClusterPoolTimer(self):
+        '''
+        Start thread adding an event checking for idle warm clusters and for
+        clusters to be started ahead of scheduled runs to the main events
+        queue every minute, or more often for short idle timeouts.
+        '''
+        if not self.clusterPool.enabled:
+            return
+
+        interval = max(1, min(60, self.clusterPool.idleTimeout / 4))
+        def tick():
+            while True:
+                time.sleep(interval)
+                evt = MasterEvent(MasterEvent.M_EVICT_CLUSTERS, None)
+                self.recvQueue.put((MasterEvent.PRIO_NORMAL, evt))
+
+        timer_thread = threading.Thread(target=tick)
+        timer_thread.daemon = True
+        timer_thread.start()
+
     def fireEnqueueJobEvent(self, test_suite_name):
         '''
         Add the Run Job event to main events queue of controll thread.
@@ -947,33 +1668,119 @@ class XrdTestMaster(Runnable):
 
     def cancelTestSuite(self, test_suite_name, timeout=False):
         '''Cancel a running test suite '''
-        if len(self.pendingJobs):
-            # Remove the suite's jobs from the queue.
-            job = self.pendingJobs[0]
-            self.removeJobs(job.groupId)
-
-            # Remove this run from the history, unless it timed out
-            if timeout:
-                LOGGER.warning('Test suite %s timed out ' % test_suite_name)
-                if self.runningSuite and self.suiteSessions.has_key(self.runningSuite.uid):
-                    tss = self.suiteSessions[self.runningSuite.uid]
-                    tss.timeout = True
-                    tss.failed = True
-                    self.suiteSessions[self.runningSuite.uid] = tss
-                self.suiteSessions.sync()
-
-            elif self.runningSuite and self.suiteSessions.has_key(self.runningSuite.uid):
-                del self.suiteSessions[self.runningSuite.uid]
-                self.suiteSessions.sync()
-
-            # Stop this suite's clusters.
-            for cluster in self.testSuites[test_suite_name].clusters:
-                if self.clustersHypervisor.has_key(cluster):
-                    self.stopCluster(cluster)
-
-        if self.runningSuite and self.runningSuite.name == test_suite_name:
-            self.runningSuite = None
+        if not self.runningSuites.has_key(test_suite_name):
+            LOGGER.debug("Test suite %s is not running." % test_suite_name)
+            return
+
+        # Remove the suite's jobs from the queue.
+        groupId = self.runningSuites[test_suite_name]
+        self.removeJobs(groupId)
+
+        uid = self.runningSuiteUids.get(test_suite_name)
+        # Remove this run from the history, unless it timed out
+        if timeout:
+            LOGGER.warning('Test suite %s timed out ' % test_suite_name)
+            tss = self.retrieveSuiteSession(test_suite_name)
+            if tss:
+                tss.timeout = True
+                tss.failed = True
+                self.storeSuiteSession(tss)
+
+        elif uid:
+            self.suiteSessions.delete(uid)
+            if self.liveSessions.has_key(test_suite_name):
+                del self.liveSessions[test_suite_name]
+
+        # Stop this suite's clusters.
+        for cluster, owner in self.clusterOwners.items():
+            if owner == groupId:
+                self.stopCluster(cluster)
+
+        self.endSuiteRun(test_suite_name)
+
+    def startSuiteRun(self, test_suite_name, jobGroupId):
+        '''
+        Mark the beginning of a test suite run: create its TestSuiteSession
+        and set its timeout.
+
+        @param test_suite_name:
+        @param jobGroupId: job group running the suite
+        '''
+        self.runningSuites[test_suite_name] = jobGroupId
+
+        tss = TestSuiteSession(self.testSuites[test_suite_name])
+        tss.state = State(TestSuite.S_IDLE)
+        self.storeSuiteSession(tss)
+
+        # Set one hour timeout
+        # TODO: make timeout value configurable per-suite
+        if self.sched:
+            self.suiteTimeouts[test_suite_name] = \
+                self.sched.add_date_job(self.cancelTestSuite,
+                                        datetime.now() + timedelta(hours=1),
+                                        [test_suite_name, True])
+
+        LOGGER.info("Test suite %s started in job group %s" % \
+                    (test_suite_name, jobGroupId))
+
+    def endSuiteRun(self, test_suite_name):
+        '''
+        Forget about a test suite run, which finished or was cancelled.
+        Clusters it used are released separately, once they are stopped.
 
+        @param test_suite_name:
+        '''
+        if self.runningSuites.has_key(test_suite_name):
+            del self.runningSuites[test_suite_name]
+        tss = self.liveSessions.get(test_suite_name)
+        if tss:
+            self.suiteSessions.forget(tss.uid)
+        if self.stageBarriers.has_key(test_suite_name):
+            del self.stageBarriers[test_suite_name]
+
+        # Remove timeout job. If we get here because a timeout job fired,
+        # then the job will have been unscheduled automatically.
+        if self.suiteTimeouts.has_key(test_suite_name):
+            try:
+                self.sched.unschedule_job(self.suiteTimeouts[test_suite_name])
+            except KeyError:
+                pass
+            del self.suiteTimeouts[test_suite_name]
+
+    def clusterPartReported(self, msg):
+        '''
+        Account a state reported by a hypervisor running a part of a split
+        cluster. A split cluster is waiting for slaves, idle, or stopped, only
+        when all of its parts are, and active after a snapshot when it is
+        taken on all of them.
+
+        @param msg: M_CLUSTER_STATE message
+        @return: True if the state applies to the whole cluster
+        '''
+        if len(self.clusterHypervisors.get(msg.clusterName, [])) < 2:
+            return True
+        if msg.state in (State(Cluster.S_WAITING_SLAVES),
+                         State(Cluster.S_ACTIVE),
+                         State(Cluster.S_IDLE),
+                         State(Cluster.S_STOPPED),
+                         State(Cluster.S_ERROR_STOP)):
+            pending = self.clusterPartsPending.get(msg.clusterName, set())
+            pending.discard(msg.sender)
+            if pending:
+                LOGGER.info("Cluster %s: waiting for parts on %s" % \
+                            (msg.clusterName, ', '.join(['%s:%s' % a \
+                                                         for a in pending])))
+                return False
+        return True
+
+    def releaseCluster(self, clusterName):
+        '''
+        Make a cluster available for other job groups.
+
+        @param clusterName:
+        '''
+        if self.clusterOwners.has_key(clusterName):
+            del self.clusterOwners[clusterName]
 
     def executeJob(self, test_suite_name):
         '''
@@ -1003,36 +1810,59 @@ class XrdTestMaster(Runnable):
             LOGGER.error('KeyError: %s is not a known test suite' % e)
             return
 
-        for clustName in ts.clusters:
-            j = Job(Job.START_CLUSTER, groupId, (clustName, test_suite_name))
-            self.pendingJobs.append(j)
-            self.pendingJobsDbg.append("startCluster(%s)" % clustName)
+        # Clusters are reverted to snapshots after the run, and before every
+        # test case but the first if the suite asks for it
+        snapshots = self.clusterSnapshotsEnabled
+        resetCases = snapshots and \
+                     getattr(ts, 'cluster_reset', 'SUITE') == 'CASE'
 
-        j = Job(Job.INITIALIZE_TEST_SUITE, groupId, test_suite_name)
-        self.pendingJobs.append(j)
-        self.pendingJobsDbg.append("initSuite(%s)" % test_suite_name)
+        for clustName in ts.clusters:
+            j = Job(Job.START_CLUSTER, groupId, (clustName, test_suite_name),
+                    test_suite_name)
+            self.jobQueue.add(j)
+
+        if snapshots:
+            for clustName in ts.clusters:
+                j = Job(Job.SNAPSHOT_CLUSTER, groupId, (clustName, 'clean'),
+                        test_suite_name)
+                self.jobQueue.add(j)
+
+        j = Job(Job.INITIALIZE_TEST_SUITE, groupId, test_suite_name,
+                test_suite_name)
+        self.jobQueue.add(j)
+
+        if resetCases:
+            for clustName in ts.clusters:
+                j = Job(Job.SNAPSHOT_CLUSTER, groupId, (clustName, 'suite'),
+                        test_suite_name)
+                self.jobQueue.add(j)
+
+        for i, tName in enumerate(ts.tests):
+            if resetCases and i:
+                for clustName in ts.clusters:
+                    j = Job(Job.RESET_CLUSTER, groupId, (clustName, 'suite'),
+                            test_suite_name)
+                    self.jobQueue.add(j)
 
-        for tName in ts.tests:
-            j = Job(Job.INITIALIZE_TEST_CASE, groupId, (test_suite_name, tName))
-            self.pendingJobs.append(j)
-            self.pendingJobsDbg.append("initTest(%s)" % tName)
+            j = Job(Job.INITIALIZE_TEST_CASE, groupId, (test_suite_name, tName),
+                    test_suite_name)
+            self.jobQueue.add(j)
 
-            j = Job(Job.RUN_TEST_CASE, groupId, (test_suite_name, tName))
-            self.pendingJobs.append(j)
-            self.pendingJobsDbg.append("runTest(%s)" % tName)
+            j = Job(Job.RUN_TEST_CASE, groupId, (test_suite_name, tName),
+                    test_suite_name)
+            self.jobQueue.add(j)
 
-            j = Job(Job.FINALIZE_TEST_CASE, groupId, (test_suite_name, tName))
-            self.pendingJobs.append(j)
-            self.pendingJobsDbg.append("finalizeTest(%s)" % tName)
+            j = Job(Job.FINALIZE_TEST_CASE, groupId, (test_suite_name, tName),
+                    test_suite_name)
+            self.jobQueue.add(j)
 
-        j = Job(Job.FINALIZE_TEST_SUITE, groupId, test_suite_name)
-        self.pendingJobs.append(j)
-        self.pendingJobsDbg.append("finalizeSuite(%s)" % test_suite_name)
+        j = Job(Job.FINALIZE_TEST_SUITE, groupId, test_suite_name,
+                test_suite_name)
+        self.jobQueue.add(j)
 
         for clustName in ts.clusters:
-            j = Job(Job.STOP_CLUSTER, groupId, clustName)
-            self.pendingJobs.append(j)
-            self.pendingJobsDbg.append("stopCluster(%s)" % clustName)
+            j = Job(Job.STOP_CLUSTER, groupId, clustName, test_suite_name)
+            self.jobQueue.add(j)
 
     def isJobValid(self, job):
         '''
@@ -1058,67 +1888,180 @@ class XrdTestMaster(Runnable):
             else:
                 return True
 
+    def isJobGroupActive(self, groupId):
+        '''
+        Check if job group has already begun, i.e. it runs a test suite or
+        still holds some clusters.
+
+        @param groupId:
+        @return: True/False
+        '''
+        return groupId in self.runningSuites.values() or \
+               groupId in self.clusterOwners.values()
+
+    def startJobGroups(self):
+        '''
+        Begin waiting job groups whose resources are free, as chosen by
+        JobQueue.admitGroups(), so that the next run of a test suite may be
+        provisioned while the clusters of the former one are torn down.
+        Clusters about to be stopped by the group holding them are handed
+        over instead of being stopped and started again. Groups of suites
+        which do not exist anymore or with invalid clusters are removed.
+        '''
+        suiteClusters = {}
+        for groupId, j in self.jobQueue.heads():
+            if self.isJobGroupActive(groupId):
+                continue
+            if not self.testSuites.has_key(j.suiteName) or \
+                (j.job == Job.START_CLUSTER and not self.isJobValid(j)):
+                self.removeJobs(groupId)
+            else:
+                suiteClusters[j.suiteName] = \
+                                    self.testSuites[j.suiteName].clusters
+
+        for groupId, suiteName, handOvers in \
+            self.jobQueue.admitGroups(self.runningSuites, self.clusterOwners,
+                                      suiteClusters):
+            self.startSuiteRun(suiteName, groupId)
+            for stop_job, start_job in handOvers:
+                self.handOverCluster(stop_job, start_job)
+
+    def handOverCluster(self, stop_job, start_job):
+        '''
+        Pass running cluster from one job group to another, dropping the
+        stop job of the former and the start job of the latter.
+
+        @param stop_job: pending STOP_CLUSTER job of current cluster owner
+        @param start_job: pending START_CLUSTER job of the new owner
+        '''
+        clusterName = stop_job.args
+        LOGGER.info("Cluster %s handed over from job group %s to %s" % \
+                    (clusterName, stop_job.groupId, start_job.groupId))
+
+        self.clusterOwners[clusterName] = start_job.groupId
+        self.jobQueue.remove(stop_job)
+        self.jobQueue.remove(start_job)
+
+    def startJob(self, j):
+        '''
+        Start a job, if it's valid and the machines it concerns are ready,
+        and change its state to started.
+
+        @param j: job to start
+        @return: None
+        '''
+        if j.job == Job.INITIALIZE_TEST_SUITE:
+            if self.isJobValid(j):
+                if self.initializeTestSuite(j.args, j.groupId):
+                    self.jobQueue.start(j)
+        elif j.job == Job.FINALIZE_TEST_SUITE:
+            if self.finalizeTestSuite(j.args):
+                self.jobQueue.start(j)
+        elif j.job == Job.INITIALIZE_TEST_CASE:
+            if self.initializeTestCase(j.args[0], j.args[1], j.groupId):
+                self.jobQueue.start(j)
+        elif j.job == Job.RUN_TEST_CASE:
+            if self.runTestCase(j.args[0], j.args[1]):
+                self.jobQueue.start(j)
+        elif j.job == Job.FINALIZE_TEST_CASE:
+            if self.finalizeTestCase(j.args[0], j.args[1]):
+                self.jobQueue.start(j)
+        elif j.job == Job.START_CLUSTER:
+            if self.isJobValid(j):
+                if self.leaseCluster(j.args[0], j.groupId):
+                    # slaves may be connected already, go on without
+                    # waiting for another event
+                    self.skipJob(j)
+                elif self.reclaimCluster(j.args[0]):
+                    pass
+                elif self.awaitTeardown(j.args[0]):
+                    pass
+                elif self.startCluster(j.args[0], j.args[1], j.groupId):
+                    self.jobQueue.start(j)
+            else:
+                self.cancelTestSuite(j.suiteName)
+        elif j.job == Job.STOP_CLUSTER:
+            if self.parkCluster(j.args) or self.stopCluster(j.args):
+                self.jobQueue.start(j)
+        elif j.job == Job.SNAPSHOT_CLUSTER:
+            if not self.needsSnapshot(j.args[0], j.args[1]):
+                self.skipJob(j)
+            elif self.snapshotCluster(j.args[0], j.args[1]):
+                self.jobQueue.start(j)
+        elif j.job == Job.RESET_CLUSTER:
+            if not self.hasSnapshot(j.args[0], j.args[1]):
+                self.skipJob(j)
+            elif self.revertCluster(j.args[0], j.args[1], j.suiteName):
+                self.jobQueue.start(j)
+        else:
+            LOGGER.error("Job %s unrecognized" % j.job)
+
+    def skipJob(self, j):
+        '''
+        Remove a job with nothing left to do and start the next jobs of its
+        group right away.
+
+        @param j: job to skip
+        '''
+        self.jobQueue.remove(j)
+        self.startFront(j.groupId)
+
+    def startFront(self, groupId):
+        '''
+        Start the jobs at the front of a group's chain which are not started
+        yet. Consecutive cluster jobs are started together, so clusters of a
+        suite are started, reset or stopped in parallel.
+
+        @param groupId:
+        '''
+        for j in self.jobQueue.front(groupId):
+            # a job may have been skipped while starting the previous one
+            if j.state != Job.S_STARTED and j in self.jobQueue:
+                self.startJob(j)
+
+    def awaitTeardown(self, clusterName):
+        '''
+        Check if the start of a cluster should wait for clusters being
+        stopped, as no hypervisor has room for it before they are gone.
+
+        @param clusterName: name of the cluster to be started
+        @return: True if the start should wait
+        '''
+        stopping = [n for (n, c) in self.clusters.iteritems() \
+                    if c.state in (State(Cluster.S_STOPCOMMAND_SENT),
+                                   State(Cluster.S_DESTROYING_CLUSTER))]
+        if not stopping or self.clusterFits(clusterName):
+            return False
+
+        LOGGER.debug("Cluster %s waits for %s to be stopped" % \
+                     (clusterName, ', '.join(stopping)))
+        return True
+
     def startNextJob(self):
         '''
-        Start next possible job enqueued in pendingJobs list or continue
-        without doing anything. Check if first job on a list is not already
-        started, then check if it is valid and if it is, start it and change
-        it's status to started.
+        Start next possible jobs enqueued in the job queue or continue
+        without doing anything. Every job group runs its own chain of jobs:
+        first waiting job groups are begun if resources allow it, then the
+        front of every running chain is started, unless it is already.
+        Clusters are started and stopped asynchronously, the next job group
+        being provisioned while the former one finalizes and tears down.
 
-        @param test_suite_name:
         @return: None
         '''
         # log next jobs that are pending
-        if len(self.pendingJobsDbg) <= 7:
-            LOGGER.info("PENDING JOBS[%s] %s " % (len(self.pendingJobs), \
-                                                  self.pendingJobsDbg))
+        if len(self.jobQueue) <= 7:
+            LOGGER.info("PENDING JOBS[%s] %s " % (len(self.jobQueue), \
+                                                  self.jobQueue.debug()))
         else:
             LOGGER.info("PENDING JOBS[%s] (next 7) %s " % \
-                                                    (len(self.pendingJobs),
-                                                    self.pendingJobsDbg[:7]))
-        if len(self.pendingJobs) > 0:
-            j = self.pendingJobs[0]
-            # if job is not already started, we can start it
-            if not j.state == Job.S_STARTED:
-                if j.job == Job.INITIALIZE_TEST_SUITE:
-                    if self.isJobValid(j):
-                        if self.initializeTestSuite(j.args, j.groupId):
-                            self.pendingJobs[0].state = Job.S_STARTED
-                        #else:
-                        #    self.removeJobs(j.groupId)
-                elif j.job == Job.FINALIZE_TEST_SUITE:
-                    if self.finalizeTestSuite(j.args):
-                        self.pendingJobs[0].state = Job.S_STARTED
-                elif j.job == Job.INITIALIZE_TEST_CASE:
-                    if self.initializeTestCase(j.args[0], j.args[1],
-                                               j.groupId):
-                        self.pendingJobs[0].state = Job.S_STARTED
-                elif j.job == Job.RUN_TEST_CASE:
-                    if self.runTestCase(j.args[0], j.args[1]):
-                        self.pendingJobs[0].state = Job.S_STARTED
-                elif j.job == Job.FINALIZE_TEST_CASE:
-                    if self.finalizeTestCase(j.args[0], j.args[1]):
-                        self.pendingJobs[0].state = Job.S_STARTED
-                elif j.job == Job.START_CLUSTER:
-                    if self.isJobValid(j):
-                        if self.startCluster(j.args[0], j.args[1], j.groupId):
-                            self.pendingJobs[0].state = Job.S_STARTED
-                    else:
-                        self.removeJobs(j.groupId)
-                elif j.job == Job.STOP_CLUSTER:
-                    #if next job is starting cluster, don't stop it. Save time.
-                    if len(self.pendingJobs) > 1:
-                        nj = self.pendingJobs[1]
-                        if nj and nj.job == Job.START_CLUSTER and \
-                            nj.args == j.args:
-                            self.pendingJobs = self.pendingJobs[2:]
-                            self.pendingJobsDbg = self.pendingJobsDbg[2:]
-                            # self.startJobs()
-                            return
-                    if self.stopCluster(j.args):
-                        self.pendingJobs[0].state = Job.S_STARTED
-                else:
-                    LOGGER.error("Job %s unrecognized" % j.job)
+                                                    (len(self.jobQueue),
+                                                    self.jobQueue.debug(7)))
+
+        self.startJobGroups()
+
+        for groupId in self.jobQueue.groups():
+            if self.isJobGroupActive(groupId):
+                self.startFront(groupId)
 
     def removeJobs(self, groupId, jobType=Job.START_CLUSTER, testName=None):
         '''
@@ -1131,59 +2074,77 @@ class XrdTestMaster(Runnable):
         @param testName: used if removed jobs concerns particular test case
         @return: None
         '''
-        newJobs = []
-        newJobsDbg = []
-        i = 0
-        # condition checked on every element of jobs list
-        # tell if job is to be removed 
-        cond = lambda j: False
-        cond1 = lambda j: (j.groupId == groupId)
         # remove jobs if test suite initialize failed
         if jobType == Job.INITIALIZE_TEST_SUITE:
             LOGGER.debug("Removing next few jobs due to suite initialize fail.")
-            cond2 = lambda j: (j.job == Job.INITIALIZE_TEST_SUITE or \
-                     j.job == Job.FINALIZE_TEST_SUITE or \
-                     j.job == Job.INITIALIZE_TEST_CASE or \
-                     j.job == Job.RUN_TEST_CASE or \
-                     j.job == Job.FINALIZE_TEST_CASE)
-            cond = lambda j: cond1(j) and cond2(j)
+            removed = self.jobQueue.removeGroup(groupId,
+                                    (Job.INITIALIZE_TEST_SUITE,
+                                     Job.FINALIZE_TEST_SUITE,
+                                     Job.INITIALIZE_TEST_CASE,
+                                     Job.RUN_TEST_CASE,
+                                     Job.FINALIZE_TEST_CASE,
+                                     Job.SNAPSHOT_CLUSTER,
+                                     Job.RESET_CLUSTER))
         # remove jobs if test case initialize failed
         elif jobType == Job.INITIALIZE_TEST_CASE:
             LOGGER.debug("Removing next few jobs due to test initialize fail.")
-            cond2 = lambda j: (j.job == Job.INITIALIZE_TEST_CASE or \
-                     j.job == Job.RUN_TEST_CASE or \
-                     j.job == Job.FINALIZE_TEST_CASE)
-            cond3 = lambda j: j.args[1] == testName
-            cond = lambda j: cond1(j) and cond2(j) and cond3(j)
+            removed = self.jobQueue.removeGroup(groupId,
+                                    (Job.INITIALIZE_TEST_CASE,
+                                     Job.RUN_TEST_CASE,
+                                     Job.FINALIZE_TEST_CASE), testName)
         # remove jobs if cluster start failed
         else:
             LOGGER.info("Removing next few jobs due to cluster start fail.")
-            cond = lambda j: cond1(j)
+            removed = self.jobQueue.removeGroup(groupId)
 
-
-        for j in self.pendingJobs:
-            if cond(j):
-                LOGGER.debug("Removing job %s" % self.pendingJobsDbg[i])
-            else:
-                newJobs.append(j)
-                newJobsDbg.append(self.pendingJobsDbg[i])
-            i += 1
-        self.pendingJobs = newJobs
-        self.pendingJobsDbg = newJobsDbg
+        for j in removed:
+            LOGGER.debug("Removing job %s" % j)
 
     def removeJob(self, remove_job):
         '''
-        Look through queue of jobs and remove one, which satisfy conditions
-        defined by parameters of pattern job remove_job.
+        Remove started job, which satisfy conditions defined by parameters
+        of pattern job remove_job.
 
         @param remove_job: pattern of a job to be removed
         '''
-        if len(self.pendingJobs):
-            j = self.pendingJobs[0]
-            if j.state == Job.S_STARTED:
-                if j.job == remove_job.job and j.args == remove_job.args:
-                    self.pendingJobs = self.pendingJobs[1:]
-                    self.pendingJobsDbg = self.pendingJobsDbg[1:]
+        self.jobQueue.complete(remove_job)
+
+    def openStageBarrier(self, test_suite_name, jobType, slaves,
+                         test_name=None):
+        '''
+        Start waiting for slaves to finish a stage of a test suite run.
+
+        @param test_suite_name:
+        @param jobType: job type of the stage, e.g. Job.RUN_TEST_CASE
+        @param slaves: slaves the stage was sent to
+        @param test_name: test case name, for test case stages
+        '''
+        args = (test_suite_name, test_name) if test_name else test_suite_name
+        barrier = StageBarrier(str(Job(jobType, args=args)),
+                               [sl.hostname for sl in slaves])
+        self.stageBarriers.setdefault(test_suite_name, {})\
+            [(jobType, test_name)] = barrier
+
+    def stageFinished(self, test_suite_name, jobType, slave_name,
+                      test_name=None, error=False):
+        '''
+        Record that a slave finished a stage of a test suite run.
+
+        @param test_suite_name:
+        @param jobType: job type of the stage
+        @param slave_name: hostname of the slave
+        @param test_name: test case name, for test case stages
+        @param error: True if the stage failed on the slave
+        @return: barrier of the stage if this slave was the last one to
+                 finish it, None otherwise
+        '''
+        barriers = self.stageBarriers.get(test_suite_name, {})
+        barrier = barriers.get((jobType, test_name))
+        if not barrier or not barrier.arrive(slave_name, error):
+            return None
+
+        del barriers[(jobType, test_name)]
+        return barrier
 
     def procSlaveMsg(self, msg):
         '''
@@ -1215,26 +2176,26 @@ class XrdTestMaster(Runnable):
                 #---------------------------------------------------------------
                 if msg.result[2] != "0":
                     tss.state             = State(TestSuite.S_INIT_ERROR)
-                    slave.state           = State(Slave.S_SUITE_INITIALIZED)
-                    slave.state.suiteName = msg.suiteName
+                    slave.state           = self.suiteState(msg.suiteName)
 
                     LOGGER.error("%s slave initialization error in test suite %s" \
                                      % (slave.hostname, tss.name))
 
                     LOGGER.error(msg.result)
                 else:
-                    slave.state           = State(Slave.S_SUITE_INITIALIZED)
-                    slave.state.suiteName = msg.suiteName
+                    slave.state           = self.suiteState(msg.suiteName)
                     LOGGER.info("%s initialized in test suite %s" % \
                                 (slave, tss.name))
 
                 #---------------------------------------------------------------
                 # Wait for other slaves and react accordingly
                 #---------------------------------------------------------------
-                iSlaves = self.getSuiteSlaves(tss.suite,
-                                              State(Slave.S_SUITE_INITIALIZED))
-                if len(iSlaves) == len(tss.suite.machines):
-                    if tss.state != State(TestSuite.S_INIT_ERROR):
+                barrier = self.stageFinished(tss.name,
+                                             Job.INITIALIZE_TEST_SUITE,
+                                             slave.hostname,
+                                             error=(msg.result[2] != "0"))
+                if barrier:
+                    if not barrier.errors:
 
                         tss.state = State(TestSuite.S_ALL_INITIALIZED)
                         self.removeJob(Job(Job.INITIALIZE_TEST_SUITE, \
@@ -1256,7 +2217,7 @@ class XrdTestMaster(Runnable):
 
                         self.removeJobs(msg.jobGroupId, \
                                         Job.INITIALIZE_TEST_SUITE)
-                        self.runningSuite = None
+                        self.endSuiteRun(tss.name)
                         
                 self.storeSuiteSession(tss)
 
@@ -1280,9 +2241,8 @@ class XrdTestMaster(Runnable):
 
                 # Has the test suite been finalized on all slaves? If so,
                 # remove the suite_finalize job.
-                iSlaves = self.getSuiteSlaves(tss.suite, \
-                                            State(Slave.S_CONNECTED_IDLE))
-                if len(iSlaves) >= len(tss.suite.machines):
+                if self.stageFinished(tss.name, Job.FINALIZE_TEST_SUITE,
+                                      slave.hostname):
                     tss.state = State(TestSuite.S_ALL_FINALIZED)
 
                     tss.sendEmailAlert(tss.failed, tss.state)
@@ -1291,7 +2251,7 @@ class XrdTestMaster(Runnable):
                                        args=tss.name))
                     # Suite has finished running, so unset these
                     del self.runningSuiteUids[tss.name]
-                    self.runningSuite = None
+                    self.endSuiteRun(tss.name)
 
                 self.storeSuiteSession(tss)
 
@@ -1321,16 +2281,12 @@ class XrdTestMaster(Runnable):
 
                 # Has the test case been initialized on all slaves? If so,
                 # remove the case_init job.
-                waitSlaves = self.getSuiteSlaves(tss.suite, test_case=tc)
-                readySlaves = self.getSuiteSlaves(tss.suite, \
-                                            State(Slave.S_TEST_INITIALIZED),
-                                            test_case=tc)
-                errorSlaves = self.getSuiteSlaves(tss.suite, \
-                                            State(Slave.S_TEST_INIT_ERROR),
-                                            test_case=tc)
-
-                if len(waitSlaves) == len(readySlaves+errorSlaves):
-                    if not len( errorSlaves ):
+                barrier = self.stageFinished(tss.name,
+                                             Job.INITIALIZE_TEST_CASE,
+                                             slave.hostname, tc.name,
+                                             error=(msg.result[2] != "0"))
+                if barrier:
+                    if not barrier.errors:
                         tss.state = State(TestSuite.S_ALL_TEST_INITIALIZED)
 
                         self.removeJob(Job(Job.INITIALIZE_TEST_CASE, \
@@ -1344,7 +2300,6 @@ class XrdTestMaster(Runnable):
                         self.removeJobs(msg.jobGroupId,
                                         Job.INITIALIZE_TEST_CASE,
                                         tc.name)
-                        self.runningSuite = None
 
                 self.storeSuiteSession(tss)
 
@@ -1370,11 +2325,8 @@ class XrdTestMaster(Runnable):
 
                 # Has the tast case finished running on all slaves? If so, 
                 # remove the case_run job.
-                waitSlaves = self.getSuiteSlaves(tss.suite, test_case=tc)
-                readySlaves = self.getSuiteSlaves(tss.suite, \
-                                            State(Slave.S_TEST_RUN_FINISHED),
-                                            test_case=tc)
-                if len(waitSlaves) == len(readySlaves):
+                if self.stageFinished(tss.name, Job.RUN_TEST_CASE,
+                                      slave.hostname, tc.name):
                     tss.state = State(TestSuite.S_ALL_TEST_RUN_FINISHED)
 
                     self.removeJob(Job(Job.RUN_TEST_CASE, \
@@ -1389,8 +2341,7 @@ class XrdTestMaster(Runnable):
             elif msg.state == State(TestSuite.S_SLAVE_TEST_FINALIZED):
 
                 tss = self.retrieveSuiteSession(msg.suiteName)
-                slave.state = State(Slave.S_SUITE_INITIALIZED)
-                slave.state.suiteName = msg.suiteName
+                slave.state = self.suiteState(msg.suiteName)
                 LOGGER.info("%s finalized test %s in suite %s" % \
                             (slave, msg.testName, tss.name))
 
@@ -1404,11 +2355,8 @@ class XrdTestMaster(Runnable):
 
                 # Has the test case been finalized on all slaves? If so,
                 # remove the case_finalize job.
-                waitSlaves = self.getSuiteSlaves(tss.suite, test_case=tc)
-                readySlaves = self.getSuiteSlaves(tss.suite, \
-                                            State(Slave.S_SUITE_INITIALIZED),
-                                            test_case=tc)
-                if len(waitSlaves) == len(readySlaves):
+                if self.stageFinished(tss.name, Job.FINALIZE_TEST_CASE,
+                                      slave.hostname, tc.name):
                     tss.state = State(TestSuite.S_ALL_TEST_FINALIZED)
 
                     tss.sendEmailAlert(tc.failed, tss.state, \
@@ -1427,119 +2375,222 @@ class XrdTestMaster(Runnable):
 
     def handleTagRequest(self, slavename):
         ''' TODO: '''
-        for slave in self.slaves.itervalues():
-            if slave.hostname == slavename:
-                msg = XrdMessage(XrdMessage.M_TAG_REPLY)
-                msg.proto = self.webInterface.protocol
-                msg.port = self.webInterface.port
-
-                # Find disk definitions
-                disks = []
-                for cluster in self.clusters.itervalues():
-                    if cluster.state == Cluster.S_ACTIVE:
-                        for host in cluster.hosts:
-                            if host.name == slavename \
-                            and host.clusterName == cluster.name:
-                                disks = host.disks
-
-                diskMountTemplate = '''
-                    if [ ! -d %(mountpoint)s ]; then mkdir %(mountpoint)s; fi
-
-                    mount -t ext4 -o user_xattr /dev/%(device)s %(mountpoint)s
-                    chown $XROOTD_USER.$XROOTD_GROUP %(mountpoint)s
-                    '''
-
-                if len(disks):
-                    msg.diskMounts = ''
-                    for disk in disks:
-                        values = dict()
-                        values['mountpoint'] = disk.mountPoint
-                        values['device'] = disk.device
-                        msg.diskMounts += diskMountTemplate % values
-
-                # Add log file paths
-                if self.runningSuite and self.testSuites.has_key(self.runningSuite.name):
-                    msg.logFiles = self.testSuites[self.runningSuite.name].logs
-
-                slave.send(msg)
+        slave = self.slaves.get(slavename)
+        if slave:
+            msg = XrdMessage(XrdMessage.M_TAG_REPLY)
+            msg.proto = self.webInterface.protocol
+            msg.port = self.webInterface.port
+
+            # Find disk definitions
+            disks = []
+            for cluster in self.clusters.itervalues():
+                if cluster.state == Cluster.S_ACTIVE:
+                    for host in cluster.hosts:
+                        if host.name == slavename \
+                        and host.clusterName == cluster.name:
+                            disks = host.disks
+
+            diskMountTemplate = '''
+                if [ ! -d %(mountpoint)s ]; then mkdir %(mountpoint)s; fi
+
+                mount -t %(fstype)s %(options)s /dev/%(device)s %(mountpoint)s
+                chown $XROOTD_USER.$XROOTD_GROUP %(mountpoint)s
+                '''
+
+            if len(disks):
+                msg.diskMounts = ''
+                for disk in disks:
+                    values = dict()
+                    values['mountpoint'] = disk.mountPoint
+                    values['device'] = disk.device
+                    values['fstype'] = disk.fsType
+                    values['options'] = ''
+                    if disk.fsType.startswith('ext'):
+                        values['options'] = '-o user_xattr'
+                    msg.diskMounts += diskMountTemplate % values
+
+            # Add log file paths of the suite running on the slave
+            for suiteName in self.runningSuites.iterkeys():
+                if self.testSuites.has_key(suiteName) and \
+                    slavename in self.testSuites[suiteName].machines:
+                    msg.logFiles = self.testSuites[suiteName].logs
+
+            slave.send(msg)
 
     def procEvents(self):
         '''
         Main loop processing incoming MasterEvents from main events queue:
-        self.recvQueue. MasterEvents with higher priority are handled first.
+        self.recvQueue. MasterEvents with higher priority are handled first,
+        those of equal priority in order of their arrival. Events queued at
+        once, e.g. a burst of slave messages, are processed in one pass.
         '''
         while True:
-            evt = self.recvQueue.get()
-
-            if evt.type == MasterEvent.M_UNKNOWN:
-                msg = evt.data
-                LOGGER.debug("Received from [%s] %s" % (msg.sender, msg.name))
-
-            # Event of client connect
-            elif evt.type == MasterEvent.M_CLIENT_CONNECTED:
-                self.handleClientConnected(evt.data[0], evt.data[1], \
-                                           evt.data[2], evt.data[3])
-
-            # Event of client disconnect
-            elif evt.type == MasterEvent.M_CLIENT_DISCONNECTED:
-                self.handleClientDisconnected(evt.data[0], evt.data[1])
-
-            # Messages from hypervisors
-            elif evt.type == MasterEvent.M_HYPERV_MSG:
-                msg = evt.data
-                if msg.name == XrdMessage.M_CLUSTER_STATE:
-                    if self.clusters.has_key(msg.clusterName):
-                        self.clusters[msg.clusterName].state = msg.state
-                        LOGGER.info(("Cluster state received [%s] %s") % \
-                                    (msg.clusterName, str(msg.state)))
-                        if msg.state == Cluster.S_WAITING_SLAVES:
+            events = self.recvQueue.get_many(self.eventBatchSize)
+            waiting = len(self.recvQueue) + len(events)
+            for evt in events:
+                waiting -= 1
+                self.eventStats.eventDequeued(evt, waiting)
+                start = time.time()
+                self.procEvent(evt)
+                self.eventStats.eventHandled(evt, time.time() - start)
+
+            # Events occurred in the system, so an opportunity might occur to
+            # start next job
+            start = time.time()
+            self.startNextJob()
+            self.eventStats.sectionDone('startNextJob', time.time() - start)
+
+    def procEvent(self, evt):
+        '''
+        Process a single MasterEvent.
+
+        @param evt: MasterEvent object
+        '''
+        if evt.type == MasterEvent.M_UNKNOWN:
+            msg = evt.data
+            LOGGER.debug("Received from [%s] %s" % (msg.sender, msg.name))
+
+        # Event of client connect
+        elif evt.type == MasterEvent.M_CLIENT_CONNECTED:
+            self.handleClientConnected(evt.data[0], evt.data[1], \
+                                       evt.data[2], evt.data[3])
+
+        # Event of client disconnect
+        elif evt.type == MasterEvent.M_CLIENT_DISCONNECTED:
+            self.handleClientDisconnected(evt.data[0], evt.data[1])
+
+        # Messages from hypervisors
+        elif evt.type == MasterEvent.M_HYPERV_MSG:
+            msg = evt.data
+            if msg.name == XrdMessage.M_CLUSTER_STATE:
+                if self.clusters.has_key(msg.clusterName):
+                    LOGGER.info(("Cluster state received [%s] %s") % \
+                                (msg.clusterName, str(msg.state)))
+                    # A cluster can not be reverted to a snapshot which
+                    # failed on any of its parts
+                    if not getattr(msg, 'snapshotTaken', True):
+                        self.clusterSnapshots[msg.clusterName] = None
+                    if not self.clusterPartReported(msg):
+                        return
+                    self.clusters[msg.clusterName].state = msg.state
+                    if msg.state == Cluster.S_WAITING_SLAVES:
+                        if getattr(msg, 'snapshot', None):
+                            self.removeJob(Job(Job.RESET_CLUSTER, \
+                                               args=(msg.clusterName,
+                                                     msg.snapshot)))
+                        elif self.clusterOwners.get(msg.clusterName) == \
+                            self.prestartGroupId(msg.clusterName):
+                            # Started ahead, waits for the scheduled run
+                            self.releaseCluster(msg.clusterName)
+                            self.clusterPool.park(msg.clusterName)
+                        else:
                             self.removeJob(Job(Job.START_CLUSTER, \
                                                args=(msg.clusterName,
                                                      msg.suiteName)))
-                        elif msg.state == Cluster.S_ERROR_START:
-                            LOGGER.error("Cluster error: %s" % msg.state)
-                            self.removeJobs(msg.jobGroupId)
-                        elif msg.state == State(Cluster.S_STOPPED):
-                            self.removeJob(Job(Job.STOP_CLUSTER, \
-                                               args=msg.clusterName))
-                        elif msg.state == State(Cluster.S_ERROR_STOP):
-                            LOGGER.error("Cluster error: %s" % msg.state)
-                            self.removeJob(Job(Job.STOP_CLUSTER, \
-                                               args=msg.clusterName))
-                    else:
-                        raise XrdTestMasterException("Unknown cluster " + \
-                                                     "state received: " + \
-                                                     msg.clusterName)
-
-                elif msg.name == XrdMessage.M_HYPERVISOR_STATE:
-                    if self.hypervisors.has_key(msg.sender):
-                        self.hypervisors[msg.sender].states.append(msg.state)
-
-            # Messages from slaves
-            elif evt.type == MasterEvent.M_SLAVE_MSG:
-                msg = evt.data
-                self.procSlaveMsg(msg)
-
-            # Messages from scheduler's threads
-            elif evt.type == MasterEvent.M_JOB_ENQUEUE:
-                self.enqueueJob(evt.data)
-
-            # Messages from cluster definitions directory monitoring threads 
-            elif evt.type == MasterEvent.M_RELOAD_CLUSTER_DEF:
-                self.handleClusterDefinitionChanged(evt.data)
-
-            # Messages from test suits definitions directory monitoring threads
-            elif evt.type == MasterEvent.M_RELOAD_SUITE_DEF:
-                self.handleSuiteDefinitionChanged(evt.data)
-
-            # Incoming message is unknown
-            else:
-                raise XrdTestMasterException("Unknown incoming evt type " + \
-                                             str(evt.type))
-
-            # Event occurred in the system, so an opportunity might occur to
-            # start next job
-            self.startNextJob()
+                    elif msg.state == State(Cluster.S_ACTIVE):
+                        snapshots = self.clusterSnapshots.get(msg.clusterName)
+                        if snapshots is not None:
+                            snapshots.append(msg.snapshot)
+                        self.removeJob(Job(Job.SNAPSHOT_CLUSTER, \
+                                           args=(msg.clusterName,
+                                                 msg.snapshot)))
+                    elif msg.state == State(Cluster.S_ERROR):
+                        LOGGER.error("Cluster error: %s" % msg.state)
+                        # Not reverted, the test suite can not go on
+                        self.clusterSnapshots[msg.clusterName] = None
+                        groupId = self.clusterOwners.get(msg.clusterName)
+                        self.removeJobs(groupId)
+                        for c, owner in self.clusterOwners.items():
+                            if owner == groupId:
+                                self.stopCluster(c)
+                        for suiteName, g in self.runningSuites.items():
+                            if g == groupId:
+                                self.endSuiteRun(suiteName)
+                    elif msg.state == Cluster.S_ERROR_START:
+                        LOGGER.error("Cluster error: %s" % msg.state)
+                        # Stop parts of a split cluster started elsewhere
+                        others = [h for h in self.clusterHypervisors.get(
+                                  msg.clusterName, []) \
+                                  if h.address != msg.sender]
+                        if others and \
+                            self.clusterOwners.has_key(msg.clusterName):
+                            self.clusterHypervisors[msg.clusterName] = others
+                            self.stopCluster(msg.clusterName)
+                            self.clusters[msg.clusterName].state = msg.state
+                        self.releaseCluster(msg.clusterName)
+                        self.clusterPool.forget(msg.clusterName)
+                        self.removeJobs(msg.jobGroupId)
+                        # Stop clusters already started for the suite
+                        for c, owner in self.clusterOwners.items():
+                            if owner == msg.jobGroupId:
+                                self.stopCluster(c)
+                        if self.runningSuites.get(msg.suiteName) == \
+                            msg.jobGroupId:
+                            self.endSuiteRun(msg.suiteName)
+                    elif msg.state == State(Cluster.S_IDLE):
+                        # Reverted to the first snapshot, if it had any
+                        if self.clusterSnapshots.get(msg.clusterName):
+                            del self.clusterSnapshots[msg.clusterName][1:]
+                        self.releaseCluster(msg.clusterName)
+                        self.removeJob(Job(Job.STOP_CLUSTER, \
+                                           args=msg.clusterName))
+                        self.clusterPool.park(msg.clusterName)
+                        self.evictIdleClusters()
+                    elif msg.state == State(Cluster.S_STOPPED):
+                        self.releaseCluster(msg.clusterName)
+                        self.removeJob(Job(Job.STOP_CLUSTER, \
+                                           args=msg.clusterName))
+                        self.clusterPool.forget(msg.clusterName)
+                        self.clusterSnapshots.pop(msg.clusterName, None)
+                    elif msg.state == State(Cluster.S_ERROR_STOP):
+                        LOGGER.error("Cluster error: %s" % msg.state)
+                        self.releaseCluster(msg.clusterName)
+                        self.removeJob(Job(Job.STOP_CLUSTER, \
+                                           args=msg.clusterName))
+                        self.clusterPool.forget(msg.clusterName)
+                        self.clusterSnapshots.pop(msg.clusterName, None)
+                else:
+                    raise XrdTestMasterException("Unknown cluster " + \
+                                                 "state received: " + \
+                                                 msg.clusterName)
+
+            elif msg.name == XrdMessage.M_HYPERVISOR_STATE:
+                if self.hypervisors.has_key(msg.sender):
+                    hyperv = self.hypervisors[msg.sender]
+                    if msg.state:
+                        hyperv.states.append(msg.state)
+                    if getattr(msg, 'capacity', None):
+                        hyperv.capacity = msg.capacity
+                        LOGGER.info("Capacity of %s: %s" % \
+                                    (hyperv, msg.capacity))
+
+        # Messages from slaves
+        elif evt.type == MasterEvent.M_SLAVE_MSG:
+            msg = evt.data
+            self.procSlaveMsg(msg)
+
+        # Messages from scheduler's threads
+        elif evt.type == MasterEvent.M_JOB_ENQUEUE:
+            self.enqueueJob(evt.data)
+
+        # Messages from cluster definitions directory monitoring threads 
+        elif evt.type == MasterEvent.M_RELOAD_CLUSTER_DEF:
+            self.handleClusterDefinitionChanged(evt.data)
+
+        # Messages from test suits definitions directory monitoring threads
+        elif evt.type == MasterEvent.M_RELOAD_SUITE_DEF:
+            self.handleSuiteDefinitionChanged(evt.data)
+
+        # Periodic check of idle warm clusters and of clusters to be
+        # started ahead of scheduled runs
+        elif evt.type == MasterEvent.M_EVICT_CLUSTERS:
+            self.evictIdleClusters()
+            self.prestartClusters()
+
+        # Incoming message is unknown
+        else:
+            raise XrdTestMasterException("Unknown incoming evt type " + \
+                                         str(evt.type))
 
     def startTCPServer(self):
         '''
@@ -1695,9 +2746,7 @@ openssl req -new -batch -x509 -extensions v3_ca \
         '''
         TODO:
         '''
-        for repo in map(lambda x: x.strip(), filter(lambda x: x, self.config.get('general', 'test-repos').split(','))):
-            repo = 'test-repo-' + repo
-
+        for repo in self.getRepos():
             if self.config.get(repo, 'type') == 'localfs':
                 self.watchedDirectories[repo] = DirectoryWatch(repo, self.config, \
                         self.fireReloadDefinitionsEvent, DirectoryWatch.watch_localfs)
@@ -1736,6 +2785,9 @@ openssl req -new -batch -x509 -extensions v3_ca \
         # directory monitoring (local and remote)
         self.watchDirectories()
 
+        # Stop warm clusters idle for too long
+        self.startClusterPoolTimer()
+
         # Process events incoming to the system MasterEvents
         self.procEvents()
 
@@ -1744,6 +2796,8 @@ openssl req -new -batch -x509 -extensions v3_ca \
             wd.stop()
         # synchronize suits sessions list with HDD storage and close
         self.suiteSessions.close()
+        if self.definitionCache:
+            self.definitionCache.close()
 
     def readConfig(self, confFile):
             '''
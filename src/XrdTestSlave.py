@@ -44,6 +44,7 @@ try:
     import threading
     import re
     import datetime
+    import time
 
     from XrdTest.Daemon import Daemon, DaemonException, Runnable
     from XrdTest.TCPClient import TCPReceiveThread
@@ -275,9 +276,33 @@ class XrdTestSlave(Runnable):
                     command = command.replace(tag, value)
         return command
             
+    def tryConnect(self):
+        '''
+        Attempt to connect to the master. Retry every 5 seconds, up to a
+        maximum of 500 times.
+        '''
+        for i in xrange(500):
+            LOGGER.debug('Connection attempt: %s' % str(i))
+            sock = self.connectMaster(self.config.get('test_master', 'ip'),
+                           self.config.getint('test_master', 'port'))
+            if sock:
+                tcpReceiveTh = TCPReceiveThread(self.sockStream, self.recvQueue)
+                thTcpReceive = threading.Thread(target=tcpReceiveTh.run)
+                thTcpReceive.start()
+                return sock
+            time.sleep(5)
+        return None
+
     def connectMaster(self, masterName, masterPort):
         ''' TODO: '''
         sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Notice soon a connection the master no longer has, e.g. after this
+        # machine was reverted to a snapshot taken while it was connected
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, 10)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 5)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
         try:
             self.sockStream = ssl.wrap_socket(sock, server_side=False,
                                         certfile=\
@@ -403,6 +428,10 @@ class XrdTestSlave(Runnable):
             try:
                 #receive msg from master
                 msg = self.recvQueue.get()
+
+                if isinstance(msg, Exception):
+                    raise msg
+
                 LOGGER.info("Received msg: " + str(msg.name))
 
                 resp = XrdMessage(XrdMessage.M_UNKNOWN)
@@ -425,20 +454,18 @@ class XrdTestSlave(Runnable):
                 LOGGER.debug("Sent msg: " + str(resp))
             except SocketDisconnectedError:
                 LOGGER.info("Connection to XrdTestMaster closed.")
-                sys.exit()
-                break
+
+                # Try to reconnect
+                if not self.tryConnect():
+                    sys.exit()
+                    break
 
     def run(self):
         ''' TODO: '''
-        sock = self.connectMaster(self.config.get('test_master', 'ip'),
-                           self.config.getint('test_master', 'port'))
+        sock = self.tryConnect()
         if not sock:
             return
 
-        tcpReceiveTh = TCPReceiveThread(self.sockStream, self.recvQueue)
-        thTcpReceive = threading.Thread(target=tcpReceiveTh.run)
-        thTcpReceive.start()
-
         self.recvLoop()
 
     def readConfig(self, confFile):
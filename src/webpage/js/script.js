@@ -158,6 +158,10 @@ function main(anchors) {
 
     $('.sidetab-switch a').click(function() {
         var sidetab = $(this).attr('href');
+        // Links to other pages, e.g. runs loaded on demand
+        if (sidetab.charAt(0) != '#') {
+            return true;
+        }
         $(this).parent().siblings().find('a').removeClass('current');
         $(this).addClass('current');
         $(sidetab).siblings('.sidetab').hide();
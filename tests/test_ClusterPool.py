@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+#-------------------------------------------------------------------------------
+#
+# Copyright (c) 2011-2012 by European Organization for Nuclear Research (CERN)
+# Author: Justin Salmon <jsalmon@cern.ch>
+#
+# This file is part of XrdTest.
+#
+# XrdTest is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# XrdTest is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with XrdTest.  If not, see <http://www.gnu.org/licenses/>.
+#
+#-------------------------------------------------------------------------------
+#
+# File:    test_ClusterPool
+# Desc:    Eviction of warm clusters: idle timeout, pool size and clusters
+#          reserved for scheduled runs. Run with
+#          python -m unittest discover tests
+#
+#-------------------------------------------------------------------------------
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+from XrdTest.ClusterPool import ClusterPool
+
+class ClusterPoolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.pool = ClusterPool(idleTimeout=100, maxIdle=2)
+
+    def park(self, clusterName, at, reservedUntil=None):
+        self.pool.park(clusterName)
+        self.pool.idle[clusterName] = at
+        if reservedUntil is not None:
+            self.pool.reserve(clusterName, reservedUntil)
+
+    def testIdleTimeout(self):
+        self.park('c1', 0)
+        self.park('c2', 50)
+        self.assertEqual(self.pool.expired(now=100), [])
+        self.assertEqual(self.pool.expired(now=120), ['c1'])
+        self.assertEqual(sorted(self.pool.expired(now=160)), ['c1', 'c2'])
+
+    def testLeastRecentlyUsedExceedPoolSize(self):
+        self.park('c2', 10)
+        self.park('c3', 20)
+        self.park('c1', 0)
+        self.assertEqual(self.pool.expired(now=30), ['c1'])
+        self.assertEqual(self.pool.leastRecentlyUsed(), 'c1')
+
+        self.park('c4', 30)
+        self.assertEqual(self.pool.expired(now=40), ['c1', 'c2'])
+
+    def testReservedClustersEvictedForExcessLast(self):
+        self.park('c1', 0, reservedUntil=1000)
+        self.park('c2', 10)
+        self.park('c3', 20)
+        self.assertEqual(self.pool.expired(now=30), ['c2'])
+        self.assertEqual(self.pool.leastRecentlyUsed(), 'c2')
+
+    def testReservationsAloneExceedPoolSize(self):
+        self.park('c2', 10, reservedUntil=1000)
+        self.park('c1', 0, reservedUntil=1000)
+        self.park('c3', 20, reservedUntil=1000)
+        self.assertEqual(self.pool.expired(now=30), ['c1'])
+
+    def testReservedClusterKeptPastIdleTimeout(self):
+        self.park('c1', 0, reservedUntil=500)
+        self.assertEqual(self.pool.expired(now=400), [])
+        self.assertEqual(self.pool.leastRecentlyUsed(), 'c1')
+
+    def testEndedReservation(self):
+        self.park('c1', 0, reservedUntil=500)
+        self.park('c2', 420)
+        self.assertEqual(self.pool.expired(now=450), [])
+        self.assertEqual(self.pool.expired(now=501), ['c1'])
+
+        # listed once, though exceeding the pool size as well
+        self.park('c3', 450)
+        self.assertEqual(self.pool.expired(now=501), ['c1'])
+
+    def testLeaseEndsReservation(self):
+        self.park('c1', 0, reservedUntil=500)
+        self.assertTrue(self.pool.lease('c1'))
+        self.assertEqual(self.pool.reserved, {})
+        self.assertEqual(self.pool.expired(now=600), [])
+        self.assertFalse(self.pool.lease('c1'))
+
+if __name__ == '__main__':
+    unittest.main()
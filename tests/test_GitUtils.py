@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+#-------------------------------------------------------------------------------
+#
+# Copyright (c) 2011-2012 by European Organization for Nuclear Research (CERN)
+# Author: Justin Salmon <jsalmon@cern.ch>
+#
+# This file is part of XrdTest.
+#
+# XrdTest is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# XrdTest is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with XrdTest.  If not, see <http://www.gnu.org/licenses/>.
+#
+#-------------------------------------------------------------------------------
+#
+# File:    test_GitUtils
+# Desc:    Synchronization of test repositories, against a local bare git
+#          repository serving as the remote. Run with
+#          python -m unittest discover tests
+#
+#-------------------------------------------------------------------------------
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import unittest
+from ConfigParser import ConfigParser
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+from XrdTest.GitUtils import sync_remote_git
+
+
+def git(cwd, *args):
+    subprocess.check_call(('git',) + args, cwd=cwd,
+                          stdout=open(os.devnull, 'w'),
+                          stderr=subprocess.STDOUT)
+
+class SyncRemoteGitTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.remote = os.path.join(self.dir, 'remote.git')
+        self.work = os.path.join(self.dir, 'work')
+        self.local = os.path.join(self.dir, 'local')
+
+        os.mkdir(self.remote)
+        git(self.remote, 'init', '--bare')
+        git(self.remote, 'symbolic-ref', 'HEAD', 'refs/heads/master')
+        os.mkdir(self.work)
+        git(self.work, 'init')
+        git(self.work, 'checkout', '-b', 'master')
+        self.commit('clusters.py', 'first')
+        git(self.work, 'remote', 'add', 'origin', self.remote)
+        git(self.work, 'push', 'origin', 'master')
+
+        self.config = ConfigParser()
+        self.config.add_section('test-repo-local')
+        for (option, value) in (('remote_repo', self.remote),
+                                ('local_path', self.local),
+                                ('local_branch', 'master'),
+                                ('remote_branch', 'origin/master')):
+            self.config.set('test-repo-local', option, value)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def commit(self, name, content):
+        open(os.path.join(self.work, name), 'w').write(content)
+        git(self.work, 'add', name)
+        git(self.work, '-c', 'user.name=test', '-c', 'user.email=test@test',
+            'commit', '-m', content)
+
+    def content(self, name):
+        return open(os.path.join(self.local, name)).read()
+
+    def testCloneThenPull(self):
+        sync_remote_git('test-repo-local', self.config, 60)
+        self.assertEqual(self.content('clusters.py'), 'first')
+
+        self.commit('clusters.py', 'second')
+        git(self.work, 'push', 'origin', 'master')
+        sync_remote_git('test-repo-local', self.config, 60)
+        self.assertEqual(self.content('clusters.py'), 'second')
+
+    def testStaleLockRemovedAfterTimeout(self):
+        sync_remote_git('test-repo-local', self.config, 60)
+        lock = os.path.join(self.local, '.git', 'index.lock')
+        open(lock, 'w').close()
+
+        sync_remote_git('test-repo-local', self.config, 0)
+        self.assertFalse(os.path.exists(lock))
+
+        self.commit('clusters.py', 'second')
+        git(self.work, 'push', 'origin', 'master')
+        sync_remote_git('test-repo-local', self.config, 60)
+        self.assertEqual(self.content('clusters.py'), 'second')
+
+if __name__ == '__main__':
+    unittest.main()
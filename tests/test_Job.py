@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+#-------------------------------------------------------------------------------
+#
+# Copyright (c) 2011-2012 by European Organization for Nuclear Research (CERN)
+# Author: Justin Salmon <jsalmon@cern.ch>
+#
+# This file is part of XrdTest.
+#
+# XrdTest is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# XrdTest is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with XrdTest.  If not, see <http://www.gnu.org/licenses/>.
+#
+#-------------------------------------------------------------------------------
+#
+# File:    test_Job
+# Desc:    Order in which jobs of the job queue are run, and bookkeeping of
+#          started and removed jobs. Run with
+#          python -m unittest discover tests
+#
+#-------------------------------------------------------------------------------
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..', 'src'))
+from XrdTest.Job import Job, JobQueue
+
+def suiteJobs(groupId, suiteName, clusters, tests):
+    '''
+    Jobs of a test suite run, enqueued like the master does.
+    '''
+    jobs = [Job(Job.START_CLUSTER, groupId, (c, suiteName), suiteName) \
+            for c in clusters]
+    jobs.append(Job(Job.INITIALIZE_TEST_SUITE, groupId, suiteName, suiteName))
+    for t in tests:
+        for jobType in (Job.INITIALIZE_TEST_CASE, Job.RUN_TEST_CASE,
+                        Job.FINALIZE_TEST_CASE):
+            jobs.append(Job(jobType, groupId, (suiteName, t), suiteName))
+    jobs.append(Job(Job.FINALIZE_TEST_SUITE, groupId, suiteName, suiteName))
+    jobs.extend(Job(Job.STOP_CLUSTER, groupId, c, suiteName) \
+                for c in clusters)
+    return jobs
+
+class JobQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = JobQueue()
+
+    def enqueue(self, jobs):
+        for j in jobs:
+            self.queue.add(j)
+        return jobs
+
+    def runFront(self, groupId):
+        '''
+        Start the jobs at the front of the group's chain and complete them.
+        @return: names of the jobs
+        '''
+        front = self.queue.front(groupId)
+        for j in front:
+            self.queue.start(j)
+        for j in front:
+            self.assertTrue(self.queue.complete(Job(j.job, args=j.args)) is j)
+        return [str(j) for j in front]
+
+    def testChainRunsInOrderOfEnqueuing(self):
+        jobs = self.enqueue(suiteJobs('g1', 's1', ['c1'], ['t1', 't2']))
+        self.assertEqual(self.queue.jobs('g1'), jobs)
+        self.assertEqual(len(self.queue), len(jobs))
+
+        ran = []
+        while self.queue.head('g1'):
+            ran.extend(self.runFront('g1'))
+        self.assertEqual(ran, [str(j) for j in jobs])
+        self.assertEqual(len(self.queue), 0)
+        self.assertEqual(self.queue.groups(), [])
+
+    def testGroupsInterleaveButKeepTheirOrder(self):
+        first = self.enqueue(suiteJobs('g1', 's1', [], ['t1']))
+        second = self.enqueue(suiteJobs('g2', 's2', [], ['t1']))
+        self.assertEqual(self.queue.groups(), ['g1', 'g2'])
+        self.assertEqual(self.queue.heads(), [('g1', first[0]),
+                                              ('g2', second[0])])
+
+        self.runFront('g2')
+        self.assertEqual(self.queue.head('g2'), second[1])
+        self.assertEqual(self.queue.head('g1'), first[0])
+
+    def testFrontGroupsConcurrentClusterJobs(self):
+        self.enqueue(suiteJobs('g1', 's1', ['c1', 'c2', 'c3'], ['t1']))
+        self.assertEqual([str(j) for j in self.queue.front('g1')],
+                         ['startCluster(c1)', 'startCluster(c2)',
+                          'startCluster(c3)'])
+        self.runFront('g1')
+
+        # not concurrent, run alone
+        self.assertEqual([str(j) for j in self.queue.front('g1')],
+                         ['initSuite(s1)'])
+        while self.queue.front('g1')[0].job != Job.STOP_CLUSTER:
+            self.runFront('g1')
+        self.assertEqual([str(j) for j in self.queue.front('g1')],
+                         ['stopCluster(c1)', 'stopCluster(c2)',
+                          'stopCluster(c3)'])
+
+    def testFrontStopsAtOtherClusterJobType(self):
+        jobs = self.enqueue([
+                Job(Job.START_CLUSTER, 'g1', ('c1', 's1'), 's1'),
+                Job(Job.SNAPSHOT_CLUSTER, 'g1', ('c1', 'clean'), 's1'),
+                Job(Job.START_CLUSTER, 'g1', ('c2', 's1'), 's1')])
+        self.assertEqual(self.queue.front('g1'), jobs[:1])
+        self.assertEqual(self.queue.front('nosuchgroup'), [])
+
+    def testFrontRunsTestCaseJobsOneByOne(self):
+        jobs = self.enqueue([
+                Job(Job.RUN_TEST_CASE, 'g1', ('s1', 't1'), 's1'),
+                Job(Job.RUN_TEST_CASE, 'g1', ('s1', 't2'), 's1')])
+        self.assertEqual(self.queue.front('g1'), jobs[:1])
+
+    def testCompleteRemovesTheStartedJob(self):
+        # same cluster started by two runs of the same suite
+        waiting = self.enqueue(suiteJobs('g1', 's1', ['c1'], []))
+        running = self.enqueue(suiteJobs('g2', 's1', ['c1'], []))
+        self.queue.start(running[0])
+
+        pattern = Job(Job.START_CLUSTER, args=('c1', 's1'))
+        self.assertTrue(self.queue.complete(pattern) is running[0])
+        self.assertEqual(self.queue.jobs('g1'), waiting)
+        self.assertEqual(self.queue.jobs('g2'), running[1:])
+        self.assertTrue(waiting[0] in self.queue)
+
+        # only started jobs are completed
+        self.assertEqual(self.queue.complete(pattern), None)
+        self.assertEqual(self.queue.jobs('g1'), waiting)
+
+    def testRemoveGroupOfTestCase(self):
+        jobs = self.enqueue(suiteJobs('g1', 's1', ['c1'], ['t1', 't2']))
+        testTypes = (Job.INITIALIZE_TEST_CASE, Job.RUN_TEST_CASE,
+                     Job.FINALIZE_TEST_CASE)
+        testJobs = [j for j in jobs if j.job in testTypes]
+        self.queue.start(testJobs[0])
+
+        removed = self.queue.removeGroup('g1', testTypes, 't1')
+        self.assertEqual(removed, testJobs[:3])
+        self.assertEqual(self.queue.jobs('g1'),
+                         [j for j in jobs if j not in removed])
+        self.assertEqual(len(self.queue), len(jobs) - 3)
+        self.assertFalse(testJobs[0] in self.queue)
+        self.assertEqual(self.queue.startedJobs, {})
+        self.assertEqual(self.queue.jobs(jobType=Job.RUN_TEST_CASE),
+                         [testJobs[4]])
+
+    def testRemoveGroupCleansIndexes(self):
+        jobs = self.enqueue(suiteJobs('g1', 's1', ['c1'], ['t1']))
+        other = self.enqueue(suiteJobs('g2', 's1', ['c1'], ['t1']))
+        self.queue.start(jobs[0])
+
+        self.assertEqual(self.queue.removeGroup('g1'), jobs)
+        self.assertEqual(self.queue.groups(), ['g2'])
+        self.assertEqual(self.queue.groups('s1'), ['g2'])
+        self.assertEqual(self.queue.jobs(jobType=Job.START_CLUSTER),
+                         other[:1])
+        self.assertEqual(self.queue.startedJobs, {})
+        self.assertEqual(len(self.queue), len(other))
+
+        self.queue.removeGroup('g2')
+        self.assertEqual(self.queue.groups('s1'), [])
+        self.assertEqual(self.queue.suiteGroups, {})
+        self.assertEqual(self.queue.groupSuite, {})
+        self.assertEqual(len(self.queue), 0)
+        self.assertEqual(self.queue.removeGroup('g2'), [])
+
+class AdmitGroupsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = JobQueue()
+        self.runningSuites = {}
+        self.clusterOwners = {}
+        self.suiteClusters = {'s1': ['c1', 'c2'], 's2': ['c2'], 's3': ['c3']}
+
+    def enqueue(self, groupId, suiteName):
+        jobs = suiteJobs(groupId, suiteName, self.suiteClusters[suiteName],
+                         ['t1'])
+        for j in jobs:
+            self.queue.add(j)
+        return jobs
+
+    def finishing(self, groupId, suiteName):
+        '''
+        Enqueue a group which ran its suite and is about to stop clusters.
+        '''
+        jobs = [Job(Job.STOP_CLUSTER, groupId, c, suiteName) \
+                for c in self.suiteClusters[suiteName]]
+        for j in jobs:
+            self.queue.add(j)
+            self.clusterOwners[j.args] = groupId
+        return jobs
+
+    def admit(self):
+        return self.queue.admitGroups(self.runningSuites, self.clusterOwners,
+                                      self.suiteClusters)
+
+    def testFreeGroupsAreAdmitted(self):
+        self.enqueue('g1', 's1')
+        self.enqueue('g2', 's3')
+        self.assertEqual(self.admit(), [('g1', 's1', []), ('g2', 's3', [])])
+
+    def testFinishedGroupHandsClustersOverToNextRun(self):
+        stops = self.finishing('g1', 's1')
+        starts = self.enqueue('g2', 's1')
+        self.assertEqual(self.admit(),
+                         [('g2', 's1', [(stops[0], starts[0]),
+                                        (stops[1], starts[1])])])
+
+    def testClusterBeingStoppedIsNotHandedOver(self):
+        stops = self.finishing('g1', 's1')
+        self.queue.start(stops[1])
+        self.enqueue('g2', 's1')
+        self.assertEqual(self.admit(), [])
+
+    def testRunningSuiteIsNotRunAgain(self):
+        self.enqueue('g1', 's3')
+        self.runningSuites['s3'] = 'g1'
+        self.enqueue('g2', 's3')
+        self.assertEqual(self.admit(), [])
+
+    def testHeldClusterIsNotHandedOverWhileInUse(self):
+        self.enqueue('g1', 's2')
+        self.runningSuites['s2'] = 'g1'
+        self.clusterOwners['c2'] = 'g1'
+        self.enqueue('g2', 's1')
+        self.assertEqual(self.admit(), [])
+
+    def testWaitingGroupBlocksLaterOnes(self):
+        self.enqueue('g1', 's2')
+        self.runningSuites['s2'] = 'g1'
+        self.clusterOwners['c2'] = 'g1'
+        # waits for c2, reserving its suite and c1 as well
+        self.enqueue('g2', 's1')
+        self.suiteClusters['s4'] = ['c1']
+        self.enqueue('g3', 's4')
+        self.enqueue('g4', 's1')
+        self.enqueue('g5', 's3')
+        self.assertEqual(self.admit(), [('g5', 's3', [])])
+
+if __name__ == '__main__':
+    unittest.main()